@@ -0,0 +1,316 @@
+""" Downloading files with asyncio streams """
+
+from __future__ import division, print_function
+
+# Standard library
+import asyncio
+import os
+import shutil
+import socket
+import ssl
+import tempfile
+
+# Third party
+import astropy.units as u
+from astropy.utils.data import check_free_space_in_dir
+from astropy.extern.six.moves import urllib
+
+# Package
+from .download import _makedirs
+
+__all__ = ['async_download_file']
+
+_default_ports = {'http': 80, 'https': 443}
+
+async def _read_headers(reader):
+    headers = dict()
+    while True:
+        line = (await reader.readline()).decode('latin-1')
+        if not line:
+            raise ConnectionError("Connection closed while reading the response headers")
+        line = line.rstrip('\r\n')
+        if not line:
+            return headers
+        key, _, value = line.partition(':')
+        headers[key.strip().title()] = value.strip()
+
+async def _iter_body(reader, headers, block_size, timeout_s):
+    """ Yield the blocks of a response body, undoing any chunked encoding. """
+
+    async def _read(n):
+        return await asyncio.wait_for(reader.read(n), timeout_s)
+
+    if headers.get('Transfer-Encoding', '').lower() == 'chunked':
+        while True:
+            line = await asyncio.wait_for(reader.readline(), timeout_s)
+            if not line:
+                raise ConnectionError("Connection closed before the last chunk")
+            chunk_size = int(line.split(b';')[0].strip(), 16)
+            if chunk_size == 0:
+                # skip any trailers
+                while (await asyncio.wait_for(reader.readline(), timeout_s)).strip():
+                    pass
+                return
+
+            while chunk_size > 0:
+                block = await _read(min(block_size, chunk_size))
+                if not block:
+                    raise ConnectionError("Connection closed in the middle of a chunk")
+                chunk_size -= len(block)
+                yield block
+            await asyncio.wait_for(reader.readexactly(2), timeout_s)
+
+    elif 'Content-Length' in headers:
+        remaining = int(headers['Content-Length'])
+        while remaining > 0:
+            block = await _read(min(block_size, remaining))
+            if not block:
+                raise ConnectionError("Connection closed with {} bytes left to read"
+                                      .format(remaining))
+            remaining -= len(block)
+            yield block
+
+    else:
+        block = await _read(block_size)
+        while block:
+            yield block
+            block = await _read(block_size)
+
+async def _close(writer):
+    """ Close a connection and wait for its transport to be released. """
+    writer.close()
+    try:
+        await writer.wait_closed()
+    except (OSError, ssl.SSLError):
+        # the connection is gone either way
+        pass
+
+async def _open(remote_url, timeout_s, max_redirects):
+    """
+    Send a GET request, following redirects, and return the reader, writer,
+    and headers of the final successful response.
+    """
+    for i in range(max_redirects + 1):
+        parts = urllib.parse.urlsplit(remote_url)
+        if parts.scheme not in _default_ports:
+            raise ValueError('unknown url type: {}'.format(remote_url))
+
+        port = parts.port or _default_ports[parts.scheme]
+        ssl_context = ssl.create_default_context() if parts.scheme == 'https' else None
+        reader, writer = await asyncio.wait_for(
+            asyncio.open_connection(parts.hostname, port, ssl=ssl_context), timeout_s)
+
+        try:
+            path = parts.path or '/'
+            if parts.query:
+                path = path + '?' + parts.query
+
+            request = ('GET {0} HTTP/1.1\r\n'
+                       'Host: {1}\r\n'
+                       'User-Agent: astrodata\r\n'
+                       'Accept-Encoding: identity\r\n'
+                       'Connection: close\r\n\r\n').format(path, parts.netloc)
+            writer.write(request.encode('latin-1'))
+            await asyncio.wait_for(writer.drain(), timeout_s)
+
+            status_line = (await asyncio.wait_for(reader.readline(), timeout_s)).decode('latin-1')
+            try:
+                _, status, reason = status_line.rstrip('\r\n').split(' ', 2)
+                status = int(status)
+            except ValueError:
+                raise ConnectionError("Invalid HTTP status line: {!r}".format(status_line))
+            headers = await asyncio.wait_for(_read_headers(reader), timeout_s)
+
+        except BaseException:
+            await _close(writer)
+            raise
+
+        if status in (301, 302, 303, 307, 308) and 'Location' in headers:
+            await _close(writer)
+            remote_url = urllib.parse.urljoin(remote_url, headers['Location'])
+            continue
+
+        if status != 200:
+            await _close(writer)
+            raise urllib.error.HTTPError(remote_url, status, reason, headers, None)
+
+        return reader, writer, headers
+
+    raise urllib.error.URLError("Too many redirects for {}".format(remote_url))
+
+async def async_download_file(remote_url, cache_path, filename=None,
+                              timeout=10.*u.second, block_size=2**16,
+                              overwrite=False, progress_callback=None,
+                              max_redirects=5):
+    """
+    The asyncio counterpart of `~astrodata.download.download_file`.
+
+    The file is streamed into a temporary file in ``cache_path`` and moved into
+    place once complete, so many downloads can share one event loop without a
+    thread per transfer.
+
+    Parameters
+    ----------
+    remote_url : str
+        The URL of the file to download. Only ``http`` and ``https`` are
+        supported.
+    cache_path : str
+        The path to save the file.
+    filename : str (optional)
+        The filename to save this file as, locally. Default is to grab the
+        basename of the remote URL.
+    timeout : `~astropy.units.Quantity` (optional)
+        The timeout for connecting and for each read, as an Astropy Quantity
+        (default is 10 seconds).
+    block_size : int (optional)
+        The download block size (default is 64K, 2**16).
+    overwrite : bool (optional)
+        Overwrite file if it exists (default is ``False``).
+    progress_callback : callable (optional)
+        A function called as ``progress_callback(remote_url, bytes_read, size)``
+        after each block is written.
+    max_redirects : int (optional)
+        The maximum number of redirects to follow (default is 5).
+
+    Returns
+    -------
+    local_path : str
+        Returns the local path that the file was download to.
+
+    """
+
+    timeout_s = timeout.to(u.second).value
+    _makedirs(cache_path)
+
+    if filename is None:
+        filename = os.path.basename(remote_url)
+
+    local_path = os.path.join(cache_path, filename)
+
+    if os.path.exists(local_path) and not overwrite:
+        return local_path
+
+    try:
+        reader, writer, headers = await _open(remote_url, timeout_s, max_redirects)
+    except (asyncio.TimeoutError, socket.timeout):
+        raise urllib.error.URLError(socket.timeout('timed out'))
+    except (OSError, ssl.SSLError) as e:
+        if isinstance(e, urllib.error.URLError):
+            raise
+        raise urllib.error.URLError(e)
+
+    try:
+        try:
+            size = int(headers['Content-Length'])
+        except (KeyError, ValueError):
+            size = None
+
+        if size is not None:
+            check_free_space_in_dir(cache_path, size)
+
+        with tempfile.NamedTemporaryFile(dir=cache_path, delete=False) as f:
+            try:
+                bytes_read = 0
+                async for block in _iter_body(reader, headers, block_size, timeout_s):
+                    f.write(block)
+                    bytes_read += len(block)
+                    if progress_callback is not None:
+                        progress_callback(remote_url, bytes_read, size)
+
+            except BaseException as e:
+                f.close()
+                if os.path.exists(f.name):
+                    os.remove(f.name)
+                if isinstance(e, asyncio.TimeoutError):
+                    raise urllib.error.URLError(socket.timeout('timed out'))
+                # like the errors of the connection itself
+                if isinstance(e, (OSError, asyncio.IncompleteReadError)):
+                    raise urllib.error.URLError(e)
+                raise
+
+        shutil.move(f.name, local_path)
+
+    finally:
+        await _close(writer)
+
+    return local_path
+
+async def _aadd_data(cache, sub_path, url_or_path, local_name=None,
+                     delete_source=False, deduplicate=None, **kwargs):
+    """ The implementation of `~astrodata.cache.Cache.aadd_data`. """
+    from .cache import _record_stat
+
+    full_cache_path = os.path.join(cache.root, sub_path)
+    _makedirs(full_cache_path)
+
+    if deduplicate is None:
+        deduplicate = cache.deduplicate
+
+    # local copies and hashing block, so run them in the loop's default executor
+    loop = asyncio.get_running_loop()
+
+    if os.path.exists(url_or_path):
+        local_path, entry = await loop.run_in_executor(
+            None, lambda: cache._ingest(full_cache_path, url_or_path,
+                                        local_name=local_name,
+                                        delete_source=delete_source,
+                                        deduplicate=deduplicate))
+
+    else:
+        try:
+            local_path = await async_download_file(url_or_path, full_cache_path,
+                                                   filename=local_name, **kwargs)
+        except ValueError as e:
+            if 'unknown url type' in str(e):
+                raise ValueError('Input data source path does not exist: {}'
+                                 .format(url_or_path))
+            else:
+                raise e
+        entry = cache._new_entry(url_or_path)
+
+        if deduplicate:
+            await loop.run_in_executor(None, cache._deduplicate, local_path, entry)
+        _record_stat(local_path, entry)
+
+    return local_path, entry
+
+async def _aadd_data_one(cache, sub_path, url_or_path, local_name=None,
+                         delete_source=False, **kwargs):
+    local_path, entry = await _aadd_data(cache, sub_path, url_or_path,
+                                         local_name=local_name,
+                                         delete_source=delete_source, **kwargs)
+    cache._store([(sub_path, os.path.basename(local_path), entry)])
+    return local_path
+
+async def _afetch_many(cache, items, delete_source=False, max_concurrent=16, **kwargs):
+    """ The implementation of `~astrodata.cache.Cache.afetch_many`. """
+    from .cache import IngestResult, _ingest_item
+
+    items = [_ingest_item(item) for item in items]
+    semaphore = asyncio.Semaphore(max(1, int(max_concurrent)))
+
+    async def _fetch(sub_path, url_or_path, local_name):
+        async with semaphore:
+            return await _aadd_data(cache, sub_path, url_or_path,
+                                    local_name=local_name,
+                                    delete_source=delete_source, **kwargs)
+
+    outcomes = await asyncio.gather(*[_fetch(*item) for item in items],
+                                    return_exceptions=True)
+
+    results = []
+    records = []
+    for (sub_path, url_or_path, local_name), outcome in zip(items, outcomes):
+        if isinstance(outcome, BaseException):
+            if not isinstance(outcome, Exception):
+                raise outcome
+            results.append(IngestResult(sub_path, url_or_path, None, outcome))
+            continue
+
+        local_path, entry = outcome
+        records.append((sub_path, os.path.basename(local_path), entry))
+        results.append(IngestResult(sub_path, url_or_path, local_path, None))
+
+    cache._store(records)
+
+    return results
@@ -1,21 +1,210 @@
 # Standard library
-from collections import defaultdict
+from collections import Counter, defaultdict, namedtuple
 import datetime
-import json
+import errno
+import hashlib
 import os
+import re
 import shutil
+import sqlite3
+import tempfile
+import threading
+import time
+import warnings
 try:
     from ConfigParser import ConfigParser
 except ImportError:
     from configparser import ConfigParser
 
-__all__ = ['cache']
+# Package
+from .catalog import (JSONCatalog, JournaledCatalog, SQLiteCatalog, _normalize_sub_path,
+                      migrate_json_to_sqlite, read_entries)
+from .compression import strip_compression_suffix
+from .fastcopy import ingest_file
+from .memmap import MappedFiles
+from .store import ObjectStore, _check_checksum, _parse_checksum, hash_file
+from .telemetry import Stats, emit
+
+__all__ = ['cache', 'IngestResult', 'CacheState']
+
+IngestResult = namedtuple('IngestResult', ['sub_path', 'source', 'local_path', 'error'])
+IngestResult.__doc__ = """
+The outcome of adding one data file with `~astrodata.cache.Cache.add_data_many`.
+``local_path`` is `None` and ``error`` holds the exception if it failed.
+"""
+
+class CacheState(namedtuple('CacheState', ['missing', 'modified', 'orphaned'])):
+    """
+    The result of `~astrodata.cache.Cache.check_state`. ``missing`` and
+    ``modified`` are lists of ``(sub_path, name)`` for files in the schema, and
+    ``orphaned`` is a list of paths (relative to the cache root) of files that
+    are not in the schema. Evaluates to `True` if all are empty.
+    """
+    __slots__ = ()
+
+    def __bool__(self):
+        return not (self.missing or self.modified or self.orphaned)
+    __nonzero__ = __bool__
+
+# an upstream that cannot be read (e.g., a damaged or locked schema) is
+# skipped in favor of the origin
+_upstream_errors = (IOError, sqlite3.Error, ValueError)
+
+# files in the cache root that belong to the cache itself
+_internal_files = ('schema.json', 'schema.json.log', 'schema.json.lock', 'schema.db',
+                   'schema.db-wal', 'schema.db-shm', 'queue.db', 'queue.db-wal',
+                   'queue.db-shm')
+
+# the names `tempfile` gives files being written, e.g. downloads in progress
+_tempfile_name = re.compile(r'^tmp[a-z0-9_]{8}$')
+
+def _is_transient(filename):
+    """
+    Whether a file is hidden, a partial download kept for resuming (with its
+    ``.part.json`` sidecar), or a temporary file being written.
+    """
+    return (filename.startswith('.') or filename.endswith(('.part', '.part.json')) or
+            _tempfile_name.match(filename) is not None)
+
+def _walk_files(root):
+    """
+    Yield the paths of all data files under the cache root, skipping the
+    schema, the object store, and files that are still being written or are
+    kept to resume a download.
+    """
+    for dirpath, dirnames, filenames in os.walk(root):
+        dirnames[:] = [d for d in dirnames if not d.startswith('.')]
+        for filename in filenames:
+            if _is_transient(filename):
+                continue
+            if dirpath == root and filename in _internal_files:
+                continue
+            yield os.path.join(dirpath, filename)
+
+def _remove_if_exists(path):
+    """ Delete a file (or link), tolerating it being gone already. """
+    try:
+        os.remove(path)
+    except OSError as e:
+        if e.errno != errno.ENOENT:
+            raise
+
+def _config_bool(value):
+    return str(value).strip().lower() in ('1', 'yes', 'true', 'on')
+
+_size_units = dict(K=2**10, M=2**20, G=2**30, T=2**40, P=2**50)
+
+def _parse_size(value):
+    """ Parse a size in bytes, with an optional K, M, G, T, or P (binary) suffix. """
+    value = str(value).strip().upper()
+    for suffix in ('IB', 'B'):
+        if value.endswith(suffix) and len(value) > len(suffix):
+            value = value[:-len(suffix)]
+            break
+
+    if value[-1:] in _size_units:
+        return int(float(value[:-1]) * _size_units[value[-1]])
+    return int(float(value))
+
+def _is_under(sub_path, prefix):
+    """ Whether a normalized sub path is ``prefix`` or nested below it. """
+    return (prefix is None or prefix == '.' or sub_path == prefix or
+            sub_path.startswith(prefix + '/'))
+
+def _usage_record(entry):
+    """ What eviction needs to know about an entry. """
+    return (entry.get('size', 0), entry.get('last_access', 0.), bool(entry.get('pinned')),
+            entry.get('sha256'))
+
+def _config_decompress(value):
+    """ A boolean, or the name of a compression format. """
+    value = str(value).strip().lower()
+    if value in ('gzip', 'bz2', 'lzma'):
+        return value
+    return _config_bool(value)
+
+# download settings that can be given in the ~/.astrodataconfig file, and how
+# to parse them
+_download_settings = dict(decompress=_config_decompress,
+                          refresh=_config_bool,
+                          resume=_config_bool,
+                          retries=int,
+                          segments=int,
+                          min_segment_size=int,
+                          lock=_config_bool,
+                          lock_timeout=float)
+
+def _copy_and_hash(source_path, local_path, algorithm, expected_checksum=None,
+                   block_size=2**20):
+    """
+    Copy a file, computing its digest in the same pass. The copy is only moved
+    into place at ``local_path`` if it matches ``expected_checksum``.
+    """
+    h = hashlib.new(algorithm)
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(local_path))
+    try:
+        with open(source_path, 'rb') as fsrc, os.fdopen(fd, 'wb') as fdst:
+            block = fsrc.read(block_size)
+            while block:
+                fdst.write(block)
+                h.update(block)
+                block = fsrc.read(block_size)
+
+        checksum = h.hexdigest()
+        _check_checksum(checksum, expected_checksum, source_path)
+
+        shutil.copystat(source_path, tmp_path)
+        os.replace(tmp_path, local_path)
+
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+    return checksum
+
+def _record_stat(local_path, entry):
+    """
+    Record the size and modification time of a cached file in its schema
+    entry, so that `~astrodata.cache.Cache.check_state` can tell if it changed.
+    """
+    stat = os.stat(local_path)
+    entry['size'] = stat.st_size
+    entry['mtime'] = stat.st_mtime
+
+def _stat_matches(local_path, entry):
+    """ Whether a file has the size and modification time recorded in its entry. """
+    try:
+        stat = os.stat(local_path)
+    except OSError:
+        return False
+    return stat.st_size == entry.get('size') and stat.st_mtime == entry.get('mtime')
+
+def _checksum_key(entry):
+    """ The name of the hash algorithm of a checksum stored in an entry, or `None`. """
+    if 'sha256' in entry:
+        return 'sha256'
+    for key in sorted(entry):
+        if key in hashlib.algorithms_available:
+            return key
+    return None
+
+def _ingest_item(item):
+    """ Normalize a bulk ingestion record to ``(sub_path, url_or_path, local_name)``. """
+    if len(item) == 2:
+        return item[0], item[1], None
+    elif len(item) == 3:
+        return tuple(item)
+    raise ValueError("Expected (sub_path, url_or_path[, local_name]) but got: {}"
+                     .format(item))
 
 class Cache(object):
     """
     A class that maintains the cache path structure.
     """
     def __init__(self, config_file=None):
+        start = time.time()
+        self._stats = Stats()
 
         if config_file is None:
             config_file = '~/.astrodataconfig'
@@ -34,23 +223,220 @@ class Cache(object):
         if repo_path is None:
             raise ValueError("Failed to read repository path from the ~/.astrodataconfig file!")
 
+        self.config = astrodata_metadata
         self.root = os.path.abspath(os.path.expanduser(repo_path))
         if not os.path.exists(self.root):
             os.makedirs(self.root)
 
-        self._schema_path = os.path.join(self.root, 'schema.json')
+        # store file contents once, with cached files linked to them
+        self.deduplicate = _config_bool(astrodata_metadata.get('deduplicate', False))
+        self.objects = ObjectStore(self.root)
+
+        # persistent connections for downloads, created on first use
+        self._pool = None
 
-        # create empty JSON file if nothing exists
-        if not os.path.exists(self._schema_path):
-            with open(self._schema_path, 'w') as f:
-                f.write(json.dumps({}))
+        # the speed of mirror hosts, loaded on first use
+        self._hosts = None
 
-        with open(self._schema_path, 'r') as f:
-            self.schema = json.loads(f.read())
+        # read-only repositories to copy files from before going to their
+        # source, e.g. ``upstream = /nfs/astrodata, http://mirror/astrodata``
+        self._upstreams = None
+
+        # downloads to be done in the background, opened on first use
+        self._queue = None
+
+        # connection windows per host and the bandwidth cap, created on first use
+        self._scheduler = None
+
+        # recently used memory maps of cached files
+        self._maps = MappedFiles(maxsize=int(astrodata_metadata.get('mmap_cache_size', 16)))
+
+        # size limits for the whole cache and for sub paths ("namespaces"),
+        # given as e.g. ``max_size = 500G`` and ``quota.sdss/apogee = 100G``
+        self.max_size = None
+        if 'max_size' in astrodata_metadata:
+            self.max_size = _parse_size(astrodata_metadata['max_size'])
+        self.quotas = dict((_normalize_sub_path(key[len('quota.'):]), _parse_size(value))
+                           for key, value in astrodata_metadata.items()
+                           if key.startswith('quota.'))
+
+        # last-access times not yet written to the schema, and the sizes and
+        # access times of all files, built when first needed
+        self._accesses = dict()
+        self._access_batch_size = int(astrodata_metadata.get('access_batch_size', 256))
+        self._index = None
+
+        # eviction runs on download threads (to make space on disk), so it and
+        # the bookkeeping it reads are done one thread at a time
+        self._usage_lock = threading.RLock()
+
+        # the schema is either a nested JSON document (the default), a JSON
+        # snapshot plus a log of changes, or an indexed SQLite catalog, set
+        # with ``schema_backend`` in the config
+        json_schema_path = os.path.join(self.root, 'schema.json')
+        backend = astrodata_metadata.get('schema_backend', 'json').strip().lower()
+        lock_timeout = astrodata_metadata.get('lock_timeout')
+        if lock_timeout is not None:
+            lock_timeout = float(lock_timeout)
+
+        if backend == 'json':
+            self._schema_path = json_schema_path
+            self._catalog = JSONCatalog(self._schema_path, lock_timeout=lock_timeout)
+
+        elif backend == 'journal':
+            self._schema_path = json_schema_path
+            threshold = astrodata_metadata.get('journal_compact_threshold', 10000)
+            self._catalog = JournaledCatalog(self._schema_path,
+                                             compact_threshold=int(threshold),
+                                             lock_timeout=lock_timeout)
+
+        elif backend == 'sqlite':
+            self._schema_path = os.path.join(self.root, 'schema.db')
+
+            # one-shot migration from an existing JSON schema
+            if (not os.path.exists(self._schema_path) and
+                    os.path.exists(json_schema_path)):
+                migrate_json_to_sqlite(json_schema_path, self._schema_path)
+
+            self._catalog = SQLiteCatalog(self._schema_path)
+
+        else:
+            raise ValueError("Unknown schema_backend '{}' in the ~/.astrodataconfig "
+                             "file -- must be 'json', 'journal', or 'sqlite'."
+                             .format(backend))
+
+        emit(self._stats.record, 'operation', operation='__init__',
+             seconds=time.time() - start)
+
+    @property
+    def schema(self):
+        """
+        The cache schema as a nested mapping of path levels to data file entries.
+        """
+        return self._catalog.schema
+
+    @property
+    def pool(self):
+        """
+        The `~astrodata.pool.ConnectionPool` used for downloads. This is the
+        shared `~astrodata.pool.default_pool` unless ``pool_size`` or
+        ``pool_idle_timeout`` are set in the config file.
+        """
+        if self._pool is None:
+            from .pool import ConnectionPool, default_pool
+            if 'pool_size' in self.config or 'pool_idle_timeout' in self.config:
+                self._pool = ConnectionPool(
+                    maxsize=int(self.config.get('pool_size', 8)),
+                    idle_timeout=float(self.config.get('pool_idle_timeout', 60.)))
+            else:
+                self._pool = default_pool
+        return self._pool
+
+    @property
+    def hosts(self):
+        """
+        The `~astrodata.mirrors.HostScores` used to rank the mirrors of data
+        files, kept in ``.hosts.json`` under the cache root.
+        """
+        if self._hosts is None:
+            from .mirrors import HostScores
+            self._hosts = HostScores(os.path.join(self.root, '.hosts.json'))
+        return self._hosts
+
+    @property
+    def upstreams(self):
+        """
+        The upstream repositories (`~astrodata.upstream.LocalUpstream` or
+        `~astrodata.upstream.HTTPUpstream`) set with ``upstream`` in the
+        config file, in the order they are consulted.
+        """
+        if self._upstreams is None:
+            from .upstream import open_upstream
+            locations = self.config.get('upstream', '').replace(',', ' ').split()
+            self._upstreams = [open_upstream(location, pool=self.pool)
+                               for location in locations]
+        return self._upstreams
+
+    @property
+    def queue(self):
+        """
+        The persistent `~astrodata.download_queue.DownloadQueue` of files
+        added with ``enqueue=True``, kept in ``queue.db`` under the cache root
+        and drained by a `~astrodata.download_queue.QueueWorker` (e.g., the
+        ``astrodata-worker`` command).
+        """
+        if self._queue is None:
+            from .download_queue import DownloadQueue
+            self._queue = DownloadQueue(
+                os.path.join(self.root, 'queue.db'),
+                max_attempts=int(self.config.get('queue_attempts', 3)),
+                retry_delay=float(self.config.get('queue_retry_delay', 1.)))
+        return self._queue
+
+    @property
+    def scheduler(self):
+        """
+        The `~astrodata.scheduler.Scheduler` that shares connections between
+        hosts when files are added with several workers, and caps the total
+        bandwidth of all downloads. It is set up with
+        ``max_connections_per_host`` (for all hosts, or per host as e.g.
+        ``max_connections_per_host.archive.example.org = 2``; default is no
+        limit, so only ``max_workers`` bounds the connections to a host),
+        ``initial_connections_per_host`` (default 2), and ``max_bandwidth`` in
+        bytes per second (e.g., ``50M``; default is no limit) in the config
+        file.
+        """
+        if self._scheduler is None:
+            from .scheduler import Scheduler
+            prefix = 'max_connections_per_host.'
+            host_limits = dict((key[len(prefix):], int(value))
+                               for key, value in self.config.items()
+                               if key.startswith(prefix))
+            max_bandwidth = self.config.get('max_bandwidth')
+            max_per_host = self.config.get('max_connections_per_host')
+            self._scheduler = Scheduler(
+                max_per_host=int(max_per_host) if max_per_host is not None else None,
+                initial_per_host=int(self.config.get('initial_connections_per_host', 2)),
+                host_limits=host_limits,
+                max_bandwidth=_parse_size(max_bandwidth) if max_bandwidth else None)
+        return self._scheduler
 
     def close(self):
-        with open(self._schema_path, 'r+') as f:
-            f.write(json.dumps(self.schema, indent=4, sort_keys=True))
+        with self._stats.timed('close'):
+            self._flush_accesses()
+            if self._hosts is not None:
+                self._hosts.save()
+            self._catalog.close()
+            self._maps.clear()
+            if self._queue is not None:
+                self._queue.close()
+
+            if self._pool is not None:
+                from .pool import default_pool
+                if self._pool is not default_pool:
+                    self._pool.clear()
+
+        # for the node exporter's textfile collector
+        if 'prometheus_textfile' in self.config:
+            self._stats.write_prometheus(
+                os.path.expanduser(self.config['prometheus_textfile']))
+
+    def stats(self):
+        """
+        Summarize the downloads and operations of this cache since it was
+        opened, with the totals and latency percentiles described in
+        `~astrodata.telemetry.Stats.summary`. If ``prometheus_textfile`` is
+        set in the config file, the statistics are also written there in the
+        Prometheus text format when the cache is closed.
+        """
+        return self._stats.summary()
+
+    def compact(self):
+        """
+        Compact the on-disk schema. For the ``journal`` backend this folds the
+        log of changes into a new schema snapshot.
+        """
+        self._catalog.compact()
 
     def __enter__(self):
         return self
@@ -58,7 +444,9 @@ class Cache(object):
     def __exit__(self, *args):
         self.close()
 
-    def add_data(self, sub_path, url_or_path, local_name=None, delete_source=False, **kwargs):
+    def add_data(self, sub_path, url_or_path, local_name=None, delete_source=False,
+                 deduplicate=None, hash_algorithm=None, expected_checksum=None,
+                 hardlink=None, mirrors=None, enqueue=False, priority=0, **kwargs):
         """
         Add a data file to the cache.
 
@@ -66,6 +454,11 @@ class Cache(object):
         from its current directory to the cache. If a file already exists at the
         specified ``sub_path`` with the same name, it will be over-written.
 
+        Local files are added without copying their data where possible: they
+        are renamed (with ``delete_source=True``), hardlinked (with
+        ``hardlink=True``), or cloned as reflinks when the source is on the same
+        filesystem as the cache, and otherwise copied inside the kernel.
+
         Parameters
         ----------
         sub_path : str
@@ -79,57 +472,1058 @@ class Cache(object):
         delete_source : bool (optional)
             If the source path is local, delete the source after copying to the cache
             (default is ``False``).
+        deduplicate : bool (optional)
+            Store the file contents in the content-addressed object store under
+            the cache root and make the cached file a link to it, so identical
+            files are only stored once. The SHA-256 digest is recorded in the
+            schema entry. Default is the ``deduplicate`` setting in the
+            ~/.astrodataconfig file, or ``False``.
+        hash_algorithm : str (optional)
+            Compute a digest of the file with this `hashlib` algorithm while it
+            is copied or downloaded, and record it in the schema entry under
+            the algorithm name alongside the file ``size``. Default is the
+            ``hash_algorithm`` setting in the ~/.astrodataconfig file, or none.
+        expected_checksum : str (optional)
+            The expected hex digest of the file, optionally prefixed by the
+            algorithm name (e.g., ``'md5:...'``). If the data do not match, an
+            `IOError` is raised and the file is not added to the cache.
+        hardlink : bool (optional)
+            If the source path is local and on the same filesystem as the cache,
+            make the cached file a hardlink to it rather than a copy. The two
+            then share their contents. Default is the ``hardlink`` setting in
+            the ~/.astrodataconfig file, or ``False``.
+        mirrors : iterable (optional)
+            Other URLs of the same remote file. The file is downloaded from
+            whichever mirror has been fastest, falling back to the others if
+            it fails, and the mirrors are recorded in the schema entry. With
+            ``hedge_percentile`` (e.g., 95) or ``hedge_delay`` (in seconds),
+            passed or set in the ~/.astrodataconfig file, a second mirror is
+            also tried if the first has not responded within that percentile
+            of its recent response times, or that delay. See
+            `~astrodata.mirrors.fetch_mirrored`.
+        enqueue : bool (optional)
+            Instead of adding the file now, put it in the persistent download
+            queue of the cache and return a
+            `~astrodata.download_queue.QueuedDownload` at once, whose ``wait()``
+            returns the local path once a worker has added the file. All
+            other arguments must then be serializable as JSON (default is
+            ``False``).
+        priority : int (optional)
+            With ``enqueue``, files with higher priorities are downloaded
+            first, and among equal priorities, smaller files first (default is
+            0).
         **kwargs
             All other keyword arguments are passed to `~astrodata.download.download_file`.
+            With ``refresh=True``, a file that is already in the cache is only
+            downloaded again if the server reports that it has changed since the
+            ``etag`` and ``last_modified`` recorded in its schema entry. With
+            ``decompress=True``, compressed files are stored uncompressed, and
+            the entry records the ``compression`` format along with the
+            ``source_size`` and ``source_checksum`` of the compressed data.
 
         """
 
-        full_cache_path = os.path.join(self.root, sub_path)
-        if not os.path.exists(full_cache_path):
-            os.makedirs(full_cache_path)
+        if enqueue:
+            from .download_queue import QueuedDownload
+            options = dict(kwargs, delete_source=delete_source, deduplicate=deduplicate,
+                           hash_algorithm=hash_algorithm,
+                           expected_checksum=expected_checksum, hardlink=hardlink,
+                           mirrors=list(mirrors) if mirrors else None)
+            options = dict((key, value) for key, value in options.items()
+                           if value is not None)
+            job_id = self.queue.put(sub_path, url_or_path, local_name=local_name,
+                                    priority=priority,
+                                    size=self._known_size(sub_path, url_or_path, local_name),
+                                    options=options)
+            return QueuedDownload(self, job_id)
+
+        with self._stats.timed('add_data'):
+            full_cache_path = os.path.join(self.root, sub_path)
+            if not os.path.exists(full_cache_path):
+                os.makedirs(full_cache_path)
+
+            local_path, entry = self._ingest(full_cache_path, url_or_path,
+                                             local_name=local_name,
+                                             delete_source=delete_source,
+                                             deduplicate=deduplicate,
+                                             hash_algorithm=hash_algorithm,
+                                             expected_checksum=expected_checksum,
+                                             hardlink=hardlink, mirrors=mirrors,
+                                             **kwargs)
+            self._store([(sub_path, os.path.basename(local_path), entry)])
+
+        return local_path
+
+    def add_data_many(self, items, delete_source=False, max_workers=None, **kwargs):
+        """
+        Add many data files to the cache, committing them to the schema at once.
+
+        Failures are collected per item rather than stopping the batch -- the
+        schema is only updated for the files that were added successfully.
+
+        Parameters
+        ----------
+        items : iterable
+            An iterable of ``(sub_path, url_or_path)`` or
+            ``(sub_path, url_or_path, local_name)`` records, with the same
+            meaning as the arguments of `~astrodata.cache.Cache.add_data`.
+        delete_source : bool (optional)
+            If a source path is local, delete the source after copying to the
+            cache (default is ``False``).
+        max_workers : int (optional)
+            The number of files to copy or download at the same time. Default
+            is the ``max_workers`` setting in the ~/.astrodataconfig file, or 1.
+            With more than one worker, progress bars are disabled unless
+            ``show_progress=True`` is passed -- use ``progress_callback`` to
+            follow the progress of each download instead. The workers are
+            shared between the hosts of the files by
+            `~astrodata.cache.Cache.scheduler`.
+        **kwargs
+            All other keyword arguments (e.g., ``deduplicate`` or
+            ``hash_algorithm``) are passed to `~astrodata.cache.Cache.add_data`.
+
+        Returns
+        -------
+        results : list
+            One `~astrodata.cache.IngestResult` per input item, in order.
+
+        """
+        items = [_ingest_item(item) for item in items]
+
+        # create each directory once, remembering failures for the items in it
+        dir_errors = dict()
+        for sub_path in set(item[0] for item in items):
+            full_cache_path = os.path.join(self.root, sub_path)
+            try:
+                if not os.path.exists(full_cache_path):
+                    os.makedirs(full_cache_path)
+            except OSError as e:
+                dir_errors[sub_path] = e
+
+        if max_workers is None:
+            max_workers = int(self.config.get('max_workers', 1))
+
+        def _ingest(sub_path, url_or_path, local_name):
+            if sub_path in dir_errors:
+                raise dir_errors[sub_path]
+            return self._ingest(os.path.join(self.root, sub_path),
+                                url_or_path, local_name=local_name,
+                                delete_source=delete_source, **kwargs)
+
+        if max_workers > 1:
+            kwargs.setdefault('show_progress', False)
+            outcomes = self.scheduler.map(_ingest, items, url_of=lambda item: item[1],
+                                          max_workers=max_workers)
+
+        else:
+            outcomes = []
+            for item in items:
+                try:
+                    outcomes.append((_ingest(*item), None))
+                except Exception as e:
+                    outcomes.append((None, e))
+
+        # the schema is only touched from this thread, once all files are in place
+        results = []
+        records = []
+        for (sub_path, url_or_path, local_name), (outcome, error) in zip(items, outcomes):
+            if error is not None:
+                results.append(IngestResult(sub_path, url_or_path, None, error))
+                continue
+
+            local_path, entry = outcome
+            records.append((sub_path, os.path.basename(local_path), entry))
+            results.append(IngestResult(sub_path, url_or_path, local_path, None))
+
+        self._store(records)
+
+        return results
+
+    def _ingest(self, full_cache_path, url_or_path, local_name=None,
+                delete_source=False, deduplicate=None, hash_algorithm=None,
+                expected_checksum=None, hardlink=None, mirrors=None, tiered=True,
+                **kwargs):
+        """
+        Copy or download a single data file into an existing cache directory.
+        With ``tiered``, a remote file that is not yet here is copied from an
+        upstream repository that has it, if any.
+
+        Returns the local path and the new schema entry for the file.
+        """
+        if deduplicate is None:
+            deduplicate = self.deduplicate
+
+        if hardlink is None:
+            hardlink = _config_bool(self.config.get('hardlink', False))
+
+        if hash_algorithm is None:
+            hash_algorithm = self.config.get('hash_algorithm', None)
+        algorithm, expected_checksum = _parse_checksum(hash_algorithm, expected_checksum)
 
         if os.path.exists(url_or_path):
             if local_name is None:
                 local_name = os.path.basename(url_or_path)
             local_path = os.path.join(full_cache_path, local_name)
-            shutil.copy2(url_or_path, local_path)
+            entry = self._new_entry(url_or_path)
 
-            if delete_source:
-                os.unlink(url_or_path)
+            if deduplicate:
+                # an identical file already in the store is only linked, and a
+                # moved file is renamed into the store rather than copied
+                digest = hash_file(url_or_path)
+                if algorithm is not None:
+                    checksum = digest if algorithm == 'sha256' else hash_file(url_or_path, algorithm)
+                    _check_checksum(checksum, expected_checksum, url_or_path)
+                    entry[algorithm] = checksum
+
+                self.objects.add(url_or_path, digest=digest, move=delete_source)
+                self.objects.link(digest, local_path)
+                entry['sha256'] = digest
+                _record_stat(local_path, entry)
+                return local_path, entry
+
+            if algorithm is not None and not (delete_source or hardlink):
+                # the data have to be read anyway, so hash them while copying
+                entry[algorithm] = _copy_and_hash(url_or_path, local_path, algorithm,
+                                                  expected_checksum)
+
+            else:
+                if algorithm is not None:
+                    # renames and links don't read the data, so check them first
+                    entry[algorithm] = hash_file(url_or_path, algorithm)
+                    _check_checksum(entry[algorithm], expected_checksum, url_or_path)
+
+                # renamed, linked, or reflinked within a filesystem, and only
+                # copied (in the kernel) across filesystems
+                ingest_file(url_or_path, local_path, move=delete_source,
+                            hardlink=hardlink)
 
         else:
-            from .download import download_file
+            from .download import fetch_file
+            kwargs = self._download_kwargs(kwargs)
+
+            # what is already known about the file, for a conditional refresh
+            name = local_name
+            if name is None:
+                name = os.path.basename(url_or_path)
+                if kwargs.get('decompress'):
+                    name, _ = strip_compression_suffix(name)
+            sub_path = os.path.relpath(full_cache_path, self.root)
+
+            if (tiered and not kwargs.get('refresh') and
+                    (kwargs.get('overwrite') or
+                     not os.path.exists(os.path.join(full_cache_path, name)))):
+                options = dict((key, kwargs[key]) for key in
+                               ('timeout', 'show_progress', 'progress_callback')
+                               if key in kwargs)
+                hit = self._from_upstream(sub_path, name, source=url_or_path,
+                                          deduplicate=deduplicate,
+                                          hash_algorithm=algorithm,
+                                          expected_checksum=expected_checksum,
+                                          hardlink=hardlink, **options)
+                if hit is not None:
+                    return hit
+
+            previous = self._catalog.get(sub_path, name)
+            if previous is not None and previous.get('source') != url_or_path:
+                previous = None
+            if kwargs.get('refresh') and previous is not None:
+                kwargs.setdefault('etag', previous.get('etag'))
+                kwargs.setdefault('last_modified', previous.get('last_modified'))
+            if (algorithm is not None and previous is not None and
+                    previous.get(algorithm) is not None and
+                    _stat_matches(os.path.join(full_cache_path, name), previous)):
+                # the file has not changed since it was hashed
+                kwargs.setdefault('local_checksum', previous[algorithm])
+
+            hedge = dict()
+            for key in ('hedge_percentile', 'hedge_delay'):
+                value = kwargs.pop(key, self.config.get(key))
+                if value is not None:
+                    hedge[key] = float(value)
+
             try:
-                local_path = download_file(url_or_path, full_cache_path, filename=local_name, **kwargs)
+                if mirrors:
+                    from .mirrors import fetch_mirrored
+                    size = previous.get('size') if previous is not None else None
+                    result = fetch_mirrored([url_or_path] + list(mirrors), full_cache_path,
+                                            filename=local_name, scores=self.hosts,
+                                            size=size, hash_algorithm=algorithm,
+                                            expected_checksum=expected_checksum,
+                                            **dict(kwargs, **hedge))
+                else:
+                    result = fetch_file(url_or_path, full_cache_path, filename=local_name,
+                                        hash_algorithm=algorithm,
+                                        expected_checksum=expected_checksum, **kwargs)
             except ValueError as e:
                 if 'unknown url type' in str(e):
                     raise ValueError('Input data source path does not exist: {}'
                                      .format(url_or_path))
                 else:
                     raise e
-            local_name = os.path.basename(local_path)
 
-        # get each path level as a list of names
-        path_pieces = os.path.normpath(sub_path).split(os.sep)
+            local_path = result.local_path
+            if (result.not_modified or result.cached) and previous is not None:
+                # nothing was transferred, so keep what is known about the file
+                entry = dict(previous)
+            else:
+                entry = self._new_entry(url_or_path)
+                if previous is not None and 'mirrors' in previous:
+                    entry['mirrors'] = previous['mirrors']
+            if mirrors:
+                entry['mirrors'] = list(mirrors)
+
+            for key in ('etag', 'last_modified', 'content_length'):
+                if getattr(result, key) is not None:
+                    entry[key] = getattr(result, key)
+            if result.checksum is not None:
+                entry[result.hash_algorithm] = result.checksum
+
+            # the source is compressed but the cached file is not
+            if result.compression is not None:
+                entry['compression'] = result.compression
+                entry['source_size'] = result.source_size
+                if result.source_checksum is not None:
+                    entry['source_checksum'] = '{0}:{1}'.format(result.hash_algorithm,
+                                                                result.source_checksum)
+
+        if deduplicate:
+            self._deduplicate(local_path, entry)
+
+        _record_stat(local_path, entry)
+        return local_path, entry
+
+    def _from_upstream(self, sub_path, name, source=None, hash_algorithm=None,
+                       expected_checksum=None, **kwargs):
+        """
+        Copy (or link) a file from the first upstream repository that has it,
+        checking it against the checksum in the upstream entry.
+
+        Returns the local path and the new schema entry for the file, or
+        `None` if no upstream repository could provide it.
+        """
+        for upstream in self.upstreams:
+            try:
+                found = upstream.find(sub_path, name, source=source)
+                if found is None:
+                    continue
+
+                upstream_sub_path, upstream_name, upstream_entry = found
+                algorithm, checksum = hash_algorithm, expected_checksum
+                if checksum is None:
+                    # check the copy against what upstream recorded
+                    if algorithm is None:
+                        algorithm = _checksum_key(upstream_entry)
+                    if algorithm is not None:
+                        checksum = upstream_entry.get(algorithm)
+
+                location = upstream.location(upstream_sub_path, upstream_name)
+                local_path = os.path.join(self.root, sub_path, name)
+
+                # copy each file once, however many processes want it
+                from .download import _lock_path
+                from .lock import FileLock
+                with FileLock(_lock_path(local_path),
+                              timeout=kwargs.get('lock_timeout')) as file_lock:
+                    if (file_lock.waited and os.path.exists(local_path) and
+                            os.path.getsize(local_path) == upstream_entry.get('size')):
+                        entry = self._new_entry(location)
+                        _record_stat(local_path, entry)
+                    else:
+                        local_path, entry = self._ingest(
+                            os.path.join(self.root, sub_path), location,
+                            local_name=name, hash_algorithm=algorithm,
+                            expected_checksum=checksum, tiered=False, lock=False,
+                            **kwargs)
+
+            except _upstream_errors as e:
+                warnings.warn("Failed to copy {0} from {1}: {2}".format(name, upstream, e))
+                continue
+
+            # the file is the same as upstream, but its use here is local
+            upstream_entry = dict((key, value) for key, value in upstream_entry.items()
+                                  if key not in ('last_access', 'pinned'))
+            entry = dict(upstream_entry, **entry)
+            entry['source'] = upstream_entry['source']
+            return local_path, entry
+
+        return None
+
+    def lookup(self, sub_path, name, source=None, **kwargs):
+        """
+        Return the local path of a data file, first from this cache, then by
+        copying it from the first of the ``upstream`` repositories in the
+        config file that has it (along with its schema entry), and finally by
+        downloading it from its source.
+
+        Parameters
+        ----------
+        sub_path : str
+            Path to the file relative to the cache root.
+        name : str
+            The local filename.
+        source : str (optional)
+            The URL of the file, if it is not known from this cache or an
+            upstream repository.
+        **kwargs
+            All other keyword arguments are passed to
+            `~astrodata.cache.Cache.add_data`.
+
+        Returns
+        -------
+        local_path : str
+        """
+        entry = self._catalog.get(sub_path, name)
+        local_path = os.path.join(self.root, sub_path, name)
+        if entry is not None and os.path.exists(local_path):
+            self.touch(sub_path, name)
+            return local_path
+
+        with self._stats.timed('lookup'):
+            full_cache_path = os.path.join(self.root, sub_path)
+            if not os.path.exists(full_cache_path):
+                os.makedirs(full_cache_path)
+
+            hit = self._from_upstream(sub_path, name, source=source)
+            if hit is not None:
+                local_path, entry = hit
+                self._store([(sub_path, name, entry)])
+                return local_path
+
+            # the origin, as recorded here or upstream
+            known = [entry]
+            for upstream in self.upstreams:
+                try:
+                    known.append(upstream.get(sub_path, name))
+                except _upstream_errors:
+                    pass
+            for known_entry in known:
+                if source is None and known_entry is not None:
+                    source = known_entry['source']
+                    kwargs.setdefault('mirrors', known_entry.get('mirrors'))
 
-        sub_schema = self.schema
-        for piece in path_pieces:
-            sub_schema[piece] = sub_schema.get(piece, dict())
-            sub_schema = sub_schema[piece]
+            if source is None:
+                raise IOError("No cached file '{0}' under '{1}', and no source to "
+                              "download it from".format(name, sub_path))
 
-        sub_schema[local_name] = dict()
-        sub_schema[local_name]['source'] = url_or_path
-        sub_schema[local_name]['download_datetime'] = datetime.datetime.now().isoformat()
+        return self.add_data(sub_path, source, local_name=name, **kwargs)
 
+    def _known_size(self, sub_path, url_or_path, local_name=None):
+        """
+        The size of a file to be added, if it is local or was cached before,
+        for ordering queued downloads. `None` if it is not known yet.
+        """
+        if os.path.exists(url_or_path):
+            return os.path.getsize(url_or_path)
+
+        name = local_name if local_name is not None else os.path.basename(url_or_path)
+        entry = self._catalog.get(sub_path, name)
+        if entry is not None and entry.get('source') == url_or_path:
+            return entry.get('content_length', entry.get('size'))
+        return None
+
+    def _deduplicate(self, local_path, entry):
+        """
+        Move a cached file into the object store, replace it with a link, and
+        record its digest in the schema entry.
+        """
+        digest = self.objects.add(local_path, digest=entry.get('sha256'), move=True)
+        self.objects.link(digest, local_path)
+        entry['sha256'] = digest
+
+    def _download_kwargs(self, kwargs):
+        """
+        Fill in any download settings from the config file that were not
+        passed explicitly.
+        """
+        kwargs = dict(kwargs)
+        for name, parse in _download_settings.items():
+            if name in self.config:
+                kwargs.setdefault(name, parse(self.config[name]))
+        kwargs.setdefault('pool', self.pool)
+        if self.scheduler.bucket is not None:
+            kwargs.setdefault('throttle', self.scheduler.throttle)
+        if self.max_size is not None or self.quotas:
+            kwargs.setdefault('make_space', self._make_space)
+        # count downloads in the cache statistics and adapt the connections
+        # per host to them, as well as telling the caller
+        kwargs['event_callback'] = self._stats._callback(
+            self.scheduler._callback(kwargs.get('event_callback')))
+        return kwargs
+
+    def _new_entry(self, url_or_path):
+        """ The schema entry for a data file that was just added. """
+        entry = dict()
+        entry['source'] = url_or_path
+        entry['download_datetime'] = datetime.datetime.now().isoformat()
+        return entry
+
+    def aadd_data(self, sub_path, url_or_path, local_name=None, delete_source=False,
+                  **kwargs):
+        """
+        Add a data file to the cache without blocking the event loop.
+
+        This is the asyncio counterpart of `~astrodata.cache.Cache.add_data`
+        and takes the same arguments, except that remote files are fetched
+        with `~astrodata.async_download.async_download_file`, to which all
+        other keyword arguments are passed. Use as
+        ``local_path = await cache.aadd_data(...)``.
+
+        Returns
+        -------
+        coroutine
+            A coroutine that returns the local path of the file.
+
+        """
+        from .async_download import _aadd_data_one
+        return _aadd_data_one(self, sub_path, url_or_path, local_name=local_name,
+                              delete_source=delete_source, **kwargs)
+
+    def afetch_many(self, items, delete_source=False, max_concurrent=None, **kwargs):
+        """
+        Add many data files to the cache concurrently from an event loop.
+
+        This is the asyncio counterpart of `~astrodata.cache.Cache.add_data_many`
+        and takes the same ``items``. All transfers share the running event
+        loop rather than using a thread each. Use as
+        ``results = await cache.afetch_many(...)``.
+
+        Parameters
+        ----------
+        items : iterable
+            An iterable of ``(sub_path, url_or_path)`` or
+            ``(sub_path, url_or_path, local_name)`` records.
+        delete_source : bool (optional)
+            If a source path is local, delete the source after copying to the
+            cache (default is ``False``).
+        max_concurrent : int (optional)
+            The maximum number of simultaneous transfers. Default is the
+            ``max_concurrent`` setting in the ~/.astrodataconfig file, or 16.
+        **kwargs
+            All other keyword arguments are passed to
+            `~astrodata.async_download.async_download_file`.
+
+        Returns
+        -------
+        coroutine
+            A coroutine that returns one `~astrodata.cache.IngestResult` per
+            input item, in order.
+
+        """
+        from .async_download import _afetch_many
+        if max_concurrent is None:
+            max_concurrent = int(self.config.get('max_concurrent', 16))
+        return _afetch_many(self, items, delete_source=delete_source,
+                            max_concurrent=max_concurrent, **kwargs)
+
+    def get_entry(self, sub_path, name):
+        """
+        Look up the schema entry for a cached data file.
+
+        Parameters
+        ----------
+        sub_path : str
+            Path to the file relative to the cache root.
+        name : str
+            The local filename.
+
+        Returns
+        -------
+        entry : dict or None
+            The schema entry, or `None` if the file is not in the cache.
+        """
+        return self._catalog.get(sub_path, name)
+
+    def _entry_path(self, sub_path, name):
+        """ The local path of a file in the schema, which must exist. """
+        if self._catalog.get(sub_path, name) is None:
+            raise IOError("No cached file '{0}' under '{1}'".format(name, sub_path))
+
+        local_path = os.path.join(self.root, sub_path, name)
+        if not os.path.exists(local_path):
+            raise IOError("Cached file is missing from disk: {}".format(local_path))
         return local_path
 
-    def check_state(self):
-        # TODO: return True if everything is ok
-        # TODO: return False if not, raise warnings
-        pass
+    def open_mmap(self, sub_path, name):
+        """
+        Memory-map a cached data file for reading, without copying it into
+        memory. Maps of recently used files are kept open (up to
+        ``mmap_cache_size`` in the config file, default 16) and reused, with
+        each call getting its own view that it may release as it likes.
+
+        Parameters
+        ----------
+        sub_path : str
+            Path to the file relative to the cache root.
+        name : str
+            The local filename.
+
+        Returns
+        -------
+        view : `memoryview`
+            A read-only view of a map of the whole file.
+        """
+        local_path = self._entry_path(sub_path, name)
+        self.touch(sub_path, name)
+        return self._maps.open_mmap(local_path)
+
+    def load_array(self, sub_path, name, dtype=None, shape=None, offset=0, order='C'):
+        """
+        Load a cached data file as memory-mapped data, without copying it into
+        memory. Like `~astrodata.cache.Cache.open_mmap`, the maps of recently
+        used files are kept open and reused, and each call gets its own view
+        -- or for a FITS file, its own `~astropy.io.fits.HDUList` to close.
+
+        Parameters
+        ----------
+        sub_path : str
+            Path to the file relative to the cache root.
+        name : str
+            The local filename.
+        dtype : data-type (optional)
+            The data type of a raw binary file (default is bytes).
+        shape : tuple (optional)
+            The shape of a raw binary file (default is a flat array of the
+            whole file).
+        offset : int (optional)
+            The byte offset of the data in a raw binary file (default is 0).
+        order : str (optional)
+            ``'C'`` or ``'F'`` order for a raw binary file (default is
+            ``'C'``).
+
+        Returns
+        -------
+        data : `~astropy.io.fits.HDUList` or `numpy.ndarray`
+            An `~astropy.io.fits.HDUList` opened with ``memmap=True`` for FITS
+            files, the read-only array of a ``.npy`` file, and otherwise a
+            read-only array over the map of the file.
+        """
+        local_path = self._entry_path(sub_path, name)
+        self.touch(sub_path, name)
+        return self._maps.load_array(local_path, dtype=dtype, shape=shape,
+                                     offset=offset, order=order)
+
+    def _set_entries(self, records):
+        """ Write entries to the schema, keeping the usage index up to date. """
+        records = list(records)
+        with self._usage_lock:
+            self._catalog.set_many(records)
+            if self._index is not None:
+                for sub_path, name, entry in records:
+                    self._index[(_normalize_sub_path(sub_path), name)] = _usage_record(entry)
+
+    def _store(self, records):
+        """
+        Write the entries of newly added files to the schema, as just
+        accessed, and evict other files if that puts the cache over its size
+        limits.
+        """
+        records = list(records)
+        now = time.time()
+        for sub_path, name, entry in records:
+            entry['last_access'] = now
+            # a file added again in place of a pinned one stays pinned
+            if 'pinned' not in entry:
+                previous = self._catalog.get(sub_path, name)
+                if previous is not None and previous.get('pinned'):
+                    entry['pinned'] = True
+        self._set_entries(records)
+        return self._enforce_limits([(sub_path, name) for sub_path, name, _ in records])
+
+    def touch(self, sub_path, name):
+        """
+        Record an access to a cached file, for least-recently-used eviction.
+        Access times are written to the schema in batches (of
+        ``access_batch_size`` in the config file, default 256) and on `close`.
+        """
+        with self._usage_lock:
+            self._accesses[(_normalize_sub_path(sub_path), name)] = time.time()
+            if len(self._accesses) >= self._access_batch_size:
+                self._flush_accesses()
+
+    def _flush_accesses(self):
+        with self._usage_lock:
+            accesses, self._accesses = self._accesses, dict()
+            records = []
+            for (sub_path, name), last_access in accesses.items():
+                entry = self._catalog.get(sub_path, name)
+                if entry is not None:
+                    records.append((sub_path, name, dict(entry, last_access=last_access)))
+
+            if records:
+                self._set_entries(records)
+
+    def pin(self, sub_path, name, pinned=True):
+        """
+        Protect a cached file from eviction, or with ``pinned=False``, allow
+        it to be evicted again.
+        """
+        entry = self._catalog.get(sub_path, name)
+        if entry is None:
+            raise IOError("No cached file '{0}' under '{1}'".format(name, sub_path))
+
+        entry = dict(entry)
+        if pinned:
+            entry['pinned'] = True
+        else:
+            entry.pop('pinned', None)
+        self._set_entries([(sub_path, name, entry)])
+
+    def unpin(self, sub_path, name):
+        """ Allow a file protected with `pin` to be evicted again. """
+        self.pin(sub_path, name, pinned=False)
+
+    def _usage_index(self):
+        with self._usage_lock:
+            if self._index is None:
+                self._index = dict(((_normalize_sub_path(sub_path), name),
+                                    _usage_record(entry))
+                                   for sub_path, name, entry in self._catalog.entries())
+            return self._index
+
+    def usage(self, sub_path=None):
+        """
+        The total size in bytes of the files in the schema, or of those under
+        ``sub_path``. Files linked to the same stored object count once.
+        """
+        prefix = None if sub_path is None else _normalize_sub_path(sub_path)
+        total = 0
+        digests = set()
+        with self._usage_lock:
+            for (key_sub_path, _), (size, _, _, digest) in self._usage_index().items():
+                if not _is_under(key_sub_path, prefix) or digest in digests:
+                    continue
+                if digest is not None:
+                    digests.add(digest)
+                total += size
+        return total
+
+    def evict(self, nbytes, sub_path=None, exclude=()):
+        """
+        Remove the least-recently-used files that are not pinned, until at
+        least ``nbytes`` bytes are freed or nothing more can be evicted.
+
+        Parameters
+        ----------
+        nbytes : int
+            The number of bytes to free.
+        sub_path : str (optional)
+            Only evict files under this sub path (default is the whole cache).
+        exclude : iterable (optional)
+            ``(sub_path, name)`` of files not to evict.
+
+        Returns
+        -------
+        evicted : list
+            ``(sub_path, name)`` of the removed files.
+        """
+        prefix = None if sub_path is None else _normalize_sub_path(sub_path)
+        exclude = set((_normalize_sub_path(s), n) for s, n in exclude)
+
+        with self._usage_lock:
+            index = self._usage_index()
+            candidates = sorted((self._accesses.get(key, last_access), key, size, digest)
+                                for key, (size, last_access, pinned, digest) in index.items()
+                                if not pinned and key not in exclude and
+                                _is_under(key[0], prefix))
+
+            # links to an object may be hardlinks or symlinks, so the schema
+            # is what knows whether it is still used
+            references = Counter(digest for _, _, _, digest in index.values()
+                                 if digest is not None)
+
+            evicted = []
+            freed = 0
+            for _, key, size, digest in candidates:
+                if freed >= nbytes:
+                    break
+
+                self._remove_file(*key)
+                evicted.append(key)
+                if digest is None:
+                    freed += size
+                    continue
+
+                # the space only comes back with the last link to the object
+                references[digest] -= 1
+                if references[digest] <= 0:
+                    _remove_if_exists(self.objects.object_path(digest))
+                    freed += size
+
+            self._catalog.delete_many(evicted)
+            for key in evicted:
+                index.pop(key, None)
+                self._accesses.pop(key, None)
+
+        return evicted
+
+    def _remove_file(self, sub_path, name):
+        """ Delete a cached file and any directories left empty. """
+        local_path = os.path.join(self.root, sub_path, name)
+        _remove_if_exists(local_path)
+
+        path = os.path.dirname(local_path)
+        while path != self.root and path.startswith(self.root):
+            try:
+                os.rmdir(path)
+            except OSError:
+                break
+            path = os.path.dirname(path)
+
+    def _enforce_limits(self, keys=()):
+        """
+        Evict files until the cache is within ``max_size`` and the quotas of
+        the sub paths of ``keys`` (which are not evicted themselves).
+        """
+        if self.max_size is None and not self.quotas:
+            return []
+
+        keys = set((_normalize_sub_path(sub_path), name) for sub_path, name in keys)
+        evicted = []
+        with self._usage_lock:
+            for prefix, quota in sorted(self.quotas.items()):
+                if any(_is_under(sub_path, prefix) for sub_path, _ in keys):
+                    excess = self.usage(prefix) - quota
+                    if excess > 0:
+                        evicted += self.evict(excess, sub_path=prefix, exclude=keys)
+
+            if self.max_size is not None:
+                excess = self.usage() - self.max_size
+                if excess > 0:
+                    evicted += self.evict(excess, exclude=keys)
+
+        return evicted
+
+    def _make_space(self, nbytes):
+        """ Evict files until there is room on disk for ``nbytes`` more. """
+        with self._usage_lock:
+            # another thread may have made room while this one waited
+            free = shutil.disk_usage(self.root).free
+            if nbytes > free:
+                self.evict(nbytes - free)
+
+    def find_source(self, source):
+        """
+        Find all cached data files that were added from the given source.
+
+        Parameters
+        ----------
+        source : str
+            The URL or local path the data files were added from.
+
+        Returns
+        -------
+        matches : list
+            A list of ``(sub_path, name)`` tuples.
+        """
+        return self._catalog.find_source(source)
+
+    def check_state(self, full=False, max_workers=None, orphans=True):
+        """
+        Compare the schema against the files on disk.
+
+        By default, each file's size and modification time are compared with
+        the values recorded when it was added, and only files whose stat data
+        changed are hashed again (in a pool of threads) to tell whether their
+        contents changed. Files that turn out to be unchanged have their stored
+        stat data refreshed, so they are not hashed again on the next check.
+        Files added without a checksum count as modified if their size or
+        modification time changed.
+
+        Parameters
+        ----------
+        full : bool (optional)
+            Hash every file that has a checksum recorded, whether or not its
+            stat data changed (default is ``False``).
+        max_workers : int (optional)
+            The number of files to hash at the same time. Default is the
+            ``max_workers`` setting in the ~/.astrodataconfig file, or 4.
+        orphans : bool (optional)
+            Also walk the cache directory for files that are not in the schema
+            (default is ``True``).
+
+        Returns
+        -------
+        state : `~astrodata.cache.CacheState`
+            The missing, modified, and orphaned files. It evaluates to `True`
+            if there are none. A warning is emitted if there are any.
+
+        """
+        if max_workers is None:
+            max_workers = int(self.config.get('max_workers', 4))
+
+        missing = []
+        modified = []
+        known = set()
+        to_hash = []
+        for sub_path, name, entry in self._catalog.entries():
+            local_path = os.path.normpath(os.path.join(self.root, sub_path, name))
+            known.add(local_path)
+
+            try:
+                stat = os.stat(local_path)
+            except OSError:
+                missing.append((sub_path, name))
+                continue
+
+            algorithm = _checksum_key(entry)
+            unchanged = (stat.st_size == entry.get('size', stat.st_size) and
+                         stat.st_mtime == entry.get('mtime', stat.st_mtime))
+
+            if algorithm is not None and (full or not unchanged):
+                to_hash.append((sub_path, name, entry, local_path, algorithm, stat))
+            elif not unchanged:
+                modified.append((sub_path, name))
+
+        # the slow path: hash only the files that might have changed
+        refreshed = []
+        if to_hash:
+            from .download import _map_threaded
+            digests = _map_threaded(hash_file, [(item[3], item[4]) for item in to_hash],
+                                    max_workers=max_workers)
+
+            for (sub_path, name, entry, local_path, algorithm, stat), (digest, error) \
+                    in zip(to_hash, digests):
+                if error is not None:
+                    missing.append((sub_path, name))
+
+                elif digest != entry[algorithm]:
+                    modified.append((sub_path, name))
+
+                elif (entry.get('size') != stat.st_size or
+                      entry.get('mtime') != stat.st_mtime):
+                    entry = dict(entry, size=stat.st_size, mtime=stat.st_mtime)
+                    refreshed.append((sub_path, name, entry))
+
+        if refreshed:
+            self._set_entries(refreshed)
+
+        orphaned = []
+        if orphans:
+            orphaned = [os.path.relpath(path, self.root)
+                        for path in _walk_files(self.root)
+                        if path not in known]
+
+        state = CacheState(sorted(missing), sorted(modified), sorted(orphaned))
+        if not state:
+            warnings.warn("The cache at {0} does not match its schema: {1} missing, "
+                          "{2} modified, and {3} orphaned files."
+                          .format(self.root, len(state.missing), len(state.modified),
+                                  len(state.orphaned)))
+
+        return state
 
     @classmethod
-    def build_from_schema(self, schema_file):
-        pass
+    def build_from_schema(cls, schema_file, config_file=None, max_workers=None,
+                          batch_size=256, **kwargs):
+        """
+        Build (or finish building) a cache from a copy of another cache's schema.
+
+        The schema is compared against the files on disk, and only the files
+        that are missing (or whose size does not match) are downloaded or
+        copied from their ``source``, in parallel and smallest first so that
+        most of the cache becomes usable quickly. The schema is committed
+        after each batch of files, so an interrupted build picks up where it
+        stopped when run again. Recorded checksums are verified.
+
+        Parameters
+        ----------
+        schema_file : str
+            Path to a ``schema.json`` file (or ``schema.db`` SQLite catalog).
+        config_file : str (optional)
+            The config file of the cache to build. Default is ~/.astrodataconfig.
+        max_workers : int (optional)
+            The number of files to fetch at the same time. Default is the
+            ``max_workers`` setting in the config file, or 4.
+        batch_size : int (optional)
+            The number of files to fetch between commits of the schema
+            (default is 256).
+        **kwargs
+            All other keyword arguments are passed to
+            `~astrodata.cache.Cache.add_data`.
+
+        Returns
+        -------
+        results : list
+            One `~astrodata.cache.IngestResult` per file that had to be fetched,
+            in the order they were fetched.
+
+        """
+        entries = read_entries(os.path.abspath(os.path.expanduser(schema_file)))
+
+        with cls(config_file) as cache:
+            return cache._build(entries, max_workers=max_workers,
+                                batch_size=batch_size, **kwargs)
+
+    def _build(self, entries, max_workers=None, batch_size=256, **kwargs):
+        """ Plan and execute `~astrodata.cache.Cache.build_from_schema`. """
+        if max_workers is None:
+            max_workers = int(self.config.get('max_workers', 4))
+        batch_size = max(1, int(batch_size))
+
+        # plan: register files already on disk, and fetch the rest
+        present = []
+        plan = []
+        for sub_path, name, entry in entries:
+            try:
+                stat = os.stat(os.path.join(self.root, sub_path, name))
+            except OSError:
+                plan.append((sub_path, name, entry))
+                continue
+
+            if stat.st_size != entry.get('size', stat.st_size):
+                plan.append((sub_path, name, entry))
+            elif self._catalog.get(sub_path, name) is None:
+                present.append((sub_path, name, dict(entry, size=stat.st_size,
+                                                     mtime=stat.st_mtime)))
+
+        if present:
+            self._store(present)
+            self._catalog.commit()
+
+        # small files first, files of unknown size last
+        plan.sort(key=lambda item: (item[2].get('size') is None,
+                                    item[2].get('size', 0)))
+
+        for sub_path in set(item[0] for item in plan):
+            full_cache_path = os.path.join(self.root, sub_path)
+            if not os.path.exists(full_cache_path):
+                os.makedirs(full_cache_path)
+
+        kwargs.setdefault('overwrite', True)
+        if max_workers > 1:
+            kwargs.setdefault('show_progress', False)
+
+        def _fetch(sub_path, name, entry):
+            algorithm = _checksum_key(entry)
+            expected_checksum = entry[algorithm] if algorithm is not None else None
+            local_path, new_entry = self._ingest(os.path.join(self.root, sub_path),
+                                                 entry['source'], local_name=name,
+                                                 mirrors=entry.get('mirrors'),
+                                                 hash_algorithm=algorithm,
+                                                 expected_checksum=expected_checksum,
+                                                 **kwargs)
+            return local_path, dict(entry, **new_entry)
+
+        # execute: fetch each batch in parallel, then checkpoint the schema
+        results = []
+        for i in range(0, len(plan), batch_size):
+            batch = plan[i:i+batch_size]
+            outcomes = self.scheduler.map(_fetch, batch, url_of=lambda item: item[2]['source'],
+                                          max_workers=max_workers)
+
+            records = []
+            for (sub_path, name, entry), (outcome, error) in zip(batch, outcomes):
+                if error is not None:
+                    results.append(IngestResult(sub_path, entry['source'], None, error))
+                    continue
+
+                local_path, new_entry = outcome
+                records.append((sub_path, name, new_entry))
+                results.append(IngestResult(sub_path, entry['source'], local_path, None))
+
+            self._store(records)
+            self._catalog.commit()
+
+        return results
 
 cache = Cache()
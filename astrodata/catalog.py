@@ -0,0 +1,651 @@
+""" Storage backends for the cache schema """
+
+from __future__ import division, print_function
+
+# Standard library
+try:
+    from collections.abc import Mapping
+except ImportError:
+    from collections import Mapping
+from collections import defaultdict
+import json
+import os
+import sqlite3
+import tempfile
+
+# Third party
+from astropy.extern.six.moves import urllib
+
+# Package
+from .lock import FileLock
+
+__all__ = ['JSONCatalog', 'JournaledCatalog', 'SQLiteCatalog',
+           'migrate_json_to_sqlite', 'read_entries']
+
+def _split_sub_path(sub_path):
+    """ Split a sub path into a list of path level names. """
+    return os.path.normpath(sub_path).split(os.sep)
+
+def _normalize_sub_path(sub_path):
+    """ The canonical, separator-independent key for a sub path. """
+    return '/'.join(_split_sub_path(sub_path))
+
+def _is_entry(node):
+    """
+    Data file entries are distinguished from path levels in the nested schema
+    because their ``source`` is a string rather than another level.
+    """
+    return (isinstance(node, dict) and 'source' in node and
+            not isinstance(node['source'], dict))
+
+def _iter_nested(node, pieces=()):
+    for name in sorted(node.keys()):
+        child = node[name]
+        if _is_entry(child):
+            yield '/'.join(pieces), name, child
+        elif isinstance(child, dict):
+            for item in _iter_nested(child, pieces + (name,)):
+                yield item
+
+def _set_nested(schema, sub_path, name, entry):
+    sub_schema = schema
+    for piece in _split_sub_path(sub_path):
+        sub_schema[piece] = sub_schema.get(piece, dict())
+        sub_schema = sub_schema[piece]
+
+    sub_schema[name] = entry
+
+def _delete_nested(schema, sub_path, name):
+    """ Remove an entry, and any path levels left empty. """
+    pieces = _split_sub_path(sub_path)
+    levels = [schema]
+    for piece in pieces:
+        node = levels[-1].get(piece)
+        if not isinstance(node, dict) or _is_entry(node):
+            return
+        levels.append(node)
+
+    if not _is_entry(levels[-1].get(name)):
+        return
+    del levels[-1][name]
+
+    for i in range(len(pieces), 0, -1):
+        if levels[i]:
+            break
+        del levels[i - 1][pieces[i - 1]]
+
+def _read_json(path):
+    with open(path, 'r') as f:
+        return json.loads(f.read())
+
+def _write_json(path, schema):
+    """ Replace a JSON schema file atomically, so readers never see a partial file. """
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)),
+                                    prefix='.schema', suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'w') as f:
+            f.write(json.dumps(schema, indent=4, sort_keys=True))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+def _replay_log(schema, log_path):
+    """
+    Apply the records of a schema log to ``schema``, stopping at a partially
+    written final record, and return the number of bytes of valid records.
+    """
+    valid_size = 0
+    n_records = 0
+    with open(log_path, 'rb') as f:
+        for line in f:
+            try:
+                if not line.endswith(b'\n'):
+                    raise ValueError()
+                record = json.loads(line.decode('utf-8'))
+            except ValueError:
+                # a partially-written final record from a crash
+                break
+
+            if record['op'] == 'set':
+                _set_nested(schema, record['sub_path'], record['name'], record['entry'])
+            elif record['op'] == 'delete':
+                _delete_nested(schema, record['sub_path'], record['name'])
+            else:
+                raise ValueError("Unknown schema log operation '{}'".format(record['op']))
+            valid_size += len(line)
+            n_records += 1
+
+    return valid_size, n_records
+
+class JSONCatalog(object):
+    """
+    The original schema storage: a single nested JSON document that is read
+    in full when opened and written by `commit`.
+
+    Several processes can share the file. Each keeps track of the entries it
+    changed, and `commit` merges just those into the file as it is on disk,
+    under a short lock (``<path>.lock``), before atomically replacing it. A
+    catalog with no changes never writes the file.
+
+    Parameters
+    ----------
+    path : str
+        Path to the JSON schema file. Created (empty) if it does not exist.
+    lock_timeout : float (optional)
+        Raise `~astrodata.lock.LockTimeout` if the file stays locked by other
+        processes for this many seconds (default is to wait).
+    """
+    def __init__(self, path, lock_timeout=None):
+        self.path = path
+        self.lock_timeout = lock_timeout
+
+        # entries set (or deleted, as None) since the file was last read
+        self._changes = dict()
+
+        # create empty JSON file if nothing exists
+        if not os.path.exists(self.path):
+            with self._lock():
+                if not os.path.exists(self.path):
+                    _write_json(self.path, {})
+
+        self.schema = self._read()
+
+    def _read(self):
+        """ Read the schema as it is on disk. """
+        return _read_json(self.path)
+
+    def _lock(self):
+        return FileLock(self.path + '.lock', timeout=self.lock_timeout)
+
+    @property
+    def dirty(self):
+        """ Whether there are changes that have not been committed. """
+        return bool(self._changes)
+
+    def get(self, sub_path, name):
+        """
+        Return the entry for file ``name`` under ``sub_path``, or `None`.
+        """
+        node = self.schema
+        for piece in _split_sub_path(sub_path):
+            node = node.get(piece)
+            if not isinstance(node, dict):
+                return None
+
+        entry = node.get(name)
+        if not _is_entry(entry):
+            return None
+        return entry
+
+    def set(self, sub_path, name, entry):
+        """
+        Add or replace the entry for file ``name`` under ``sub_path``.
+        """
+        _set_nested(self.schema, sub_path, name, entry)
+        self._changes[(_normalize_sub_path(sub_path), name)] = entry
+
+    def set_many(self, records):
+        """
+        Add or replace many entries, given as ``(sub_path, name, entry)``.
+        """
+        # walk down to each path level only once
+        by_sub_path = defaultdict(list)
+        for sub_path, name, entry in records:
+            by_sub_path[_normalize_sub_path(sub_path)].append((name, entry))
+
+        for sub_path, named_entries in by_sub_path.items():
+            sub_schema = self.schema
+            for piece in sub_path.split('/'):
+                sub_schema[piece] = sub_schema.get(piece, dict())
+                sub_schema = sub_schema[piece]
+
+            for name, entry in named_entries:
+                sub_schema[name] = entry
+                self._changes[(sub_path, name)] = entry
+
+    def delete_many(self, keys):
+        """
+        Remove the entries for many files, given as ``(sub_path, name)``.
+        Missing entries are ignored.
+        """
+        for sub_path, name in keys:
+            _delete_nested(self.schema, sub_path, name)
+            self._changes[(_normalize_sub_path(sub_path), name)] = None
+
+    def entries(self):
+        """
+        Iterate over all entries as ``(sub_path, name, entry)`` tuples.
+        """
+        return _iter_nested(self.schema)
+
+    def find_source(self, source):
+        """
+        Return a list of ``(sub_path, name)`` for all entries with the given
+        ``source``. This is a linear scan for the JSON backend.
+        """
+        return [(sub_path, name) for sub_path, name, entry in self.entries()
+                if entry['source'] == source]
+
+    def commit(self):
+        """
+        Merge the changes since the last commit into the file, keeping any
+        entries that other processes wrote in the meantime.
+        """
+        if not self._changes:
+            return
+
+        with self._lock():
+            schema = _read_json(self.path) if os.path.exists(self.path) else dict()
+            for (sub_path, name), entry in self._changes.items():
+                if entry is None:
+                    _delete_nested(schema, sub_path, name)
+                else:
+                    _set_nested(schema, sub_path, name, entry)
+            _write_json(self.path, schema)
+
+        self.schema = schema
+        self._changes = dict()
+
+    def compact(self):
+        self.commit()
+
+    def close(self):
+        self.commit()
+
+class JournaledCatalog(JSONCatalog):
+    """
+    A nested JSON schema snapshot plus an append-only log of changes.
+
+    Every `set` appends one line to ``<path>.log`` instead of rewriting the
+    snapshot. Opening the catalog replays the log on top of the snapshot, and
+    `compact` folds the log into a new snapshot that atomically replaces the
+    old one. A crash loses at most the record being written.
+
+    Several processes can share the log: records are appended under the
+    ``<path>.lock`` lock, and `compact` re-reads the snapshot and the whole
+    log (with every process's records) before replacing them.
+
+    Parameters
+    ----------
+    path : str
+        Path to the JSON schema snapshot. Created (empty) if it does not exist.
+    compact_threshold : int (optional)
+        Compact automatically on `close` once the log holds more than this
+        many records (default is 10000). Set to 0 to only compact explicitly.
+    """
+    def __init__(self, path, compact_threshold=10000, lock_timeout=None):
+        self.log_path = path + '.log'
+        self.compact_threshold = int(compact_threshold)
+        self._n_records = 0
+        super(JournaledCatalog, self).__init__(path, lock_timeout=lock_timeout)
+
+        self._log = open(self.log_path, 'a')
+
+    def _read(self):
+        # the snapshot and the log are read under one lock, so that another
+        # process cannot compact the log into a newer snapshot in between
+        with self._lock():
+            schema = _read_json(self.path)
+            if os.path.exists(self.log_path):
+                valid_size, self._n_records = _replay_log(schema, self.log_path)
+
+                # drop the partial record so new records start on a fresh line
+                if valid_size < os.path.getsize(self.log_path):
+                    with open(self.log_path, 'r+b') as f:
+                        f.truncate(valid_size)
+        return schema
+
+    def _append(self, records):
+        lines = [json.dumps(record, sort_keys=True) + '\n' for record in records]
+        if not lines:
+            return
+
+        # one write per batch, under the lock, so that records from
+        # different processes never interleave
+        with self._lock():
+            self._log.write(''.join(lines))
+            self._log.flush()
+        self._n_records += len(lines)
+
+    def set(self, sub_path, name, entry):
+        """
+        Add or replace the entry for file ``name`` under ``sub_path``.
+        """
+        self.set_many([(sub_path, name, entry)])
+
+    def set_many(self, records):
+        """
+        Add or replace many entries, given as ``(sub_path, name, entry)``.
+        """
+        records = list(records)
+        self._append(dict(op='set', sub_path=sub_path, name=name, entry=entry)
+                     for sub_path, name, entry in records)
+        super(JournaledCatalog, self).set_many(records)
+
+    def delete_many(self, keys):
+        """
+        Remove the entries for many files, given as ``(sub_path, name)``.
+        """
+        keys = list(keys)
+        self._append(dict(op='delete', sub_path=sub_path, name=name)
+                     for sub_path, name in keys)
+        super(JournaledCatalog, self).delete_many(keys)
+
+    def commit(self):
+        # every change is already in the log
+        self._changes = dict()
+        self._log.flush()
+        os.fsync(self._log.fileno())
+
+    def compact(self):
+        """
+        Write the schema as it is on disk (the snapshot and the log, which
+        hold the changes of every process) to a new snapshot, atomically swap
+        it in for the old one, and truncate the log.
+        """
+        self.commit()
+
+        with self._lock():
+            schema = _read_json(self.path)
+            _replay_log(schema, self.log_path)
+            _write_json(self.path, schema)
+
+            # replaying records already in the snapshot is harmless, so a
+            # crash before this point loses nothing
+            self._log.close()
+            open(self.log_path, 'w').close()
+            self._log = open(self.log_path, 'a')
+
+        self.schema = schema
+        self._n_records = 0
+
+    def close(self):
+        if self.compact_threshold > 0 and self._n_records > self.compact_threshold:
+            self.compact()
+        else:
+            self.commit()
+        self._log.close()
+
+class _SQLiteSchemaLevel(Mapping):
+    """
+    A read-only, nested-dictionary view of one path level of a
+    `SQLiteCatalog`, so that ``cache.schema['a']['b'][name]`` keeps working
+    without loading the whole catalog into memory.
+    """
+    def __init__(self, catalog, prefix):
+        self._catalog = catalog
+        self._prefix = prefix
+
+    def _child_prefix(self, key):
+        if self._prefix:
+            return self._prefix + '/' + key
+        return key
+
+    def __getitem__(self, key):
+        if self._prefix:
+            entry = self._catalog.get(self._prefix, key)
+            if entry is not None:
+                return entry
+
+        prefix = self._child_prefix(key)
+        if self._catalog._has_sub_path(prefix):
+            return _SQLiteSchemaLevel(self._catalog, prefix)
+
+        raise KeyError(key)
+
+    def __iter__(self):
+        return iter(self._catalog._children(self._prefix))
+
+    def __len__(self):
+        return len(self._catalog._children(self._prefix))
+
+    def __repr__(self):
+        return '<{0} {1!r}>'.format(self.__class__.__name__, self._prefix)
+
+def _connect_read_only(path):
+    """
+    Open an SQLite database without writing to it, so nothing about it (e.g.,
+    its journal mode) changes and it can be on read-only media.
+    """
+    uri = 'file:{}?mode=ro'.format(urllib.parse.quote(os.path.abspath(path)))
+    with open(path, 'rb') as f:
+        header = f.read(20)
+    if header[18:19] == b'\x02' and not os.path.exists(path + '-wal'):
+        # even a read-only connection to a database in WAL mode creates its
+        # -wal and -shm files, but without them nothing is writing to it
+        return sqlite3.connect(uri + '&immutable=1', uri=True, check_same_thread=False)
+
+    try:
+        conn = sqlite3.connect(uri, uri=True, timeout=60., check_same_thread=False)
+        conn.execute('SELECT 1 FROM sqlite_master LIMIT 1')
+    except sqlite3.OperationalError:
+        # a database in WAL mode needs a writable -shm file even to be read,
+        # so on read-only media read it as a file that nobody is changing
+        conn = sqlite3.connect(uri + '&immutable=1', uri=True, check_same_thread=False)
+    return conn
+
+class SQLiteCatalog(object):
+    """
+    An indexed schema stored in an SQLite database (in WAL mode).
+
+    Entries are keyed by ``(sub_path, name)`` and indexed by ``source``, so
+    lookups are O(log n) and each `set` writes a single row instead of
+    rewriting the whole schema.
+
+    Parameters
+    ----------
+    path : str
+        Path to the SQLite database file. Created if it does not exist.
+    """
+    def __init__(self, path):
+        self.path = path
+
+        # other processes writing to the catalog hold its lock only briefly
+        self._conn = sqlite3.connect(self.path, timeout=60., check_same_thread=False)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('PRAGMA synchronous=NORMAL')
+        with self._conn:
+            self._conn.execute('CREATE TABLE IF NOT EXISTS entries ('
+                               'sub_path TEXT NOT NULL, '
+                               'name TEXT NOT NULL, '
+                               'source TEXT, '
+                               'metadata TEXT NOT NULL, '
+                               'PRIMARY KEY (sub_path, name))')
+            self._conn.execute('CREATE INDEX IF NOT EXISTS entries_source '
+                               'ON entries (source)')
+
+        self.schema = _SQLiteSchemaLevel(self, '')
+
+    def get(self, sub_path, name):
+        """
+        Return the entry for file ``name`` under ``sub_path``, or `None`.
+        """
+        row = self._conn.execute('SELECT metadata FROM entries '
+                                 'WHERE sub_path = ? AND name = ?',
+                                 (_normalize_sub_path(sub_path), name)).fetchone()
+        if row is None:
+            return None
+        return json.loads(row[0])
+
+    def _rows(self, records):
+        for sub_path, name, entry in records:
+            yield (_normalize_sub_path(sub_path), name,
+                   entry.get('source'), json.dumps(entry, sort_keys=True))
+
+    def set(self, sub_path, name, entry):
+        """
+        Add or replace the entry for file ``name`` under ``sub_path``.
+        """
+        self.set_many([(sub_path, name, entry)])
+
+    def set_many(self, records):
+        """
+        Add or replace many entries, given as ``(sub_path, name, entry)``, in
+        a single transaction.
+        """
+        with self._conn:
+            self._conn.executemany('INSERT OR REPLACE INTO entries '
+                                   '(sub_path, name, source, metadata) '
+                                   'VALUES (?, ?, ?, ?)', self._rows(records))
+
+    def delete_many(self, keys):
+        """
+        Remove the entries for many files, given as ``(sub_path, name)``, in a
+        single transaction.
+        """
+        with self._conn:
+            self._conn.executemany('DELETE FROM entries WHERE sub_path = ? AND name = ?',
+                                   ((_normalize_sub_path(sub_path), name)
+                                    for sub_path, name in keys))
+
+    def entries(self):
+        """
+        Iterate over all entries as ``(sub_path, name, entry)`` tuples.
+        """
+        cursor = self._conn.execute('SELECT sub_path, name, metadata FROM entries '
+                                    'ORDER BY sub_path, name')
+        for sub_path, name, metadata in cursor:
+            yield sub_path, name, json.loads(metadata)
+
+    def find_source(self, source):
+        """
+        Return a list of ``(sub_path, name)`` for all entries with the given
+        ``source``.
+        """
+        cursor = self._conn.execute('SELECT sub_path, name FROM entries '
+                                    'WHERE source = ? ORDER BY sub_path, name',
+                                    (source,))
+        return [tuple(row) for row in cursor]
+
+    def _has_sub_path(self, prefix):
+        # '0' is the character after '/', so this range is every sub_path
+        # nested below ``prefix``
+        row = self._conn.execute('SELECT 1 FROM entries WHERE sub_path = ? OR '
+                                 '(sub_path > ? AND sub_path < ?) LIMIT 1',
+                                 (prefix, prefix + '/', prefix + '0')).fetchone()
+        return row is not None
+
+    def _children(self, prefix):
+        if not prefix:
+            cursor = self._conn.execute('SELECT DISTINCT sub_path FROM entries')
+            return sorted(set(row[0].split('/')[0] for row in cursor))
+
+        names = set(row[0] for row in
+                    self._conn.execute('SELECT name FROM entries WHERE sub_path = ?',
+                                       (prefix,)))
+        cursor = self._conn.execute('SELECT DISTINCT sub_path FROM entries '
+                                    'WHERE sub_path > ? AND sub_path < ?',
+                                    (prefix + '/', prefix + '0'))
+        for row in cursor:
+            names.add(row[0][len(prefix)+1:].split('/')[0])
+
+        return sorted(names)
+
+    def commit(self):
+        self._conn.commit()
+
+    def compact(self):
+        """
+        Fold the write-ahead log back into the main database file.
+        """
+        self.commit()
+        self._conn.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+
+    def close(self):
+        self.commit()
+        self._conn.close()
+
+def migrate_json_to_sqlite(json_path, sqlite_path):
+    """
+    Copy all entries from a nested JSON schema file into an SQLite catalog.
+
+    The entries are written to a temporary database next to ``sqlite_path``,
+    which only replaces it once complete, so an interrupted migration leaves
+    no half-populated catalog behind.
+
+    Parameters
+    ----------
+    json_path : str
+        Path to the existing ``schema.json``.
+    sqlite_path : str
+        Path to the SQLite database to create or add to. An existing database
+        must not be open elsewhere while it is migrated into.
+
+    Returns
+    -------
+    n_entries : int
+        The number of entries migrated.
+    """
+    json_catalog = JSONCatalog(json_path)
+    records = list(json_catalog.entries())
+
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(sqlite_path)),
+                                    prefix='.{}.'.format(os.path.basename(sqlite_path)),
+                                    suffix='.tmp')
+    os.close(fd)
+    try:
+        if os.path.exists(sqlite_path):
+            # start from the existing entries, including any still in its log
+            source = sqlite3.connect(sqlite_path, timeout=60.)
+            target = sqlite3.connect(tmp_path)
+            try:
+                source.backup(target)
+            finally:
+                target.close()
+                source.close()
+
+        catalog = SQLiteCatalog(tmp_path)
+        try:
+            catalog.set_many(records)
+        finally:
+            catalog.close()
+
+        os.replace(tmp_path, sqlite_path)
+
+    except BaseException:
+        for path in (tmp_path, tmp_path + '-wal', tmp_path + '-shm'):
+            if os.path.exists(path):
+                os.remove(path)
+        raise
+
+    return len(records)
+
+def read_entries(path):
+    """
+    Read all entries from a schema file without modifying it.
+
+    Parameters
+    ----------
+    path : str
+        Path to a nested JSON schema file (e.g., ``schema.json``, including
+        any ``schema.json.log`` next to it) or an SQLite catalog (``.db``).
+
+    Returns
+    -------
+    entries : list
+        A list of ``(sub_path, name, entry)`` tuples.
+    """
+    if not os.path.exists(path):
+        raise IOError("Schema file does not exist: {}".format(path))
+
+    if path.endswith('.db'):
+        conn = _connect_read_only(path)
+        try:
+            cursor = conn.execute('SELECT sub_path, name, metadata FROM entries '
+                                  'ORDER BY sub_path, name')
+            return [(sub_path, name, json.loads(metadata))
+                    for sub_path, name, metadata in cursor]
+        finally:
+            conn.close()
+
+    schema = _read_json(path)
+
+    # replay any changes that were not compacted into the snapshot yet
+    if os.path.exists(path + '.log'):
+        _replay_log(schema, path + '.log')
+
+    return list(_iter_nested(schema))
@@ -0,0 +1,106 @@
+""" Decompressing gzip, bzip2, and lzma/xz data as they stream in """
+
+from __future__ import division, print_function
+
+# Standard library
+import bz2
+import os
+import zlib
+try:
+    import lzma
+except ImportError:
+    lzma = None
+
+__all__ = ['StreamDecompressor', 'detect_compression', 'strip_compression_suffix']
+
+# leading bytes of each format -- raw .lzma streams have no magic number
+# that ordinary data cannot start with, so they are only read when asked for
+_magic = [(b'\x1f\x8b', 'gzip'),
+          (b'BZh', 'bz2'),
+          (b'\xfd7zXZ\x00', 'lzma')]
+
+# the number of leading bytes needed to recognize any format
+_magic_length = max(len(magic) for magic, _ in _magic)
+
+_suffixes = {'.gz': 'gzip', '.gzip': 'gzip', '.bz2': 'bz2', '.xz': 'lzma',
+             '.lzma': 'lzma'}
+
+def _new_decompressor(compression):
+    if compression == 'gzip':
+        return zlib.decompressobj(16 + zlib.MAX_WBITS)
+    elif compression == 'bz2':
+        return bz2.BZ2Decompressor()
+    elif compression == 'lzma':
+        if lzma is None:
+            raise ValueError("lzma decompression is not supported by this Python")
+        return lzma.LZMADecompressor()
+    raise ValueError("Unknown compression '{}' -- must be 'gzip', 'bz2', or 'lzma'."
+                     .format(compression))
+
+def detect_compression(data):
+    """
+    Return the compression format (``'gzip'``, ``'bz2'``, or ``'lzma'`` for
+    xz) of data starting with ``data``, or `None` if they are not compressed
+    (or are a raw ``.lzma`` stream, which cannot be told from other data).
+    """
+    data = bytes(data[:_magic_length])
+    for magic, compression in _magic:
+        if data.startswith(magic):
+            return compression
+    return None
+
+def strip_compression_suffix(filename):
+    """
+    Split a compression suffix from a filename, returning the filename
+    without it and the compression format, or the filename and `None`.
+    """
+    root, ext = os.path.splitext(filename)
+    compression = _suffixes.get(ext.lower())
+    if compression is None:
+        return filename, None
+    return root, compression
+
+class StreamDecompressor(object):
+    """
+    Decompress a stream fed in blocks of any size, including files of several
+    concatenated compressed members (as written by e.g. ``pigz`` or
+    ``pbzip2``).
+
+    Parameters
+    ----------
+    compression : str
+        ``'gzip'``, ``'bz2'``, or ``'lzma'`` (which also reads ``.xz`` files).
+    """
+
+    def __init__(self, compression):
+        self.compression = compression
+        self._decompressor = _new_decompressor(compression)
+
+    def decompress(self, data):
+        """ Return the decompressed bytes of the next block of the stream. """
+        out = []
+        while data:
+            if self._decompressor.eof:
+                # the start of the next member
+                self._decompressor = _new_decompressor(self.compression)
+
+            out.append(self._decompressor.decompress(data))
+            if not self._decompressor.eof:
+                break
+
+            data = self._decompressor.unused_data
+
+        return b''.join(out)
+
+    def flush(self):
+        """
+        Return any remaining decompressed bytes, and raise an `IOError` if
+        the stream ended part-way through a member.
+        """
+        out = b''
+        if hasattr(self._decompressor, 'flush'):
+            out = self._decompressor.flush()
+
+        if not self._decompressor.eof:
+            raise IOError("The {0} stream ended unexpectedly".format(self.compression))
+        return out
@@ -3,27 +3,98 @@
 from __future__ import division, print_function
 
 # Standard library
+from collections import namedtuple
 import os
 import sys
+import concurrent.futures
 import contextlib
+import email.utils
+import hashlib
 import io
+import json
 import shutil
 import socket
 import tempfile
+import threading
+import time
 
 # Third party
 import astropy.units as u
 from astropy.utils.data import check_free_space_in_dir
 from astropy.utils.console import ProgressBarOrSpinner
-from astropy.extern.six.moves import urllib
+from astropy.extern.six.moves import http_client, urllib
 
-def download_file(remote_url, cache_path, filename=None, timeout=10.*u.second,
-                  show_progress=True, block_size=2**16, overwrite=False):
+# Package
+from .compression import (StreamDecompressor, _magic_length, detect_compression,
+                          strip_compression_suffix)
+from .lock import FileLock, SingleFlight
+from .pool import default_pool
+from .store import _check_checksum, _parse_checksum, _update_hash, hash_file
+from .telemetry import emit
+
+__all__ = ['download_file', 'download_files', 'fetch_file', 'DownloadResult']
+
+DownloadResult = namedtuple('DownloadResult', ['local_path', 'size', 'hash_algorithm',
+                                               'checksum', 'etag', 'last_modified',
+                                               'content_length', 'not_modified',
+                                               'compression', 'source_size',
+                                               'source_checksum', 'cached'])
+DownloadResult.__new__.__defaults__ = (None, None, None, False, None, None, None, False)
+DownloadResult.__doc__ = """
+The outcome of `~astrodata.download.fetch_file`. ``size`` is the number of bytes
+in the file, and ``checksum`` is its hex digest computed with ``hash_algorithm``
+(both `None` if no hash was requested). ``etag``, ``last_modified``, and
+``content_length`` are the validators and length reported by the server, or
+`None` if nothing was requested or the server did not send them.
+``not_modified`` is `True` if a ``refresh`` found the local file up to date,
+and ``cached`` is `True` if the existing local file was used without asking
+the server at all -- in both cases nothing was transferred.
+If the file was decompressed as it was downloaded, ``compression`` is the
+format, and ``source_size`` and ``source_checksum`` describe the compressed
+data as served, while ``size`` and ``checksum`` describe the stored file.
+"""
+
+def download_file(remote_url, cache_path, filename=None, **kwargs):
     """
     This is a modified version of `~astropy.utils.data.download_file` that
     allows the user to specify the cache path.
 
     Accepts a URL, downloads and caches the result returning the local filename.
+    All keyword arguments are described in `~astrodata.download.fetch_file`.
+
+    Parameters
+    ----------
+    remote_url : str
+        The URL of the file to download
+    cache_path : str
+        The path to save the file.
+    filename : str (optional)
+        The filename to save this file as, locally. Default is to grab the
+        basename of the remote URL.
+
+    Returns
+    -------
+    local_path : str
+        Returns the local path that the file was download to.
+
+    """
+    return fetch_file(remote_url, cache_path, filename=filename, **kwargs).local_path
+
+def fetch_file(remote_url, cache_path, filename=None, timeout=10.*u.second,
+               show_progress=True, block_size=2**16, overwrite=False,
+               progress_callback=None, resume=False, retries=0,
+               retry_backoff=1.*u.second, segments=1, min_segment_size=2**26,
+               hash_algorithm=None, expected_checksum=None, refresh=False,
+               etag=None, last_modified=None, pool=None, event_callback=None,
+               decompress=False, make_space=None, lock=True, lock_timeout=None,
+               throttle=None, local_checksum=None):
+    """
+    Download a file like `~astrodata.download.download_file`, but return
+    information about the downloaded file along with its local path.
+
+    Only one download of a local file runs at a time: other threads of this
+    process asking for the same file wait for it and share its result, and
+    other processes wait on an advisory lock file next to it (see ``lock``).
 
     Parameters
     ----------
@@ -39,80 +110,827 @@ def download_file(remote_url, cache_path, filename=None, timeout=10.*u.second,
     show_progress : bool (optional)
         Display a progress bar during the download (default is ``True``).
     block_size : int (optional)
-        The download block size (default is 64K, 2**16).
+        The initial download block size (default is 64K, 2**16). Blocks grow
+        up to 4M while data arrive quickly.
     overwrite : bool (optional)
         Overwrite file if it exists (default is ``False``).
+    progress_callback : callable (optional)
+        A function called as ``progress_callback(remote_url, bytes_read, size)``
+        as blocks are written, at most every 0.1 seconds, and once the
+        download is complete. ``size`` is `None` if the server did not report
+        the length of the file.
+    resume : bool (optional)
+        Keep the data from a failed download in ``<filename>.part`` (with a
+        ``<filename>.part.json`` sidecar holding the URL, validators, and the
+        number of bytes written) and continue from there with an HTTP Range
+        request on the next attempt. The full file is fetched again if the
+        server does not support ranges or the file has changed (default is
+        ``False``).
+    retries : int (optional)
+        The number of times to retry after network errors or server (5xx)
+        errors (default is 0).
+    retry_backoff : `~astropy.units.Quantity` (optional)
+        The delay before the first retry, doubled for each later retry
+        (default is 1 second).
+    segments : int (optional)
+        Download the file over up to this many connections at once, each
+        fetching a separate byte range, if the server supports ranges (default
+        is 1). Partial data is not kept for resuming in this mode.
+    min_segment_size : int (optional)
+        The smallest byte range to give each connection when ``segments`` is
+        more than 1 -- smaller files use fewer connections (default is 64M,
+        2**26).
+    hash_algorithm : str (optional)
+        Compute a digest of the file with this `hashlib` algorithm as it is
+        written, e.g. ``'sha256'`` (default is no digest, unless
+        ``expected_checksum`` is given).
+    expected_checksum : str (optional)
+        The expected hex digest of the file, optionally prefixed by the
+        algorithm name, e.g. ``'md5:0cc175b9c0f1b6a831c399e269772661'``. The
+        algorithm defaults to ``hash_algorithm`` or SHA-256. If the downloaded
+        data do not match, an `IOError` is raised before the file is moved into
+        place, and an existing local file that does not match is downloaded
+        again.
+    refresh : bool (optional)
+        If the file exists, ask the server whether it has changed with a
+        conditional request (``If-None-Match`` and ``If-Modified-Since``) and
+        only download it again if so (default is ``False``). Without ``etag``
+        or ``last_modified``, the modification time of the local file is used.
+    etag : str (optional)
+        The ``ETag`` of the existing file, as previously reported by the
+        server, for ``refresh``.
+    last_modified : str (optional)
+        The ``Last-Modified`` date of the existing file, as previously reported
+        by the server, for ``refresh``.
+    pool : `~astrodata.pool.ConnectionPool` (optional)
+        The pool of persistent connections to make HTTP(S) requests with
+        (default is the shared `~astrodata.pool.default_pool`).
+    event_callback : callable (optional)
+        A function called with each `~astrodata.telemetry.Event` of the
+        download (start, time to first byte, retries, and completion or
+        failure), in addition to any listeners added with
+        `~astrodata.telemetry.add_listener`.
+    decompress : bool or str (optional)
+        Decompress gzip, bzip2, or lzma/xz data as they are downloaded, so only
+        the uncompressed file is written. With ``True`` the format (gzip,
+        bzip2, or xz) is detected from the data, and otherwise it is given as
+        ``'gzip'``, ``'bz2'``, or ``'lzma'`` (which also reads raw ``.lzma``
+        streams). A compression suffix (e.g., ``.gz``) is removed from the
+        default filename if the data are decompressed. ``expected_checksum``
+        then applies to the compressed
+        data, an existing file is not checked against it, and ``resume`` and
+        ``segments`` are ignored (default is ``False``).
+    make_space : callable (optional)
+        A function called as ``make_space(size)`` if there is not enough free
+        disk space for the download, which may free some (e.g., by evicting
+        other cached files) before the free space is checked again.
+    lock : bool (optional)
+        Hold the lock file ``.<filename>.lock`` in ``cache_path`` while the
+        file is fetched. A process that finds it held waits, then uses the
+        file that was downloaded rather than fetching it again, even with
+        ``overwrite`` or ``refresh``. Locks left by processes that died are
+        broken (default is ``True``).
+    lock_timeout : float (optional)
+        Raise `~astrodata.lock.LockTimeout` after waiting this many seconds
+        for the lock (default is to wait as long as it is held).
+    throttle : callable (optional)
+        A function called as ``throttle(n_bytes)`` after each block is read,
+        which may sleep to limit the bandwidth used (e.g.,
+        `~astrodata.scheduler.Scheduler.throttle`).
+    local_checksum : str (optional)
+        The hex digest of the existing local file with ``hash_algorithm``, as
+        recorded when it was stored (e.g., in a cache schema). It is reported
+        for the file when it is not downloaded again (because it exists, or a
+        ``refresh`` finds it unchanged) and there is no ``expected_checksum``
+        to check it against, instead of reading the whole file to hash it.
 
     Returns
     -------
-    local_path : str
-        Returns the local path that the file was download to.
+    result : `~astrodata.download.DownloadResult`
+        The local path, size, and (if requested) checksum of the file.
 
     """
 
+    arguments = dict(locals())
     timeout_s = timeout.to(u.second).value
-    if not os.path.exists(cache_path):
-        os.makedirs(cache_path)
+    retry_backoff_s = retry_backoff.to(u.second).value
+    if pool is None:
+        pool = default_pool
+    _makedirs(cache_path)
 
+    # where the file goes if it turns out not to be compressed after all
+    undetected_path = None
     if filename is None:
         filename = os.path.basename(remote_url)
+        if decompress:
+            filename, suffix_compression = strip_compression_suffix(filename)
+            if decompress is True and suffix_compression is not None:
+                undetected_path = os.path.join(cache_path, os.path.basename(remote_url))
+
+    if decompress:
+        # the state of a decompressor cannot be saved or split
+        resume = False
+        segments = 1
 
     local_path = os.path.join(cache_path, filename)
+    if lock:
+        return _fetch_single_flight(local_path, lock_timeout, arguments)
+
+    if (undetected_path is not None and not overwrite and
+            not os.path.exists(local_path) and os.path.exists(undetected_path)):
+        # an earlier download found nothing to decompress
+        local_path = undetected_path
+
+    algorithm, expected_checksum = _parse_checksum(hash_algorithm, expected_checksum)
 
+    conditional = None
     if os.path.exists(local_path) and not overwrite:
-        return local_path
+        if refresh:
+            conditional = _conditional_headers(local_path, etag, last_modified)
+
+        elif algorithm is None:
+            return DownloadResult(local_path, os.path.getsize(local_path), None, None,
+                                  cached=True)
+
+        elif decompress or expected_checksum is None:
+            # nothing to check the file against (with decompression, the
+            # expected checksum is of the compressed data, which are gone)
+            checksum = local_checksum
+            if checksum is None:
+                checksum = hash_file(local_path, algorithm)
+            return DownloadResult(local_path, os.path.getsize(local_path),
+                                  algorithm, checksum, cached=True)
 
+        else:
+            checksum = hash_file(local_path, algorithm)
+            if checksum == expected_checksum:
+                return DownloadResult(local_path, os.path.getsize(local_path),
+                                      algorithm, checksum, cached=True)
+
+    def _emit(name, **data):
+        emit(event_callback, name, remote_url, **data)
+
+    def _attempt():
+        result = None
+        if segments > 1 and conditional is None:
+            result = _segmented_attempt(remote_url, cache_path, local_path,
+                                        timeout_s, show_progress=show_progress,
+                                        block_size=block_size,
+                                        progress_callback=progress_callback,
+                                        segments=segments,
+                                        min_segment_size=min_segment_size,
+                                        algorithm=algorithm,
+                                        expected_checksum=expected_checksum,
+                                        pool=pool, emit=_emit, make_space=make_space,
+                                        throttle=throttle)
+
+        if result is None:
+            result = _download_attempt(remote_url, cache_path, local_path, timeout_s,
+                                       show_progress=show_progress,
+                                       block_size=block_size,
+                                       progress_callback=progress_callback,
+                                       resume=resume, algorithm=algorithm,
+                                       expected_checksum=expected_checksum,
+                                       conditional=conditional, pool=pool,
+                                       emit=_emit, decompress=decompress,
+                                       make_space=make_space, throttle=throttle,
+                                       undetected_path=undetected_path)
+        return result
+
+    start = time.time()
+    _emit('start')
     try:
-        with contextlib.closing(urllib.request.urlopen(remote_url, timeout=timeout_s)) as remote:
-            # get file info
-            info = remote.info()
-            if 'Content-Length' in info:
-                try:
-                    size = int(info['Content-Length'])
-                except ValueError:
-                    size = None
-            else:
-                size = None
+        result = _retry(_attempt, remote_url, retries, retry_backoff_s, emit=_emit)
 
-            if size is not None:
-                check_free_space_in_dir(cache_path, size)
+        if result.not_modified and algorithm is not None:
+            checksum = local_checksum
+            if checksum is None:
+                checksum = hash_file(local_path, algorithm)
+            if expected_checksum is None or decompress or checksum == expected_checksum:
+                result = result._replace(hash_algorithm=algorithm, checksum=checksum)
 
-            # show progress via stdout, or just output to stringIO and ignore
-            if show_progress:
-                progress_stream = sys.stdout
             else:
-                progress_stream = io.StringIO()
-
-            # message to display when downloading file:
-            dlmsg = "Downloading {0}".format(remote_url)
-            with ProgressBarOrSpinner(size, dlmsg, file=progress_stream) as p:
-                with tempfile.NamedTemporaryFile(dir=cache_path, delete=False) as f:
-                    try:
-                        bytes_read = 0
-                        block = remote.read(block_size)
-                        while block:
-                            f.write(block)
-                            bytes_read += len(block)
-                            p.update(bytes_read)
-                            block = remote.read(block_size)
-
-                    except BaseException:
-                        if os.path.exists(f.name):
-                            os.remove(f.name)
-                        raise
-
-            shutil.move(f.name, local_path)
-
-    except urllib.error.URLError as e:
+                # the server's copy is unchanged but the local one is not what
+                # was expected, so fetch it again in full
+                conditional = None
+                result = _retry(_attempt, remote_url, retries, retry_backoff_s,
+                                emit=_emit)
+
+    except Exception as e:
+        _emit('failure', error=e, seconds=time.time() - start)
+        raise
+
+    seconds = time.time() - start
+    n_bytes = 0 if result.not_modified else result.size
+    _emit('complete', bytes=n_bytes, seconds=seconds,
+          throughput=n_bytes / seconds if seconds > 0 else None,
+          not_modified=result.not_modified)
+    return result
+
+def _lock_path(local_path):
+    """ The lock file guarding the download of ``local_path``. """
+    return os.path.join(os.path.dirname(local_path),
+                        '.{0}.lock'.format(os.path.basename(local_path)))
+
+# downloads running in this process, by local path
+_flights = SingleFlight()
+
+def _fetch_single_flight(local_path, lock_timeout, arguments):
+    """
+    Call `fetch_file` with ``arguments`` for a file unless another thread is
+    already fetching it, holding the file's lock against other processes.
+    """
+    def _locked():
+        with FileLock(_lock_path(local_path), timeout=lock_timeout) as file_lock:
+            kwargs = dict(arguments, lock=False)
+            if file_lock.waited:
+                # another process has just fetched the file
+                kwargs.update(overwrite=False, refresh=False)
+            return fetch_file(**kwargs)
+
+    result, _ = _flights.do(os.path.abspath(local_path), _locked)
+    return result
+
+def _retry(func, remote_url, retries, retry_backoff_s, emit=None):
+    """
+    Call ``func()``, retrying up to ``retries`` times after network or server
+    errors with an exponentially growing delay. ``emit(name, **data)`` is
+    called with a ``'retry'`` event before each retry.
+    """
+    attempt = 0
+    while True:
+        try:
+            return func()
+
+        except _retryable_errors as e:
+            # client errors (e.g., 404) will not go away by trying again
+            if isinstance(e, urllib.error.HTTPError) and e.code < 500:
+                raise _fix_url_error(e, remote_url)
+
+            if attempt >= retries:
+                raise _fix_url_error(e, remote_url)
+
+            if emit is not None:
+                emit('retry', attempt=attempt + 1, error=e)
+            time.sleep(retry_backoff_s * 2**attempt)
+            attempt += 1
+
+def _conditional_headers(local_path, etag=None, last_modified=None):
+    """
+    The headers of a request for ``local_path`` that the server should answer
+    with 304 (Not Modified) if its copy has not changed.
+    """
+    headers = dict()
+    if etag:
+        headers['If-None-Match'] = etag
+    if last_modified:
+        headers['If-Modified-Since'] = last_modified
+    elif not etag:
+        headers['If-Modified-Since'] = email.utils.formatdate(
+            os.path.getmtime(local_path), usegmt=True)
+    return headers
+
+def _response_validators(info, size):
+    """ The validators and total length of a response, for `DownloadResult`. """
+    return dict(etag=info.get('ETag'), last_modified=info.get('Last-Modified'),
+                content_length=size)
+
+# the largest block that adaptive reads grow to, and the shortest time in
+# seconds between progress updates
+_max_block_size = 2**22
+_progress_interval = 0.1
+
+def _iter_blocks(remote, block_size, limit=None, throttle=None):
+    """
+    Read ``remote`` into one reused buffer, yielding a `memoryview` of each
+    block, which is only valid until the next one is read. The block size
+    starts at ``block_size`` and doubles (up to ``_max_block_size``) while
+    blocks arrive quickly, shrinking back when reads become slow. At most
+    ``limit`` bytes are read, if given, and ``throttle(n)`` is called after
+    each block of ``n`` bytes, if given.
+    """
+    min_size = size = max(1, int(block_size))
+    buffer = bytearray(size)
+    readinto = getattr(remote, 'readinto', None)
+
+    while limit is None or limit > 0:
+        if size > len(buffer):
+            buffer = bytearray(size)
+        view = memoryview(buffer)[:size if limit is None else min(size, limit)]
+
+        start = time.time()
+        if readinto is not None:
+            n = readinto(view)
+        else:
+            block = remote.read(len(view))
+            n = len(block)
+            view[:n] = block
+        elapsed = time.time() - start
+
+        if not n:
+            return
+        if limit is not None:
+            limit -= n
+        if throttle is not None:
+            throttle(n)
+        yield view[:n]
+
+        # aim for reads that take between about 10 and 100 ms
+        if n == size and elapsed < 0.01 and size < _max_block_size:
+            size *= 2
+        elif elapsed > 0.1 and size > min_size:
+            size //= 2
+
+def _join_head(blocks, n):
+    """
+    Yield ``blocks``, joining the first ones so that the first block yielded
+    has at least ``n`` bytes (unless the whole stream is shorter).
+    """
+    head = b''
+    for block in blocks:
+        if head is None:
+            yield block
+            continue
+        head += bytes(block)
+        if len(head) >= n:
+            yield head
+            head = None
+    if head:
+        yield head
+
+class _Progress(object):
+    """
+    Report progress to a progress bar and an optional callback, at most
+    every ``_progress_interval`` seconds unless forced.
+    """
+
+    def __init__(self, bar, callback, remote_url, size):
+        self.bar = bar
+        self.callback = callback
+        self.remote_url = remote_url
+        self.size = size
+        self._last = 0.
+
+    def update(self, bytes_read, force=False):
+        now = time.time()
+        if not force and now - self._last < _progress_interval:
+            return
+
+        self._last = now
+        self.bar.update(bytes_read)
+        if self.callback is not None:
+            self.callback(self.remote_url, bytes_read, self.size)
+
+# errors worth retrying a download for
+_retryable_errors = (urllib.error.URLError, socket.timeout, ConnectionError,
+                     http_client.HTTPException)
+
+def _fix_url_error(e, remote_url):
+    """ Add the URL to name resolution errors, and turn timeouts into URLErrors. """
+    if isinstance(e, urllib.error.URLError):
         if hasattr(e, 'reason') and hasattr(e.reason, 'errno') and e.reason.errno == 8:
             e.reason.strerror = e.reason.strerror + '. requested URL: ' + remote_url
             e.reason.args = (e.reason.errno, e.reason.strerror)
-        raise e
-    except socket.timeout as e:
+        return e
+
+    elif isinstance(e, socket.timeout):
         # this isn't supposed to happen, but occasionally a socket.timeout gets
         # through.  It's supposed to be caught in `urrlib2` and raised in this
         # way, but for some reason in mysterious circumstances it doesn't. So
         # we'll just re-raise it here instead
-        raise urllib.error.URLError(e)
+        return urllib.error.URLError(e)
+
+    return e
+
+def _read_partial(part_path, remote_url):
+    """
+    Return the sidecar metadata of a partial download of ``remote_url``, with
+    the partial file trimmed to the bytes known to be written, or `None` if
+    there is nothing to resume.
+    """
+    meta_path = part_path + '.json'
+    try:
+        with open(meta_path, 'r') as f:
+            meta = json.load(f)
+        size = os.path.getsize(part_path)
+    except (IOError, OSError, ValueError):
+        return None
+
+    if meta.get('url') != remote_url or size < meta.get('bytes', 0):
+        return None
+
+    with open(part_path, 'r+b') as f:
+        f.truncate(meta['bytes'])
+
+    return meta
+
+def _write_partial(part_path, meta):
+    with open(part_path + '.json', 'w') as f:
+        json.dump(meta, f)
+
+def _remove_partial(part_path):
+    for path in (part_path, part_path + '.json'):
+        if os.path.exists(path):
+            os.remove(path)
+
+def _download_attempt(remote_url, cache_path, local_path, timeout_s, show_progress,
+                      block_size, progress_callback, resume, algorithm=None,
+                      expected_checksum=None, conditional=None, pool=default_pool,
+                      emit=None, decompress=False, make_space=None, throttle=None,
+                      undetected_path=None):
+    """
+    Make one attempt at downloading a file to ``local_path``, hashing the data
+    as they are written if an ``algorithm`` is given. If ``conditional``
+    request headers are given and the server answers 304 (Not Modified), the
+    existing file is left alone. With ``decompress``, the data are
+    decompressed on the way, and hashed both before and after -- and if
+    ``decompress`` is `True` but no format is detected, the data are stored
+    as they are at ``undetected_path`` (if given) instead. A partial download
+    that no longer fits the file on the server is dropped, and the file is
+    fetched from the start.
+    """
+    arguments = dict(locals())
+
+    request = urllib.request.Request(remote_url, headers=conditional or dict())
+
+    # pick up where a previous attempt left off
+    part_path = local_path + '.part'
+    meta = None
+    if resume:
+        meta = _read_partial(part_path, remote_url)
+    offset = meta['bytes'] if meta else 0
+
+    if offset > 0:
+        request.add_header('Range', 'bytes={0}-'.format(offset))
+        # the server sends the whole file instead if it has changed
+        validator = meta.get('etag') or meta.get('last_modified')
+        if validator:
+            request.add_header('If-Range', validator)
+
+    start = time.time()
+    try:
+        remote = pool.urlopen(request, timeout=timeout_s)
+    except urllib.error.HTTPError as e:
+        if e.code == 416 and offset > 0:
+            # the file is now shorter than the partial download
+            e.close()
+            _remove_partial(part_path)
+            return _download_attempt(**arguments)
+        if e.code != 304 or conditional is None:
+            raise
+        e.close()
+        if emit is not None:
+            emit('ttfb', seconds=time.time() - start)
+        return DownloadResult(local_path, os.path.getsize(local_path), None, None,
+                              not_modified=True,
+                              **_response_validators(e.info(), None))
+
+    if emit is not None:
+        emit('ttfb', seconds=time.time() - start)
+
+    if offset > 0 and remote.getcode() == 206:
+        content_range = remote.info().get('Content-Range', '')
+        if not content_range.startswith('bytes {0}-'.format(offset)):
+            # some other part of the file, which can't follow the partial one
+            remote.close()
+            _remove_partial(part_path)
+            return _download_attempt(**arguments)
+
+    with contextlib.closing(remote):
+        # get file info
+        info = remote.info()
+
+        if offset > 0 and remote.getcode() != 206:
+            # the server ignored the range or the file changed: start over
+            offset = 0
+
+        if 'Content-Length' in info:
+            try:
+                size = int(info['Content-Length'])
+            except ValueError:
+                size = None
+        else:
+            size = None
+
+        if size is not None:
+            _check_free_space(cache_path, size, make_space)
+            size += offset
+
+        # show progress via stdout, or just output to stringIO and ignore
+        if show_progress:
+            progress_stream = sys.stdout
+        else:
+            progress_stream = io.StringIO()
+
+        h = hashlib.new(algorithm) if algorithm is not None else None
+        source_h = hashlib.new(algorithm) if algorithm is not None and decompress else None
+        decompressor = None
+
+        if resume:
+            meta = dict(url=remote_url, etag=info.get('ETag'),
+                        last_modified=info.get('Last-Modified'), bytes=offset)
+            _write_partial(part_path, meta)
+            if offset > 0 and h is not None:
+                # only the already-downloaded part has to be read back
+                _update_hash(h, part_path, block_size)
+            f = open(part_path, 'ab' if offset > 0 else 'wb')
+        else:
+            f = tempfile.NamedTemporaryFile(dir=cache_path, delete=False)
+
+        # message to display when downloading file:
+        dlmsg = "Downloading {0}".format(remote_url)
+        with ProgressBarOrSpinner(size, dlmsg, file=progress_stream) as p:
+            progress = _Progress(p, progress_callback, remote_url, size)
+            with f:
+                try:
+                    bytes_read = offset
+                    bytes_written = offset
+                    blocks = _iter_blocks(remote, block_size, throttle=throttle)
+                    if decompress is True:
+                        # however the first reads split them, detect the
+                        # format from enough leading bytes
+                        blocks = _join_head(blocks, _magic_length)
+                    for block in blocks:
+                        bytes_read += len(block)
+                        if decompress:
+                            if source_h is not None:
+                                source_h.update(block)
+                            if decompressor is None and bytes_read == len(block):
+                                compression = (detect_compression(block) if decompress is True
+                                               else decompress)
+                                if compression is not None:
+                                    decompressor = StreamDecompressor(compression)
+                            if decompressor is not None:
+                                block = decompressor.decompress(block)
+
+                        f.write(block)
+                        if h is not None:
+                            h.update(block)
+                        bytes_written += len(block)
+                        progress.update(bytes_read)
+                    progress.update(bytes_read, force=True)
+
+                    if size is not None and bytes_read < size:
+                        raise http_client.IncompleteRead(b'', size - bytes_read)
+
+                    if decompressor is not None:
+                        block = decompressor.flush()
+                        f.write(block)
+                        if h is not None:
+                            h.update(block)
+                        bytes_written += len(block)
+
+                    checksum = h.hexdigest() if h is not None else None
+                    source_checksum = (source_h.hexdigest() if source_h is not None
+                                       else checksum)
+                    if (expected_checksum is not None and
+                            source_checksum != expected_checksum):
+                        # the data are bad, so there is nothing worth resuming
+                        resume = False
+                        _check_checksum(source_checksum, expected_checksum, remote_url)
+
+                except BaseException:
+                    if resume:
+                        # keep what was written so the next attempt can resume
+                        f.flush()
+                        meta['bytes'] = bytes_read
+                        _write_partial(part_path, meta)
+                    else:
+                        f.close()
+                        _remove_partial(f.name)
+                    raise
+
+        if decompress is True and decompressor is None and undetected_path is not None:
+            local_path = undetected_path
+        shutil.move(f.name, local_path)
+        if resume:
+            _remove_partial(part_path)
+
+    if decompressor is not None:
+        return DownloadResult(local_path, bytes_written, algorithm, checksum,
+                              compression=decompressor.compression,
+                              source_size=bytes_read, source_checksum=source_checksum,
+                              **_response_validators(info, size))
+
+    return DownloadResult(local_path, bytes_read, algorithm, checksum,
+                          **_response_validators(info, size))
+
+def _check_free_space(cache_path, size, make_space=None):
+    """
+    Raise an `IOError` if there is not enough free space in ``cache_path``
+    for ``size`` bytes, after giving ``make_space`` a chance to free some.
+    """
+    try:
+        check_free_space_in_dir(cache_path, size)
+    except IOError:
+        if make_space is None:
+            raise
+        make_space(size)
+        check_free_space_in_dir(cache_path, size)
+
+def _probe_ranges(remote_url, timeout_s, pool=default_pool):
+    """
+    Check whether the server supports byte ranges for ``remote_url``. Returns
+    the total size and the response headers, or ``(None, None)`` if ranges are
+    not supported.
+    """
+    request = urllib.request.Request(remote_url, headers={'Range': 'bytes=0-0'})
+    with contextlib.closing(pool.urlopen(request, timeout=timeout_s)) as remote:
+        info = remote.info()
+        content_range = info.get('Content-Range', '')
+        if remote.getcode() != 206 or '/' not in content_range:
+            return None, None
+
+        # read the single byte so the connection can be reused
+        remote.read()
+
+        try:
+            size = int(content_range.rsplit('/', 1)[1])
+        except ValueError:
+            return None, None
+
+        return size, info
+
+def _preallocate(f, size):
+    if hasattr(os, 'posix_fallocate'):
+        try:
+            os.posix_fallocate(f.fileno(), 0, size)
+            return
+        except OSError:
+            # not supported by this filesystem
+            pass
+    f.truncate(size)
+
+def _segmented_attempt(remote_url, cache_path, local_path, timeout_s, show_progress,
+                       block_size, progress_callback, segments, min_segment_size,
+                       algorithm=None, expected_checksum=None, pool=default_pool,
+                       emit=None, make_space=None, throttle=None):
+    """
+    Download a file as several byte ranges in parallel, each written into its
+    place in a preallocated temporary file. Returns `None` without
+    downloading anything if the server does not support ranges or the file is
+    too small to split.
+
+    Segments arrive out of order, so if an ``algorithm`` is given the file is
+    hashed in a separate pass once complete.
+    """
+    start = time.time()
+    size, info = _probe_ranges(remote_url, timeout_s, pool=pool)
+    if size is None:
+        return None
+    validator = info.get('ETag') or info.get('Last-Modified')
+
+    n_segments = min(int(segments), size // max(1, int(min_segment_size)))
+    if n_segments < 2:
+        return None
+
+    if emit is not None:
+        emit('ttfb', seconds=time.time() - start)
+
+    _check_free_space(cache_path, size, make_space)
+
+    bounds = [size * i // n_segments for i in range(n_segments + 1)]
+    lock = threading.Lock()
+    bytes_read = [0]
+
+    if show_progress:
+        progress_stream = sys.stdout
+    else:
+        progress_stream = io.StringIO()
+
+    def _fetch_segment(temp_path, start, end, progress):
+        headers = {'Range': 'bytes={0}-{1}'.format(start, end - 1)}
+        if validator:
+            headers['If-Range'] = validator
+        request = urllib.request.Request(remote_url, headers=headers)
+
+        with contextlib.closing(pool.urlopen(request, timeout=timeout_s)) as remote:
+            content_range = remote.info().get('Content-Range', '')
+            if (remote.getcode() != 206 or
+                    not content_range.startswith('bytes {0}-{1}/'.format(start, end - 1))):
+                raise urllib.error.URLError("Server did not return the requested range "
+                                            "(the file may have changed): {}"
+                                            .format(remote_url))
+
+            with open(temp_path, 'r+b') as f:
+                f.seek(start)
+                position = start
+                for block in _iter_blocks(remote, block_size, limit=end - start,
+                                          throttle=throttle):
+                    f.write(block)
+                    position += len(block)
+                    with lock:
+                        bytes_read[0] += len(block)
+                        progress.update(bytes_read[0])
+
+        if position != end:
+            raise http_client.IncompleteRead(b'', end - position)
+
+    dlmsg = "Downloading {0} ({1} segments)".format(remote_url, n_segments)
+    with ProgressBarOrSpinner(size, dlmsg, file=progress_stream) as p:
+        progress = _Progress(p, progress_callback, remote_url, size)
+        with tempfile.NamedTemporaryFile(dir=cache_path, delete=False) as f:
+            temp_path = f.name
+            try:
+                _preallocate(f, size)
+            except BaseException:
+                f.close()
+                os.remove(temp_path)
+                raise
+
+        try:
+            results = _map_threaded(_fetch_segment,
+                                    [(temp_path, start, end, progress)
+                                     for start, end in zip(bounds[:-1], bounds[1:])],
+                                    max_workers=n_segments)
+            for _, error in results:
+                if error is not None:
+                    raise error
+
+            if os.path.getsize(temp_path) != size or bytes_read[0] != size:
+                raise http_client.IncompleteRead(b'', size - bytes_read[0])
+            progress.update(size, force=True)
+
+            checksum = None
+            if algorithm is not None:
+                checksum = hash_file(temp_path, algorithm)
+                _check_checksum(checksum, expected_checksum, remote_url)
+
+        except BaseException:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            raise
+
+    shutil.move(temp_path, local_path)
+    return DownloadResult(local_path, size, algorithm, checksum,
+                          **_response_validators(info, size))
+
+def download_files(requests, max_workers=8, scheduler=None, **kwargs):
+    """
+    Download many files concurrently using a pool of threads.
+
+    Parameters
+    ----------
+    requests : iterable
+        An iterable of ``(remote_url, cache_path)`` or
+        ``(remote_url, cache_path, filename)`` records, with the same meaning
+        as the arguments of `~astrodata.download.download_file`.
+    max_workers : int (optional)
+        The maximum number of simultaneous downloads (default is 8).
+    scheduler : `~astrodata.scheduler.Scheduler` (optional)
+        Start each download once its host has a free connection in the
+        scheduler's adaptive window, and keep to its bandwidth limit (default
+        is to start downloads in order, as workers become free).
+    **kwargs
+        All other keyword arguments are passed to
+        `~astrodata.download.download_file`. Progress bars are disabled unless
+        ``show_progress=True`` is passed explicitly -- use
+        ``progress_callback`` to follow the progress of each file instead.
+
+    Returns
+    -------
+    results : list
+        A list of ``(local_path, error)`` tuples in the same order as
+        ``requests``. ``local_path`` is `None` and ``error`` is the exception
+        raised if a download failed.
+
+    """
+    kwargs.setdefault('show_progress', False)
+    if scheduler is not None:
+        kwargs.setdefault('throttle', scheduler.throttle)
+        kwargs['event_callback'] = scheduler._callback(kwargs.get('event_callback'))
+
+    def _download(remote_url, cache_path, filename=None):
+        return download_file(remote_url, cache_path, filename=filename, **kwargs)
+
+    if scheduler is not None:
+        return scheduler.map(_download, requests, max_workers=max_workers)
+    return _map_threaded(_download, requests, max_workers=max_workers)
+
+def _map_threaded(func, args_list, max_workers):
+    """
+    Call ``func(*args)`` for each item of ``args_list`` in a thread pool and
+    return a list of ``(result, error)`` tuples in the input order.
+    """
+    args_list = list(args_list)
+    results = [None] * len(args_list)
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, int(max_workers))) as pool:
+        futures = dict((pool.submit(func, *args), i) for i, args in enumerate(args_list))
+        for future in concurrent.futures.as_completed(futures):
+            i = futures[future]
+            try:
+                results[i] = (future.result(), None)
+            except Exception as e:
+                results[i] = (None, e)
+
+    return results
 
-    return local_path
+def _makedirs(path):
+    """ Create a directory, tolerating another thread or process doing the same. """
+    if not os.path.exists(path):
+        try:
+            os.makedirs(path)
+        except OSError:
+            if not os.path.isdir(path):
+                raise
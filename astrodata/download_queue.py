@@ -0,0 +1,493 @@
+""" A persistent priority queue of downloads, and the worker that drains it """
+
+from __future__ import division, print_function
+
+# Standard library
+import argparse
+import concurrent.futures
+import json
+import os
+import socket
+import sqlite3
+import threading
+import time
+
+# Package
+from .lock import _pid_alive
+
+__all__ = ['DownloadQueue', 'QueuedDownload', 'QueueWorker', 'main']
+
+_columns = ('id', 'sub_path', 'source', 'local_name', 'options', 'priority', 'size',
+            'state', 'attempts', 'error', 'local_path', 'entry', 'worker',
+            'enqueued', 'started', 'finished', 'probed', 'not_before')
+
+# columns added since the first version of the table, for older queues
+_added_columns = (('probed', 'INTEGER NOT NULL DEFAULT 0'), ('not_before', 'REAL'))
+
+# what older versions stored as the size of a file they could not probe
+_old_unknown_size = 2**62
+
+def _worker_id():
+    return '{0}:{1}'.format(socket.gethostname(), os.getpid())
+
+class DownloadQueue(object):
+    """
+    A queue of files to add to a cache, kept in an SQLite database so that it
+    survives restarts and can be shared by the processes using the cache.
+
+    Jobs are taken in order of decreasing ``priority``, then shortest first
+    where the size is known (files of unknown size go last), then in the
+    order they were added. A failed job waits ``retry_delay`` seconds before
+    it is tried again, doubling with each attempt.
+
+    Parameters
+    ----------
+    path : str
+        Path to the SQLite database. Created if it does not exist.
+    max_attempts : int (optional)
+        The number of times a job is tried before it is marked as failed
+        (default is 3).
+    retry_delay : float (optional)
+        Seconds to wait before the first retry of a failed job (default is
+        1).
+    """
+
+    def __init__(self, path, max_attempts=3, retry_delay=1.):
+        self.path = path
+        self.max_attempts = int(max_attempts)
+        self.retry_delay = float(retry_delay)
+        self._lock = threading.Lock()
+
+        self._conn = sqlite3.connect(self.path, timeout=60., check_same_thread=False,
+                                     isolation_level=None)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('PRAGMA synchronous=NORMAL')
+        self._conn.execute('CREATE TABLE IF NOT EXISTS jobs ('
+                           'id INTEGER PRIMARY KEY AUTOINCREMENT, '
+                           'sub_path TEXT NOT NULL, '
+                           'source TEXT NOT NULL, '
+                           'local_name TEXT, '
+                           'options TEXT NOT NULL, '
+                           'priority INTEGER NOT NULL DEFAULT 0, '
+                           'size INTEGER, '
+                           'state TEXT NOT NULL, '
+                           'attempts INTEGER NOT NULL DEFAULT 0, '
+                           'error TEXT, '
+                           'local_path TEXT, '
+                           'entry TEXT, '
+                           'worker TEXT, '
+                           'enqueued REAL, '
+                           'started REAL, '
+                           'finished REAL, '
+                           'probed INTEGER NOT NULL DEFAULT 0, '
+                           'not_before REAL)')
+        self._add_columns()
+        self._conn.execute('CREATE INDEX IF NOT EXISTS jobs_order ON jobs '
+                           '(state, priority DESC, size IS NULL, size, id)')
+
+    def _add_columns(self):
+        columns = set(row[1] for row in self._conn.execute('PRAGMA table_info(jobs)'))
+        for name, definition in _added_columns:
+            if name in columns:
+                continue
+            try:
+                self._conn.execute('ALTER TABLE jobs ADD COLUMN {0} {1}'
+                                   .format(name, definition))
+            except sqlite3.OperationalError:
+                # another process added it first
+                continue
+            if name == 'probed':
+                self._conn.execute('UPDATE jobs SET size = NULL, probed = 1 '
+                                   'WHERE size = ?', (_old_unknown_size,))
+
+    def _execute(self, sql, args=()):
+        with self._lock:
+            return self._conn.execute(sql, args).fetchall()
+
+    def put(self, sub_path, source, local_name=None, priority=0, size=None, options=None):
+        """
+        Add a job, or return the id of the same job if it is still waiting or
+        running (raising its priority if this one is higher).
+
+        Parameters
+        ----------
+        sub_path : str
+            Path to save the file relative to the cache root.
+        source : str
+            The URL (or local path) of the file.
+        local_name : str (optional)
+            The filename to save this file as locally.
+        priority : int (optional)
+            Higher priorities are taken first (default is 0).
+        size : int (optional)
+            The size of the file in bytes, if known.
+        options : dict (optional)
+            Keyword arguments for `~astrodata.cache.Cache.add_data`, which
+            must be serializable as JSON.
+
+        Returns
+        -------
+        job_id : int
+        """
+        try:
+            options = json.dumps(options or dict(), sort_keys=True)
+        except TypeError as e:
+            raise ValueError("Queued downloads only take options that can be "
+                             "stored as JSON: {}".format(e))
+
+        with self._lock:
+            self._conn.execute('BEGIN IMMEDIATE')
+            try:
+                row = self._conn.execute(
+                    "SELECT id, priority FROM jobs WHERE sub_path = ? AND source = ? AND "
+                    "local_name IS ? AND options = ? AND state IN ('queued', 'running')",
+                    (sub_path, source, local_name, options)).fetchone()
+                if row is not None:
+                    job_id = row[0]
+                    if priority > row[1]:
+                        self._conn.execute('UPDATE jobs SET priority = ? WHERE id = ?',
+                                           (priority, job_id))
+                else:
+                    job_id = self._conn.execute(
+                        'INSERT INTO jobs (sub_path, source, local_name, options, '
+                        'priority, size, state, enqueued) '
+                        "VALUES (?, ?, ?, ?, ?, ?, 'queued', ?)",
+                        (sub_path, source, local_name, options, int(priority), size,
+                         time.time())).lastrowid
+                self._conn.execute('COMMIT')
+            except BaseException:
+                self._conn.execute('ROLLBACK')
+                raise
+
+        return job_id
+
+    def claim(self, worker=None):
+        """
+        Mark the next job as running and return it as a dictionary, or return
+        `None` if there is nothing to do (jobs waiting to be retried are
+        skipped until their ``not_before`` time).
+        """
+        if worker is None:
+            worker = _worker_id()
+
+        with self._lock:
+            self._conn.execute('BEGIN IMMEDIATE')
+            try:
+                now = time.time()
+                row = self._conn.execute(
+                    "SELECT {0} FROM jobs WHERE state = 'queued' AND "
+                    '(not_before IS NULL OR not_before <= ?) '
+                    'ORDER BY priority DESC, size IS NULL, size, id LIMIT 1'
+                    .format(', '.join(_columns)), (now,)).fetchone()
+                if row is not None:
+                    self._conn.execute("UPDATE jobs SET state = 'running', worker = ?, "
+                                       'started = ?, attempts = attempts + 1 WHERE id = ?',
+                                       (worker, now, row[0]))
+                self._conn.execute('COMMIT')
+            except BaseException:
+                self._conn.execute('ROLLBACK')
+                raise
+
+        if row is None:
+            return None
+        job = dict(zip(_columns, row))
+        job['options'] = json.loads(job['options'])
+        job['attempts'] += 1
+        return job
+
+    def set_size(self, job_id, size):
+        """
+        Record the size of a job's file, for ordering, or `None` if it could
+        not be found out, so that it is not probed again.
+        """
+        self._execute('UPDATE jobs SET size = ?, probed = 1 WHERE id = ?', (size, job_id))
+
+    def unsized(self, limit=32):
+        """ ``(id, source)`` of waiting jobs whose size has not been probed. """
+        return self._execute("SELECT id, source FROM jobs WHERE state = 'queued' AND "
+                             'size IS NULL AND NOT probed ORDER BY priority DESC, id '
+                             'LIMIT ?', (limit,))
+
+    def complete(self, job_id, local_path, entry=None):
+        """ Mark a job as done. """
+        self._execute("UPDATE jobs SET state = 'done', local_path = ?, entry = ?, "
+                      'error = NULL, finished = ? WHERE id = ?',
+                      (local_path, json.dumps(entry) if entry is not None else None,
+                       time.time(), job_id))
+
+    def fail(self, job_id, error):
+        """
+        Record a failed attempt, putting the job back in the queue unless it
+        has been tried ``max_attempts`` times. It is not tried again for
+        ``retry_delay * 2**(attempts - 1)`` seconds.
+        """
+        now = time.time()
+        self._execute("UPDATE jobs SET state = CASE WHEN attempts < ? THEN 'queued' "
+                      "ELSE 'failed' END, error = ?, finished = ?, "
+                      'not_before = ? + ? * (1 << (attempts - 1)) WHERE id = ?',
+                      (self.max_attempts, str(error), now, now, self.retry_delay, job_id))
+
+    def recover(self):
+        """
+        Put back in the queue any running jobs whose worker process on this
+        host no longer exists, e.g. after a crash or restart.
+
+        Returns
+        -------
+        n_jobs : int
+        """
+        host = socket.gethostname()
+        recovered = []
+        for job_id, worker in self._execute("SELECT id, worker FROM jobs "
+                                            "WHERE state = 'running'"):
+            worker_host, _, pid = (worker or '').rpartition(':')
+            if worker_host == host and pid.isdigit() and not _pid_alive(int(pid)):
+                recovered.append(job_id)
+
+        for job_id in recovered:
+            self._execute("UPDATE jobs SET state = 'queued', worker = NULL "
+                          "WHERE id = ? AND state = 'running'", (job_id,))
+        return len(recovered)
+
+    def get(self, job_id):
+        """ Return a job as a dictionary, or `None` if there is no such job. """
+        rows = self._execute('SELECT {0} FROM jobs WHERE id = ?'.format(', '.join(_columns)),
+                             (job_id,))
+        if not rows:
+            return None
+        job = dict(zip(_columns, rows[0]))
+        job['options'] = json.loads(job['options'])
+        if job['entry'] is not None:
+            job['entry'] = json.loads(job['entry'])
+        return job
+
+    def counts(self):
+        """ The number of jobs in each state. """
+        return dict(self._execute('SELECT state, COUNT(*) FROM jobs GROUP BY state'))
+
+    def purge(self, older_than=0.):
+        """
+        Remove finished (done or failed) jobs that finished more than
+        ``older_than`` seconds ago.
+        """
+        self._execute("DELETE FROM jobs WHERE state IN ('done', 'failed') AND "
+                      'finished < ?', (time.time() - older_than,))
+
+    def close(self):
+        self._conn.close()
+
+class QueuedDownload(object):
+    """
+    A handle on a job in a `~astrodata.download_queue.DownloadQueue`, as
+    returned by ``Cache.add_data(..., enqueue=True)``.
+    """
+
+    def __init__(self, cache, job_id):
+        self.cache = cache
+        self.id = job_id
+
+    @property
+    def state(self):
+        """ ``'queued'``, ``'running'``, ``'done'``, or ``'failed'``. """
+        return self.cache.queue.get(self.id)['state']
+
+    def done(self):
+        """ Whether the job has finished, successfully or not. """
+        return self.state in ('done', 'failed')
+
+    def wait(self, timeout=None, poll_interval=0.2):
+        """
+        Wait for the job to finish, and return the local path of the file. Its
+        schema entry is also added to the cache that queued it.
+
+        Raises an `IOError` if the job failed or did not finish within
+        ``timeout`` seconds.
+        """
+        start = time.time()
+        while True:
+            job = self.cache.queue.get(self.id)
+            if job['state'] == 'done':
+                if job['entry'] is not None:
+                    name = os.path.basename(job['local_path'])
+                    self.cache._set_entries([(job['sub_path'], name, job['entry'])])
+                return job['local_path']
+
+            if job['state'] == 'failed':
+                raise IOError("Queued download of {0} failed: {1}"
+                              .format(job['source'], job['error']))
+
+            if timeout is not None and time.time() - start > timeout:
+                raise IOError("Timed out waiting for the queued download of {}"
+                              .format(job['source']))
+            time.sleep(poll_interval)
+
+    def __repr__(self):
+        return '<QueuedDownload {0}>'.format(self.id)
+
+class QueueWorker(object):
+    """
+    Drain the download queue of a cache with a pool of threads, adding each
+    file to the cache as it is done. Jobs left running by a worker that died
+    are picked up again, and the sizes of waiting files are probed in the
+    background so that short ones go first.
+
+    Parameters
+    ----------
+    cache : `~astrodata.cache.Cache`
+        The cache whose queue to drain.
+    max_workers : int (optional)
+        The number of transfers at once. Default is the ``queue_workers``
+        setting in the ~/.astrodataconfig file, or 4.
+    poll_interval : float (optional)
+        Seconds between checks of an empty queue (default is 1).
+    max_probes : int (optional)
+        The number of size probes at once (default is 4).
+    """
+
+    def __init__(self, cache, max_workers=None, poll_interval=1., max_probes=4):
+        if max_workers is None:
+            max_workers = int(cache.config.get('queue_workers', 4))
+        self.cache = cache
+        self.max_workers = max(1, int(max_workers))
+        self.poll_interval = float(poll_interval)
+        self.max_probes = max(1, int(max_probes))
+        self._stop = threading.Event()
+
+    def stop(self):
+        """ Stop taking new jobs; `run` returns once the running ones finish. """
+        self._stop.set()
+
+    def _probe_size(self, job_id, source):
+        from .download import _probe_ranges
+        size = None
+        if not os.path.exists(source):
+            try:
+                size, _ = _probe_ranges(source, 10., pool=self.cache.pool)
+            except Exception:
+                pass
+        else:
+            size = os.path.getsize(source)
+        # files whose size cannot be found out are not probed again, and go
+        # after all files of known size
+        self.cache.queue.set_size(job_id, size)
+
+    def _probe_sizes(self, prober, probing):
+        """
+        Start probing the sizes of waiting jobs in ``prober``, keeping at most
+        ``max_probes`` going. ``probing`` maps each future to its job's ID.
+        """
+        for future in [future for future in probing if future.done()]:
+            del probing[future]
+
+        free = self.max_probes - len(probing)
+        if free <= 0:
+            return
+        ids = set(probing.values())
+        for job_id, source in self.cache.queue.unsized(limit=self.max_probes + len(ids)):
+            if free <= 0:
+                break
+            if job_id not in ids:
+                probing[prober.submit(self._probe_size, job_id, source)] = job_id
+                free -= 1
+
+    def _run_job(self, job):
+        options = dict(job['options'])
+        options.setdefault('show_progress', False)
+        local_path, entry = self.cache._ingest(
+            os.path.join(self.cache.root, job['sub_path']), job['source'],
+            local_name=job['local_name'], **options)
+        return local_path, entry
+
+    def run(self, until_empty=False):
+        """
+        Process jobs until `stop` is called, or with ``until_empty``, until
+        the queue has no more waiting jobs (including those waiting to be
+        retried).
+
+        Returns
+        -------
+        n_jobs : int
+            The number of jobs processed.
+        """
+        queue = self.cache.queue
+        queue.recover()
+        worker = _worker_id()
+        running = dict()
+        probing = dict()
+        n_jobs = 0
+
+        # probes wait on remote servers, so they run apart from dispatching
+        prober = concurrent.futures.ThreadPoolExecutor(max_workers=self.max_probes)
+        try:
+            with concurrent.futures.ThreadPoolExecutor(max_workers=self.max_workers) as pool:
+                while True:
+                    if not self._stop.is_set():
+                        self._probe_sizes(prober, probing)
+                        while len(running) < self.max_workers:
+                            job = queue.claim(worker)
+                            if job is None:
+                                break
+                            full_cache_path = os.path.join(self.cache.root,
+                                                           job['sub_path'])
+                            if not os.path.exists(full_cache_path):
+                                os.makedirs(full_cache_path)
+                            running[pool.submit(self._run_job, job)] = job
+
+                    if not running:
+                        if self._stop.is_set() or (until_empty and
+                                                   not queue.counts().get('queued')):
+                            break
+                        self._stop.wait(self.poll_interval)
+                        continue
+
+                    done, _ = concurrent.futures.wait(
+                        running, timeout=self.poll_interval,
+                        return_when=concurrent.futures.FIRST_COMPLETED)
+
+                    # the schema is only touched from this thread
+                    for future in done:
+                        job = running.pop(future)
+                        n_jobs += 1
+                        try:
+                            local_path, entry = future.result()
+                        except Exception as e:
+                            queue.fail(job['id'], e)
+                            continue
+
+                        name = os.path.basename(local_path)
+                        self.cache._store([(job['sub_path'], name, entry)])
+                        self.cache._catalog.commit()
+                        queue.complete(job['id'], local_path, entry)
+
+        finally:
+            # probes not yet started are dropped, and the rest time out
+            for future in probing:
+                future.cancel()
+            prober.shutdown(wait=True)
+
+        return n_jobs
+
+def main(args=None):
+    """ Run a worker that drains the download queue of a cache. """
+    parser = argparse.ArgumentParser(description="Download the files queued with "
+                                     "Cache.add_data(..., enqueue=True).")
+    parser.add_argument('--config', default=None,
+                        help="The AstroData config file (default ~/.astrodataconfig).")
+    parser.add_argument('--workers', type=int, default=None,
+                        help="The number of transfers at once (default is the "
+                        "queue_workers setting, or 4).")
+    parser.add_argument('--once', action='store_true',
+                        help="Exit when the queue is empty instead of waiting for more.")
+    args = parser.parse_args(args)
+
+    from .cache import Cache
+    with Cache(args.config) as cache:
+        worker = QueueWorker(cache, max_workers=args.workers)
+        try:
+            worker.run(until_empty=args.once)
+        except KeyboardInterrupt:
+            # running jobs are taken up again by the next worker
+            pass
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,157 @@
+""" Moving and copying local files into the cache without passing data through Python """
+
+from __future__ import division, print_function
+
+# Standard library
+import errno
+import os
+import shutil
+import uuid
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+__all__ = ['reflink', 'copy_file', 'ingest_file']
+
+# the FICLONE ioctl request from <linux/fs.h>
+FICLONE = 0x40049409
+
+def reflink(source_path, dest_path):
+    """
+    Make ``dest_path`` a copy-on-write clone of ``source_path``. This only
+    works within one filesystem that supports it (e.g., Btrfs or XFS), and
+    raises an `OSError` otherwise.
+    """
+    if fcntl is None:
+        raise OSError(errno.EOPNOTSUPP, "Reflinks are not supported on this platform")
+
+    with open(source_path, 'rb') as fsrc, open(dest_path, 'wb') as fdst:
+        fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+
+def _kernel_copy(fsrc, fdst, size):
+    """
+    Copy the contents of one open file to another inside the kernel, with
+    ``copy_file_range`` or ``sendfile`` where available, falling back to a
+    regular copy. Returns the name of the method used.
+    """
+    offset = 0
+    infd, outfd = fsrc.fileno(), fdst.fileno()
+
+    if hasattr(os, 'copy_file_range'):
+        try:
+            while offset < size:
+                n = os.copy_file_range(infd, outfd, size - offset, offset, offset)
+                if n == 0:
+                    break
+                offset += n
+            if offset >= size:
+                return 'copy_file_range'
+        except OSError:
+            # e.g., across filesystems on older kernels
+            pass
+
+    if hasattr(os, 'sendfile'):
+        try:
+            os.lseek(outfd, offset, os.SEEK_SET)
+            while offset < size:
+                n = os.sendfile(outfd, infd, offset, size - offset)
+                if n == 0:
+                    break
+                offset += n
+            if offset >= size:
+                return 'sendfile'
+        except OSError:
+            pass
+
+    fsrc.seek(offset)
+    fdst.seek(offset)
+    shutil.copyfileobj(fsrc, fdst, 2**20)
+    return 'copy'
+
+def copy_file(source_path, dest_path):
+    """
+    Copy a file and its metadata, as a reflink if possible and otherwise
+    inside the kernel.
+
+    Returns
+    -------
+    method : str
+        How the data were copied: ``'reflink'``, ``'copy_file_range'``,
+        ``'sendfile'``, or ``'copy'``.
+    """
+    try:
+        reflink(source_path, dest_path)
+        method = 'reflink'
+
+    except (OSError, IOError):
+        with open(source_path, 'rb') as fsrc, open(dest_path, 'wb') as fdst:
+            method = _kernel_copy(fsrc, fdst, os.fstat(fsrc.fileno()).st_size)
+
+    shutil.copystat(source_path, dest_path)
+    return method
+
+def ingest_file(source_path, local_path, move=False, hardlink=False):
+    """
+    Put a local file into the cache at ``local_path`` with as little data
+    copying as possible, replacing any existing file atomically.
+
+    Parameters
+    ----------
+    source_path : str
+        The file to add.
+    local_path : str
+        The path in the cache.
+    move : bool (optional)
+        Remove the source. Within one filesystem the file is simply renamed
+        (default is ``False``).
+    hardlink : bool (optional)
+        Within one filesystem, make the cached file a hardlink to the source
+        instead of copying it -- the two then share their contents (default is
+        ``False``).
+
+    Returns
+    -------
+    method : str
+        How the file was added: ``'rename'``, ``'link'``, or one of the
+        methods of `~astrodata.fastcopy.copy_file`.
+    """
+    tmp_path = os.path.join(os.path.dirname(local_path),
+                            '.{0}.{1}.tmp'.format(os.path.basename(local_path),
+                                                  uuid.uuid4().hex))
+    method = None
+    try:
+        if move:
+            try:
+                os.rename(source_path, tmp_path)
+                method = 'rename'
+            except OSError as e:
+                if e.errno != errno.EXDEV:
+                    raise
+
+        elif hardlink:
+            try:
+                os.link(source_path, tmp_path)
+                method = 'link'
+            except OSError:
+                pass
+
+        if method is None:
+            method = copy_file(source_path, tmp_path)
+
+        os.replace(tmp_path, local_path)
+        if os.path.lexists(tmp_path):
+            # renaming over another link to the same file does nothing
+            os.remove(tmp_path)
+
+    except BaseException:
+        if method == 'rename' and os.path.exists(tmp_path):
+            os.rename(tmp_path, source_path)
+        elif os.path.lexists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+    if move and method != 'rename':
+        os.remove(source_path)
+
+    return method
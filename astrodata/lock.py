@@ -0,0 +1,235 @@
+""" Advisory lock files and single-flight calls shared between processes """
+
+from __future__ import division, print_function
+
+# Standard library
+import errno
+import json
+import os
+import socket
+import threading
+import time
+import uuid
+
+__all__ = ['FileLock', 'LockTimeout', 'SingleFlight']
+
+class LockTimeout(IOError):
+    """ Raised when a lock could not be acquired in time. """
+
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except OSError as e:
+        return e.errno == errno.EPERM
+    return True
+
+class FileLock(object):
+    """
+    An advisory lock held by creating a file exclusively, which works between
+    threads, processes, and (on filesystems with atomic exclusive creation)
+    hosts. The file records the host and process holding the lock, and its
+    modification time is refreshed from a background thread while the lock is
+    held.
+
+    A lock is broken as stale if its holder was a process on this host that
+    no longer exists, or if it has not been refreshed for ``stale_after``
+    seconds (e.g., its host went down).
+
+    Use as a context manager::
+
+        with FileLock(path):
+            ...
+
+    Parameters
+    ----------
+    path : str
+        The lock file.
+    timeout : float (optional)
+        Raise `~astrodata.lock.LockTimeout` after waiting this many seconds
+        (default is to wait indefinitely).
+    stale_after : float (optional)
+        The age in seconds after which a lock that is not refreshed is
+        considered stale (default is 60).
+    poll_interval : float (optional)
+        The longest time in seconds between attempts to take the lock
+        (default is 1).
+    """
+
+    def __init__(self, path, timeout=None, stale_after=60., poll_interval=1.):
+        self.path = path
+        self.timeout = timeout
+        self.stale_after = float(stale_after)
+        self.poll_interval = float(poll_interval)
+        self.waited = False
+        self._token = None
+        self._stop = None
+
+    @property
+    def locked(self):
+        """ Whether this object holds the lock. """
+        return self._token is not None
+
+    def acquire(self):
+        """
+        Take the lock, waiting for another holder to release it if necessary.
+
+        Returns
+        -------
+        waited : bool
+            Whether the lock was held by someone else first, in which case
+            they may already have done the work it protects.
+        """
+        start = time.time()
+        delay = 0.01
+        self.waited = False
+        token = '{0}.{1}'.format(os.getpid(), uuid.uuid4().hex)
+
+        while True:
+            try:
+                fd = os.open(self.path, os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0o644)
+            except OSError as e:
+                if e.errno != errno.EEXIST:
+                    raise
+            else:
+                with os.fdopen(fd, 'w') as f:
+                    json.dump(dict(host=socket.gethostname(), pid=os.getpid(),
+                                   token=token, time=time.time()), f)
+                self._token = token
+                self._start_heartbeat()
+                return self.waited
+
+            self.waited = True
+            if self._break_stale():
+                continue
+
+            if self.timeout is not None and time.time() - start > self.timeout:
+                raise LockTimeout("Timed out waiting for the lock {}".format(self.path))
+
+            time.sleep(delay)
+            delay = min(delay * 2, self.poll_interval)
+
+    def release(self):
+        """ Release the lock, if held. """
+        if self._token is None:
+            return
+
+        self._stop.set()
+        token, self._token = self._token, None
+        if self._read(self.path).get('token') == token:
+            try:
+                os.remove(self.path)
+            except OSError:
+                pass
+
+    def _start_heartbeat(self):
+        self._stop = stop = threading.Event()
+        path = self.path
+        interval = self.stale_after / 4.
+
+        def _beat():
+            while not stop.wait(interval):
+                try:
+                    os.utime(path, None)
+                except OSError:
+                    return
+
+        thread = threading.Thread(target=_beat)
+        thread.daemon = True
+        thread.start()
+
+    @staticmethod
+    def _read(path):
+        try:
+            with open(path, 'r') as f:
+                return json.load(f)
+        except (IOError, OSError, ValueError):
+            return dict()
+
+    def _is_stale(self, info, mtime):
+        if info.get('host') == socket.gethostname() and 'pid' in info:
+            if not _pid_alive(info['pid']):
+                return True
+        return time.time() - mtime > self.stale_after
+
+    def _break_stale(self):
+        """ Remove the lock file if its holder is gone, returning whether it was. """
+        try:
+            mtime = os.stat(self.path).st_mtime
+        except OSError:
+            # released in the meantime
+            return True
+
+        info = self._read(self.path)
+        if not info and time.time() - mtime < 1.:
+            # the holder may still be writing the file
+            return False
+        if not self._is_stale(info, mtime):
+            return False
+
+        # move the lock aside first, so that only one waiter breaks it
+        aside = '{0}.{1}.stale'.format(self.path, uuid.uuid4().hex)
+        try:
+            os.rename(self.path, aside)
+        except OSError:
+            return True
+
+        if self._read(aside).get('token') != info.get('token'):
+            # a new holder took the lock in between -- give it back
+            try:
+                os.link(aside, self.path)
+            except OSError:
+                pass
+        os.remove(aside)
+        return True
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *args):
+        self.release()
+
+class SingleFlight(object):
+    """
+    Coalesce concurrent calls with the same key within a process: while one
+    call for a key is running, other threads asking for the same key wait for
+    it and get its result (or its exception) instead of repeating the work.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = dict()
+
+    def do(self, key, func):
+        """
+        Call ``func()``, or wait for the call already running for ``key``.
+
+        Returns
+        -------
+        result
+            The return value of the call.
+        shared : bool
+            Whether the result came from another thread's call.
+        """
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = dict(done=threading.Event())
+
+        if not leader:
+            call['done'].wait()
+            if 'error' in call:
+                raise call['error']
+            return call['result'], True
+
+        try:
+            call['result'] = func()
+            return call['result'], False
+        except BaseException as e:
+            call['error'] = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call['done'].set()
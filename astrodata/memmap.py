@@ -0,0 +1,140 @@
+""" Memory-mapped views of cached files, kept open between uses """
+
+from __future__ import division, print_function
+
+# Standard library
+from collections import OrderedDict
+import io
+import mmap
+import os
+import struct
+import threading
+
+__all__ = ['MappedFiles']
+
+_fits_suffixes = ('.fits', '.fit', '.fts')
+
+def _is_fits(path):
+    if path.lower().endswith(_fits_suffixes):
+        return True
+    with open(path, 'rb') as f:
+        return f.read(9) == b'SIMPLE  ='
+
+def _open_mmap(path):
+    with open(path, 'rb') as f:
+        # the map stays valid after the file is closed
+        return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+def _npy_layout(data):
+    """
+    The ``(dtype, shape, order, offset)`` of the array in the contents of a
+    ``.npy`` file, or `None` for a format version that is not understood.
+    """
+    from numpy.lib import format as npy_format
+    version = npy_format.read_magic(io.BytesIO(data[:8]))
+    if version == (1, 0):
+        offset = 10 + struct.unpack('<H', data[8:10])[0]
+        read_header = npy_format.read_array_header_1_0
+    elif version == (2, 0):
+        offset = 12 + struct.unpack('<I', data[8:12])[0]
+        read_header = npy_format.read_array_header_2_0
+    else:
+        return None
+
+    header = io.BytesIO(data[:offset])
+    npy_format.read_magic(header)
+    shape, fortran_order, dtype = read_header(header)
+    return dtype, shape, 'F' if fortran_order else 'C', offset
+
+def _array_view(data, dtype=None, shape=None, offset=0, order='C'):
+    """ A read-only array over ``data`` (e.g., a map), without copying it. """
+    import numpy as np
+    dtype = np.dtype(dtype or np.uint8)
+    if shape is None:
+        return np.frombuffer(data, dtype=dtype, offset=offset)
+
+    shape = tuple(shape) if hasattr(shape, '__len__') else (shape,)
+    count = 1
+    for n in shape:
+        count *= int(n)
+    return np.frombuffer(data, dtype=dtype, count=count, offset=offset).reshape(
+        shape, order=order)
+
+class MappedFiles(object):
+    """
+    A least-recently-used set of read-only memory maps of files, so that
+    repeated access to the same file does not open and map it again.
+
+    The maps themselves are never handed out: each call gets its own view of
+    one (a `memoryview` or a `numpy.ndarray`), so callers don't share a file
+    position and releasing one view leaves the others alone. A map is
+    replaced if its file changes (e.g., is downloaded again). Evicted maps
+    are not closed, so views already handed out stay valid until they are no
+    longer referenced.
+
+    Parameters
+    ----------
+    maxsize : int (optional)
+        The number of maps to keep (default is 16).
+    """
+
+    def __init__(self, maxsize=16):
+        self.maxsize = int(maxsize)
+        self._maps = OrderedDict()
+        self._lock = threading.Lock()
+
+    def open_mmap(self, path):
+        """ Return a read-only `memoryview` of a map of the whole file. """
+        return memoryview(self._get(path))
+
+    def load_array(self, path, dtype=None, shape=None, offset=0, order='C'):
+        """
+        Return a memory-mapped view of a file: a new `~astropy.io.fits.HDUList`
+        for FITS files, the array of a ``.npy`` file, and otherwise a
+        read-only array with the given ``dtype`` (default is bytes),
+        ``shape``, ``offset``, and ``order``.
+        """
+        if _is_fits(path):
+            # astropy only maps files itself, so each caller gets its own list
+            # (and map) to close as it likes
+            from astropy.io import fits
+            return fits.open(path, mode='readonly', memmap=True)
+
+        data = self._get(path)
+        if path.lower().endswith('.npy'):
+            layout = _npy_layout(data)
+            if layout is None:
+                import numpy as np
+                return np.load(path, mmap_mode='r')
+            dtype, shape, order, offset = layout
+
+        return _array_view(data, dtype=dtype, shape=shape, offset=offset, order=order)
+
+    def _get(self, path):
+        path = os.path.abspath(path)
+        stat = os.stat(path)
+        version = (stat.st_ino, stat.st_size, stat.st_mtime)
+
+        with self._lock:
+            cached = self._maps.get(path)
+            if cached is not None and cached[0] == version:
+                self._maps.move_to_end(path)
+                return cached[1]
+
+        value = _open_mmap(path)
+
+        with self._lock:
+            self._maps[path] = (version, value)
+            self._maps.move_to_end(path)
+            while len(self._maps) > self.maxsize:
+                self._maps.popitem(last=False)
+
+        return value
+
+    def __len__(self):
+        return len(self._maps)
+
+    def clear(self):
+        """ Forget all maps. """
+        with self._lock:
+            self._maps.clear()
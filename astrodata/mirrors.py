@@ -0,0 +1,375 @@
+""" Choosing between mirrors of a file, and hedging slow requests """
+
+from __future__ import division, print_function
+
+# Standard library
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+
+# Third party
+from astropy.extern.six.moves import urllib
+
+# Package
+from .compression import strip_compression_suffix
+from .download import _flights, _lock_path, _makedirs, fetch_file
+from .lock import FileLock
+from .telemetry import Event, _percentile
+
+__all__ = ['HostScores', 'fetch_mirrored']
+
+def _host(url):
+    """ The ``host[:port]`` of a URL, or `None` for e.g. local paths. """
+    return urllib.parse.urlsplit(url).netloc or None
+
+class _Cancelled(Exception):
+    """ Raised inside the losing download of a hedged pair to stop it. """
+
+class HostScores(object):
+    """
+    Time-to-first-byte and throughput statistics per host, learned from
+    download events (pass `~astrodata.mirrors.HostScores.record` as an event
+    callback), for ranking the mirrors of a file.
+
+    Parameters
+    ----------
+    path : str (optional)
+        A JSON file to load the statistics from and `save` them to, so they
+        carry over between sessions.
+    alpha : float (optional)
+        The weight of each new measurement in the moving averages (default
+        is 0.3).
+    max_samples : int (optional)
+        The number of recent time-to-first-byte measurements kept per host,
+        for percentiles (default is 100).
+    """
+
+    def __init__(self, path=None, alpha=0.3, max_samples=100):
+        self.path = path
+        self.alpha = float(alpha)
+        self.max_samples = int(max_samples)
+        self._hosts = dict()
+        self._lock = threading.Lock()
+        self._dirty = False
+
+        if path is not None and os.path.exists(path):
+            try:
+                with open(path, 'r') as f:
+                    self._hosts = json.load(f)
+            except (IOError, ValueError):
+                # a damaged file only loses what was learned
+                self._hosts = dict()
+
+    def _average(self, old, new):
+        if old is None:
+            return new
+        return (1 - self.alpha) * old + self.alpha * new
+
+    def record(self, event):
+        """ Update the statistics of a host from a download `~astrodata.telemetry.Event`. """
+        host = _host(event.url) if event.url else None
+        if host is None:
+            return
+
+        with self._lock:
+            stats = self._hosts.setdefault(host, dict(ttfb=None, throughput=None,
+                                                      samples=[], failures=0))
+            if event.name == 'ttfb':
+                stats['ttfb'] = self._average(stats['ttfb'], event.data['seconds'])
+                stats['samples'] = (stats['samples'] + [event.data['seconds']])[-self.max_samples:]
+
+            elif event.name == 'complete':
+                if event.data.get('bytes') and event.data.get('throughput'):
+                    stats['throughput'] = self._average(stats['throughput'],
+                                                        event.data['throughput'])
+                stats['failures'] = 0
+
+            elif event.name == 'failure':
+                if isinstance(event.data.get('error'), _Cancelled):
+                    return
+                stats['failures'] += 1
+
+            else:
+                return
+
+            self._dirty = True
+
+    def expected_time(self, url, size=None, default=None):
+        """
+        The expected time in seconds to download ``size`` bytes (or just to
+        get the first byte) from the host of ``url``, doubled for each failure
+        since its last success. A host that has never responded is taken to
+        respond in ``default`` seconds, and `None` is returned if that is not
+        given.
+        """
+        stats = self._hosts.get(_host(url), dict(ttfb=None, throughput=None, failures=0))
+        seconds = stats['ttfb'] if stats['ttfb'] is not None else default
+        if seconds is None:
+            return None
+
+        if size and stats['throughput']:
+            seconds += size / stats['throughput']
+        return seconds * 2**min(stats['failures'], 10)
+
+    def rank(self, urls, size=None):
+        """
+        Order URLs from the fastest expected host to the slowest. Hosts with no
+        statistics rank as if they were average, so that they get tried, and
+        ties keep the given order.
+        """
+        urls = list(urls)
+        known = [t for t in (self.expected_time(url, size) for url in urls) if t is not None]
+        default = sum(known) / len(known) if known else 1.
+        return sorted(urls, key=lambda url: self.expected_time(url, size, default=default))
+
+    def ttfb_percentile(self, url, q, min_samples=5):
+        """
+        The ``q``-th percentile of the recent times to first byte from the host
+        of ``url``, or `None` with fewer than ``min_samples`` measurements.
+        """
+        stats = self._hosts.get(_host(url))
+        if stats is None or len(stats['samples']) < min_samples:
+            return None
+        return _percentile(sorted(stats['samples']), q)
+
+    def save(self):
+        """ Write the statistics to ``path``, if given and they have changed. """
+        if self.path is None or not self._dirty:
+            return
+
+        with self._lock:
+            data = json.dumps(self._hosts)
+            self._dirty = False
+
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(self.path)),
+                                        prefix='.hosts')
+        try:
+            with os.fdopen(fd, 'w') as f:
+                f.write(data)
+            os.replace(tmp_path, self.path)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+
+def fetch_mirrored(urls, cache_path, filename=None, scores=None, size=None,
+                   hedge_percentile=None, hedge_delay=None, **kwargs):
+    """
+    Download a file from whichever of its mirrors is expected to be fastest,
+    falling back to the others in turn if a download fails.
+
+    With ``hedge_percentile`` or ``hedge_delay``, a second request is sent to
+    the next mirror if the first has not received a response within that
+    time. The first of the two to finish is kept and the other is cancelled,
+    so that a stalled mirror only costs the delay.
+
+    Parameters
+    ----------
+    urls : iterable
+        The URLs of the mirrors of the file.
+    cache_path : str
+        The path to save the file.
+    filename : str (optional)
+        The filename to save this file as, locally. Default is the basename
+        of the first URL.
+    scores : `~astrodata.mirrors.HostScores` (optional)
+        Statistics to rank the mirrors with, which are updated from these
+        downloads (default is to try the mirrors in order).
+    size : int (optional)
+        The expected size of the file, to weigh throughput against latency
+        when ranking the mirrors.
+    hedge_percentile : float (optional)
+        Hedge after this percentile (e.g., 95) of the recent times to first
+        byte from the chosen mirror, once there are enough of them.
+    hedge_delay : float (optional)
+        Hedge after this many seconds when there is no percentile to use.
+    **kwargs
+        All other keyword arguments are passed to
+        `~astrodata.download.fetch_file`.
+
+    Returns
+    -------
+    result : `~astrodata.download.DownloadResult`
+    """
+    urls = list(urls)
+    if not urls:
+        raise ValueError("At least one URL is needed")
+
+    if filename is None:
+        filename = os.path.basename(urls[0])
+        if kwargs.get('decompress'):
+            filename, _ = strip_compression_suffix(filename)
+
+    _makedirs(cache_path)
+    if scores is not None:
+        urls = scores.rank(urls, size=size)
+
+    callback = kwargs.pop('event_callback', None)
+    if scores is not None:
+        callback = _chain(scores.record, callback)
+
+    # only a new download can be hedged -- an existing file is checked or
+    # refreshed in place
+    hedge = ((hedge_percentile is not None or hedge_delay is not None) and
+             (kwargs.get('overwrite') or not os.path.exists(os.path.join(cache_path,
+                                                                         filename))))
+
+    error = None
+    i = 0
+    while i < len(urls):
+        delay = None
+        if hedge and i + 1 < len(urls):
+            delay = hedge_delay
+            if hedge_percentile is not None and scores is not None:
+                percentile = scores.ttfb_percentile(urls[i], hedge_percentile)
+                if percentile is not None:
+                    delay = percentile
+
+        try:
+            if delay is not None:
+                return _hedged_single_flight(urls[i], urls[i+1], delay, cache_path,
+                                             filename, callback, scores, kwargs)
+            return fetch_file(urls[i], cache_path, filename=filename,
+                              event_callback=callback, **kwargs)
+        except Exception as e:
+            error = e
+
+        i += 1 if delay is None else 2
+
+    raise error
+
+def _chain(first, second):
+    if second is None:
+        return first
+
+    def _both(event):
+        first(event)
+        second(event)
+    return _both
+
+class _Racer(object):
+    """ The state of one download of a hedged pair. """
+
+    def __init__(self, url, path):
+        self.url = url
+        self.path = path
+        self.start = time.time()
+        self.first_byte = False
+        self.finished = False
+        self.cancelled = False
+        self.error = None
+
+def _hedged_single_flight(primary_url, secondary_url, delay, cache_path, filename,
+                          callback, scores, kwargs):
+    """
+    Call `_hedged` unless another thread is already fetching the file,
+    holding the file's lock against other processes, as `fetch_file` does.
+    """
+    if not kwargs.get('lock', True):
+        return _hedged(primary_url, secondary_url, delay, cache_path, filename,
+                       callback, scores, kwargs)
+
+    local_path = os.path.join(cache_path, filename)
+
+    def _locked():
+        with FileLock(_lock_path(local_path),
+                      timeout=kwargs.get('lock_timeout')) as file_lock:
+            if file_lock.waited and os.path.exists(local_path):
+                # another process has just fetched the file
+                return fetch_file(primary_url, cache_path, filename=filename,
+                                  event_callback=callback,
+                                  **dict(kwargs, lock=False, overwrite=False,
+                                         refresh=False))
+            return _hedged(primary_url, secondary_url, delay, cache_path, filename,
+                           callback, scores, kwargs)
+
+    result, _ = _flights.do(os.path.abspath(local_path), _locked)
+    return result
+
+def _hedged(primary_url, secondary_url, delay, cache_path, filename, callback,
+            scores, kwargs):
+    """
+    Download from ``primary_url``, and also from ``secondary_url`` if the
+    first has no response within ``delay`` seconds (keeping whichever
+    finishes first) or fails.
+    """
+    local_path = os.path.join(cache_path, filename)
+    condition = threading.Condition()
+    state = dict(result=None)
+    racers = []
+    progress_callback = kwargs.get('progress_callback')
+
+    def _start(url, show_progress):
+        # each download goes to its own directory so they cannot collide
+        racer = _Racer(url, tempfile.mkdtemp(dir=cache_path, prefix='.hedge'))
+        racers.append(racer)
+
+        def _event(event):
+            if event.name == 'ttfb':
+                with condition:
+                    racer.first_byte = True
+                    condition.notify_all()
+            if callback is not None:
+                callback(event)
+
+        def _progress(remote_url, bytes_read, total):
+            if racer.cancelled:
+                raise _Cancelled("Another mirror finished first")
+            if progress_callback is not None:
+                progress_callback(remote_url, bytes_read, total)
+
+        # the caller holds the lock of the final path
+        racer_kwargs = dict(kwargs, overwrite=True, resume=False, lock=False,
+                            show_progress=show_progress, progress_callback=_progress,
+                            event_callback=_event)
+
+        def _run():
+            try:
+                result = fetch_file(url, racer.path, filename=filename, **racer_kwargs)
+                with condition:
+                    if state['result'] is None:
+                        os.replace(result.local_path, local_path)
+                        state['result'] = result._replace(local_path=local_path)
+            except Exception as e:
+                racer.error = e
+            finally:
+                shutil.rmtree(racer.path, ignore_errors=True)
+                with condition:
+                    racer.finished = True
+                    condition.notify_all()
+
+        thread = threading.Thread(target=_run)
+        # a cancelled download stops at its next block, so don't wait for it
+        thread.daemon = True
+        thread.start()
+        return racer
+
+    primary = _start(primary_url, kwargs.get('show_progress', True))
+    with condition:
+        condition.wait_for(lambda: primary.first_byte or primary.finished, timeout=delay)
+        if primary.first_byte:
+            # it answered in time, so only fall back if it fails
+            condition.wait_for(lambda: primary.finished)
+
+    if state['result'] is None:
+        _start(secondary_url, False)
+
+    with condition:
+        condition.wait_for(lambda: state['result'] is not None or
+                           all(racer.finished for racer in racers))
+        for racer in racers:
+            racer.cancelled = True
+        result = state['result']
+
+    # a mirror that never answered is at least this slow
+    now = time.time()
+    for racer in racers:
+        if scores is not None and not racer.first_byte and not racer.finished:
+            scores.record(Event('ttfb', racer.url, now, dict(seconds=now - racer.start)))
+
+    if result is None:
+        raise racers[-1].error
+    return result
@@ -0,0 +1,250 @@
+""" Reusing persistent HTTP(S) connections across downloads """
+
+from __future__ import division, print_function
+
+# Standard library
+import atexit
+import io
+import socket
+import ssl
+import threading
+import time
+
+# Third party
+from astropy.extern.six.moves import http_client, urllib
+
+__all__ = ['ConnectionPool', 'default_pool']
+
+_connection_classes = {'http': http_client.HTTPConnection,
+                       'https': http_client.HTTPSConnection}
+_default_ports = {'http': 80, 'https': 443}
+
+# errors that mean a reused connection was closed by the server while idle
+_stale_errors = (http_client.BadStatusLine, http_client.CannotSendRequest,
+                 ConnectionError)
+
+class ConnectionPool(object):
+    """
+    A thread-safe pool of persistent HTTP and HTTPS connections, kept per
+    ``(scheme, host, port)`` so that many requests to one server only pay for
+    the TCP and TLS handshakes once.
+
+    Connections are only borrowed while a response is being read, so any
+    number of threads can make requests at once. Other URL schemes, and
+    requests that have to go through a proxy, are handed to
+    `urllib.request.urlopen` instead.
+
+    Parameters
+    ----------
+    maxsize : int (optional)
+        The maximum number of idle connections kept per host (default is 8).
+    idle_timeout : float (optional)
+        Close connections that have been idle for longer than this many
+        seconds (default is 60).
+    """
+
+    def __init__(self, maxsize=8, idle_timeout=60.):
+        self.maxsize = int(maxsize)
+        self.idle_timeout = float(idle_timeout)
+        self._idle = dict()
+        self._lock = threading.Lock()
+
+    def urlopen(self, request, timeout=10., max_redirects=5):
+        """
+        Make a request like `urllib.request.urlopen`, following redirects and
+        raising `~urllib.error.HTTPError` for responses other than 2xx.
+
+        Parameters
+        ----------
+        request : str or `urllib.request.Request`
+            The URL, or a request with extra headers.
+        timeout : float (optional)
+            The timeout in seconds for connecting and each read (default is
+            10).
+        max_redirects : int (optional)
+            The maximum number of redirects to follow (default is 5).
+
+        Returns
+        -------
+        response
+            A file-like response with ``info()``, ``getcode()``, ``geturl()``,
+            ``read()``, and ``readinto()``. Closing it after reading the whole
+            body returns the connection to the pool.
+        """
+        if not isinstance(request, urllib.request.Request):
+            request = urllib.request.Request(request)
+
+        url = request.get_full_url()
+        headers = dict((name.title(), value) for name, value in request.header_items())
+        headers.setdefault('User-Agent', 'astrodata')
+
+        for i in range(max_redirects + 1):
+            parts = urllib.parse.urlsplit(url)
+            if parts.scheme not in _connection_classes or self._proxied(parts):
+                return urllib.request.urlopen(urllib.request.Request(url, headers=headers),
+                                              timeout=timeout)
+
+            key = (parts.scheme, parts.hostname, parts.port or _default_ports[parts.scheme])
+            path = parts.path or '/'
+            if parts.query:
+                path = path + '?' + parts.query
+
+            conn, response = self._request(key, path, headers, timeout)
+            response = _PooledResponse(self, key, conn, response, url)
+
+            status = response.getcode()
+            if status in (301, 302, 303, 307, 308) and response.info().get('Location'):
+                response.discard()
+                url = urllib.parse.urljoin(url, response.info()['Location'])
+                continue
+
+            if not 200 <= status < 300:
+                body = response.discard()
+                raise urllib.error.HTTPError(url, status, response.reason,
+                                             response.info(), io.BytesIO(body))
+
+            return response
+
+        raise urllib.error.URLError("Too many redirects for {}".format(url))
+
+    def clear(self):
+        """ Close all idle connections. """
+        with self._lock:
+            idle, self._idle = self._idle, dict()
+
+        for connections in idle.values():
+            for conn, _ in connections:
+                conn.close()
+
+    def _proxied(self, parts):
+        proxies = urllib.request.getproxies()
+        return (parts.scheme in proxies and
+                not urllib.request.proxy_bypass(parts.hostname or ''))
+
+    def _request(self, key, path, headers, timeout):
+        """ Send a request on a pooled connection and return it with the response. """
+        while True:
+            conn = self._get(key)
+            reused = conn is not None
+            if conn is None:
+                scheme, host, port = key
+                kwargs = dict()
+                if scheme == 'https':
+                    kwargs['context'] = ssl.create_default_context()
+                conn = _connection_classes[scheme](host, port, timeout=timeout, **kwargs)
+
+            conn.timeout = timeout
+            if conn.sock is not None:
+                conn.sock.settimeout(timeout)
+
+            try:
+                conn.request('GET', path, headers=headers)
+                return conn, conn.getresponse()
+
+            except _stale_errors as e:
+                conn.close()
+                if reused:
+                    # the server dropped the idle connection, so try a new one
+                    continue
+                if isinstance(e, http_client.HTTPException):
+                    raise
+                raise urllib.error.URLError(e)
+
+            except (socket.error, ssl.SSLError) as e:
+                conn.close()
+                raise urllib.error.URLError(e)
+
+            except BaseException:
+                conn.close()
+                raise
+
+    def _get(self, key):
+        """ Take an idle connection to ``key``, or `None` if there is none. """
+        now = time.time()
+        expired = []
+        conn = None
+        with self._lock:
+            connections = self._idle.get(key, [])
+            while connections:
+                candidate, last_used = connections.pop()
+                if now - last_used > self.idle_timeout:
+                    expired.append(candidate)
+                else:
+                    conn = candidate
+                    break
+
+        for candidate in expired:
+            candidate.close()
+        return conn
+
+    def _put(self, key, conn):
+        """ Return a connection whose response has been read in full. """
+        with self._lock:
+            connections = self._idle.setdefault(key, [])
+            if len(connections) < self.maxsize:
+                connections.append((conn, time.time()))
+                return
+        conn.close()
+
+class _PooledResponse(object):
+    """ A response that hands its connection back to the pool when closed. """
+
+    def __init__(self, pool, key, conn, response, url):
+        self._pool = pool
+        self._key = key
+        self._conn = conn
+        self._response = response
+        self._url = url
+        self.reason = response.reason
+
+    def info(self):
+        return self._response.msg
+
+    def getcode(self):
+        return self._response.status
+
+    def geturl(self):
+        return self._url
+
+    def read(self, amt=None):
+        return self._response.read(amt)
+
+    def readinto(self, b):
+        return self._response.readinto(b)
+
+    def discard(self, limit=2**16):
+        """
+        Read and return a short body (e.g., of a redirect or error) so the
+        connection can be reused, and close the response.
+        """
+        body = b''
+        # the remaining length, which is zero for e.g. 304 responses
+        length = self._response.length
+        if length is not None and length <= limit:
+            try:
+                body = self._response.read()
+            except (http_client.HTTPException, socket.error):
+                pass
+        self.close()
+        return body
+
+    def close(self):
+        if self._conn is None:
+            return
+
+        conn, self._conn = self._conn, None
+        if self._response.isclosed() and not self._response.will_close:
+            self._pool._put(self._key, conn)
+        else:
+            # the rest of the body is still on the wire
+            self._response.close()
+            conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+default_pool = ConnectionPool()
+atexit.register(default_pool.clear)
@@ -0,0 +1,314 @@
+""" Sharing connections between hosts, and shaping the total bandwidth """
+
+from __future__ import division, print_function
+
+# Standard library
+from collections import OrderedDict, deque
+import concurrent.futures
+import errno
+import socket
+import threading
+import time
+
+# Third party
+from astropy.extern.six.moves import http_client, urllib
+
+# Package
+from .mirrors import _host
+
+__all__ = ['Scheduler', 'TokenBucket']
+
+# socket errors that suggest a host (or the path to it) is overloaded
+_congestion_errnos = (errno.ECONNRESET, errno.ECONNREFUSED, errno.ECONNABORTED,
+                      errno.EPIPE, errno.ETIMEDOUT)
+
+def _is_congestion(error):
+    """ Whether a download error is a sign to back off from its host. """
+    if isinstance(error, urllib.error.HTTPError):
+        return error.code == 429 or error.code >= 500
+    if isinstance(error, (urllib.error.URLError, socket.timeout,
+                          http_client.HTTPException)):
+        return True
+    return getattr(error, 'errno', None) in _congestion_errnos
+
+class TokenBucket(object):
+    """
+    Limit the rate at which bytes are consumed, across threads. Up to
+    ``burst`` bytes may be consumed at once after a quiet period, and callers
+    that go over the rate sleep until it is met again.
+
+    Parameters
+    ----------
+    rate : float
+        The long-term limit in bytes per second.
+    burst : float (optional)
+        The size of the bucket in bytes (default is one second of ``rate``).
+    """
+
+    def __init__(self, rate, burst=None):
+        self.rate = float(rate)
+        if self.rate <= 0:
+            raise ValueError("The rate must be positive, not {}".format(rate))
+        self.burst = float(burst) if burst is not None else self.rate
+        self._tokens = self.burst
+        self._last = time.time()
+        self._lock = threading.Lock()
+
+    def consume(self, n_bytes):
+        """ Take ``n_bytes`` from the bucket, sleeping if it runs dry. """
+        with self._lock:
+            now = time.time()
+            self._tokens = min(self.burst, self._tokens + (now - self._last) * self.rate)
+            self._last = now
+            # go into debt, so that later callers wait their turn behind this one
+            self._tokens -= n_bytes
+            wait = -self._tokens / self.rate
+
+        if wait > 0:
+            time.sleep(wait)
+
+class _HostState(object):
+    """
+    The concurrency window of one host, and what was measured through it. A
+    host without a ``max_limit`` has no window at all.
+    """
+
+    def __init__(self, limit, max_limit):
+        self.limit = float(limit) if max_limit is not None else None
+        self.max_limit = max_limit
+        self.active = 0
+        self.throughput = None
+        self.slow_start = True
+
+    @property
+    def capacity(self):
+        return int(self.limit) if self.limit is not None else None
+
+class Scheduler(object):
+    """
+    Run downloads from many hosts at once, optionally giving each host a
+    window of simultaneous connections that adapts to how it responds, and
+    optionally capping the total bandwidth. Without ``max_per_host``, only
+    the hosts in ``host_limits`` have a window, and calls to other hosts are
+    limited only by ``max_workers``.
+
+    Each host's window starts at ``initial_per_host`` connections and grows
+    by one per successful download until the first sign of trouble (as in
+    TCP slow start), then by one per window of successful downloads. It is
+    halved when a download from the host fails or is retried with a server
+    (429 or 5xx) or network error, and shrinks by one when the combined
+    throughput from the host drops as connections are added (judged only
+    from downloads of at least ``min_measured_bytes``, since the throughput
+    of small files is mostly latency). Free workers
+    always go to the host using the smallest share of its window, so a slow
+    archive does not hold up the others.
+
+    Pass `~astrodata.scheduler.Scheduler.record` as the ``event_callback``
+    and `~astrodata.scheduler.Scheduler.throttle` as the ``throttle`` of
+    `~astrodata.download.fetch_file`, or use
+    `~astrodata.download.download_files` with ``scheduler=``.
+
+    Parameters
+    ----------
+    max_per_host : int (optional)
+        The largest window of any host (default is no window).
+    initial_per_host : int (optional)
+        The window of a host before anything is known about it (default is 2).
+    host_limits : dict (optional)
+        The largest window of particular hosts, by ``host`` or ``host:port``,
+        instead of ``max_per_host``.
+    max_bandwidth : float (optional)
+        The limit on the total download rate in bytes per second (default is
+        no limit).
+    alpha : float (optional)
+        The weight of each new measurement in the moving average of the
+        throughput of a host (default is 0.3).
+    min_measured_bytes : int (optional)
+        The smallest download whose throughput is compared (default is 1M,
+        2**20).
+    """
+
+    def __init__(self, max_per_host=None, initial_per_host=2, host_limits=None,
+                 max_bandwidth=None, alpha=0.3, min_measured_bytes=2**20):
+        self.max_per_host = max(1, int(max_per_host)) if max_per_host is not None else None
+        self.initial_per_host = max(1, int(initial_per_host))
+        self.host_limits = dict((host, max(1, int(limit)))
+                                for host, limit in (host_limits or dict()).items())
+        self.alpha = float(alpha)
+        self.min_measured_bytes = int(min_measured_bytes)
+        self.bucket = TokenBucket(max_bandwidth) if max_bandwidth else None
+        self._hosts = dict()
+        self._condition = threading.Condition()
+
+    def _state(self, host):
+        state = self._hosts.get(host)
+        if state is None:
+            # limits may be given with or without the port
+            hostname = urllib.parse.urlsplit('//' + host).hostname
+            max_limit = self.host_limits.get(host, self.host_limits.get(hostname,
+                                                                        self.max_per_host))
+            initial = (min(self.initial_per_host, max_limit) if max_limit is not None
+                       else None)
+            state = self._hosts[host] = _HostState(initial, max_limit)
+        return state
+
+    def limits(self):
+        """
+        The current window of each host seen so far, by ``host[:port]``
+        (`None` for hosts without one).
+        """
+        with self._condition:
+            return dict((host, state.capacity) for host, state in self._hosts.items())
+
+    def throttle(self, n_bytes):
+        """ Account for ``n_bytes`` downloaded, sleeping to keep to ``max_bandwidth``. """
+        if self.bucket is not None:
+            self.bucket.consume(n_bytes)
+
+    def record(self, event):
+        """ Adapt the window of a host to a download `~astrodata.telemetry.Event`. """
+        host = _host(event.url) if event.url else None
+        if host is None:
+            return
+
+        with self._condition:
+            state = self._state(host)
+            if state.max_limit is None:
+                return
+
+            if event.name in ('retry', 'failure'):
+                if not _is_congestion(event.data.get('error')):
+                    return
+                state.limit = max(1., state.limit / 2.)
+                state.slow_start = False
+
+            elif event.name == 'complete':
+                throughput = event.data.get('throughput')
+                if not event.data.get('bytes') or not throughput:
+                    return
+
+                # what the host delivers over all of its connections together
+                measured = event.data['bytes'] >= self.min_measured_bytes
+                combined = throughput * max(1, state.active)
+                if (measured and state.throughput is not None and state.active > 1 and
+                        combined < 0.8 * state.throughput):
+                    # more connections only made things slower
+                    state.limit = max(1., state.limit - 1.)
+                    state.slow_start = False
+                elif state.slow_start:
+                    state.limit = min(state.max_limit, state.limit + 1.)
+                else:
+                    state.limit = min(state.max_limit, state.limit + 1. / state.limit)
+
+                if measured and state.throughput is None:
+                    state.throughput = combined
+                elif measured:
+                    state.throughput = ((1 - self.alpha) * state.throughput +
+                                        self.alpha * combined)
+
+            else:
+                return
+
+            self._condition.notify_all()
+
+    def _callback(self, callback):
+        if callback is None:
+            return self.record
+
+        def _both(event):
+            self.record(event)
+            callback(event)
+        return _both
+
+    def _next_host(self, pending):
+        """
+        Wait for a host with pending work and a free connection, preferring
+        the one using the least of its window. Returns ``_done`` once nothing
+        is pending. Must be called holding the condition.
+        """
+        while pending:
+            best = None
+            for host in pending:
+                if host is None:
+                    # local files don't use a connection
+                    return host
+                state = self._state(host)
+                if state.capacity is None:
+                    return host
+                if state.active < state.capacity:
+                    share = state.active / state.capacity
+                    if best is None or share < best[0]:
+                        best = (share, host)
+            if best is not None:
+                return best[1]
+            self._condition.wait()
+        return _done
+
+    def map(self, func, args_list, url_of=None, max_workers=8):
+        """
+        Call ``func(*args)`` for each item of ``args_list`` in a pool of
+        ``max_workers`` threads, starting each call once the host it
+        downloads from has a free connection. Calls for the same host start in
+        the order given.
+
+        Parameters
+        ----------
+        func : callable
+            The function that downloads one item.
+        args_list : iterable
+            The arguments of each call.
+        url_of : callable (optional)
+            A function of the arguments of a call giving the URL it downloads
+            (default is the first argument). Calls with local paths are not
+            limited.
+        max_workers : int (optional)
+            The largest number of calls running at once (default is 8).
+
+        Returns
+        -------
+        results : list
+            A list of ``(result, error)`` tuples in the same order as
+            ``args_list``.
+        """
+        args_list = list(args_list)
+        if url_of is None:
+            url_of = lambda args: args[0]
+
+        pending = OrderedDict()
+        for i, args in enumerate(args_list):
+            pending.setdefault(_host(url_of(args)), deque()).append(i)
+        results = [None] * len(args_list)
+
+        def _work():
+            while True:
+                with self._condition:
+                    host = self._next_host(pending)
+                    if host is _done:
+                        return
+                    i = pending[host].popleft()
+                    if not pending[host]:
+                        del pending[host]
+                    state = self._state(host) if host is not None else None
+                    if state is not None:
+                        state.active += 1
+
+                try:
+                    results[i] = (func(*args_list[i]), None)
+                except Exception as e:
+                    results[i] = (None, e)
+                finally:
+                    with self._condition:
+                        if state is not None:
+                            state.active -= 1
+                        self._condition.notify_all()
+
+        n_workers = max(1, min(int(max_workers), len(args_list)))
+        with concurrent.futures.ThreadPoolExecutor(max_workers=n_workers) as pool:
+            workers = [pool.submit(_work) for i in range(n_workers)]
+        for worker in workers:
+            worker.result()
+
+        return results
+
+# returned by _next_host when there is nothing left to do
+_done = object()
@@ -0,0 +1,175 @@
+""" A content-addressed store for deduplicating cached data files """
+
+from __future__ import division, print_function
+
+# Standard library
+import errno
+import hashlib
+import os
+import tempfile
+import uuid
+
+# Package
+from .fastcopy import copy_file
+
+__all__ = ['ObjectStore', 'hash_file']
+
+def hash_file(path, algorithm='sha256', block_size=2**20):
+    """
+    Compute the hex digest of a file, reading it in blocks.
+
+    Parameters
+    ----------
+    path : str
+        Path to the file.
+    algorithm : str (optional)
+        Any algorithm name supported by `hashlib` (default is ``'sha256'``).
+    block_size : int (optional)
+        The read block size (default is 1M, 2**20).
+
+    Returns
+    -------
+    digest : str
+    """
+    h = hashlib.new(algorithm)
+    _update_hash(h, path, block_size)
+    return h.hexdigest()
+
+def _update_hash(h, path, block_size=2**20):
+    with open(path, 'rb') as f:
+        block = f.read(block_size)
+        while block:
+            h.update(block)
+            block = f.read(block_size)
+
+def _parse_checksum(hash_algorithm, expected_checksum):
+    """
+    Work out the hash algorithm to use and the expected hex digest (or `None`)
+    from the ``hash_algorithm`` and ``expected_checksum`` arguments.
+    """
+    if expected_checksum is not None and ':' in expected_checksum:
+        prefix, expected_checksum = expected_checksum.split(':', 1)
+        if hash_algorithm is not None and hash_algorithm.lower() != prefix.lower():
+            raise ValueError("expected_checksum is a {0} digest but hash_algorithm is {1}"
+                             .format(prefix, hash_algorithm))
+        hash_algorithm = prefix
+
+    if hash_algorithm is None and expected_checksum is not None:
+        hash_algorithm = 'sha256'
+
+    if hash_algorithm is None:
+        return None, None
+
+    # fail early on an unknown algorithm
+    hashlib.new(hash_algorithm)
+
+    if expected_checksum is not None:
+        expected_checksum = expected_checksum.strip().lower()
+
+    return hash_algorithm.lower(), expected_checksum
+
+def _check_checksum(checksum, expected_checksum, source):
+    if expected_checksum is not None and checksum != expected_checksum:
+        raise IOError("Checksum mismatch for {0}: expected {1} but got {2}"
+                      .format(source, expected_checksum, checksum))
+
+class ObjectStore(object):
+    """
+    A store of file contents under ``<root>/.objects``, keyed by SHA-256
+    digest. Cached files are hardlinks (or, where that is impossible,
+    symlinks) to objects in the store, so identical files take up disk space
+    only once.
+
+    Parameters
+    ----------
+    root : str
+        The cache root.
+    """
+    algorithm = 'sha256'
+
+    def __init__(self, root):
+        self.root = os.path.join(root, '.objects')
+
+    def object_path(self, digest):
+        """ The path of the object with the given digest. """
+        return os.path.join(self.root, digest[:2], digest[2:])
+
+    def __contains__(self, digest):
+        return os.path.exists(self.object_path(digest))
+
+    def add(self, path, digest=None, move=False):
+        """
+        Add the contents of a file to the store, if not already present.
+
+        Parameters
+        ----------
+        path : str
+            The file to add.
+        digest : str (optional)
+            The SHA-256 digest of the file, if already known.
+        move : bool (optional)
+            Move the file into the store instead of copying it. The file is
+            removed if the store already holds its contents (default is
+            ``False``).
+
+        Returns
+        -------
+        digest : str
+        """
+        if digest is None:
+            digest = hash_file(path, self.algorithm)
+
+        object_path = self.object_path(digest)
+        if os.path.exists(object_path):
+            if move:
+                os.remove(path)
+            return digest
+
+        from .download import _makedirs
+        _makedirs(os.path.dirname(object_path))
+
+        if move:
+            try:
+                os.replace(path, object_path)
+                return digest
+            except OSError as e:
+                if e.errno != errno.EXDEV:
+                    raise
+
+        # copy to a temporary file first so that a partial copy is never
+        # mistaken for a complete object
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(object_path))
+        os.close(fd)
+        try:
+            copy_file(path, tmp_path)
+            os.replace(tmp_path, object_path)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+
+        if move:
+            os.remove(path)
+
+        return digest
+
+    def link(self, digest, path):
+        """
+        Make ``path`` a hardlink to the object with the given digest, falling
+        back to a symlink if a hardlink is not possible. Any existing file at
+        ``path`` is replaced.
+        """
+        object_path = self.object_path(digest)
+        tmp_path = os.path.join(os.path.dirname(path),
+                                '.{0}.{1}.link'.format(os.path.basename(path),
+                                                       uuid.uuid4().hex))
+        try:
+            os.link(object_path, tmp_path)
+        except OSError:
+            # e.g., a different filesystem or too many links to the object
+            os.symlink(object_path, tmp_path)
+
+        os.replace(tmp_path, path)
+        if os.path.lexists(tmp_path):
+            # renaming over another link to the same file does nothing
+            os.remove(tmp_path)
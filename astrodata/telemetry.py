@@ -0,0 +1,211 @@
+""" Events and timing statistics for downloads and cache operations """
+
+from __future__ import division, print_function
+
+# Standard library
+from collections import defaultdict, deque, namedtuple
+import contextlib
+import os
+import tempfile
+import threading
+import time
+
+__all__ = ['Event', 'Stats', 'add_listener', 'remove_listener']
+
+Event = namedtuple('Event', ['name', 'url', 'timestamp', 'data'])
+Event.__doc__ = """
+A telemetry event. Downloads emit ``'start'``, ``'ttfb'`` (with the
+``seconds`` until the response headers arrived), ``'retry'`` (with the
+``attempt`` number and the ``error``), ``'complete'`` (with the ``bytes``
+transferred, ``seconds``, and ``throughput`` in bytes per second), and
+``'failure'`` (with the ``error`` and ``seconds``) events. Timed cache
+operations emit ``'operation'`` events with the ``operation`` name and
+``seconds``, and no ``url``.
+"""
+
+_listeners = []
+
+def add_listener(listener):
+    """
+    Call ``listener(event)`` with every `~astrodata.telemetry.Event` emitted
+    in this process, from whichever thread emits it.
+    """
+    _listeners.append(listener)
+
+def remove_listener(listener):
+    """ Stop sending events to a listener added with `add_listener`. """
+    _listeners.remove(listener)
+
+def emit(callback, name, url=None, **data):
+    """ Send an event to all listeners and to ``callback``, if given. """
+    event = Event(name, url, time.time(), data)
+    for listener in list(_listeners):
+        listener(event)
+    if callback is not None:
+        callback(event)
+
+def _percentile(sorted_values, q):
+    """ The nearest-rank ``q``-th percentile of a sorted list. """
+    index = int(round(q / 100. * (len(sorted_values) - 1)))
+    return sorted_values[index]
+
+class _Timing(object):
+    """
+    The count, total, and maximum of a series of durations, and its most
+    recent values for percentiles, so memory stays bounded however long the
+    series runs.
+    """
+
+    def __init__(self, max_samples):
+        self.count = 0
+        self.total = 0.
+        self.max = None
+        self.recent = deque(maxlen=max_samples)
+
+    def append(self, seconds):
+        self.count += 1
+        self.total += seconds
+        self.max = seconds if self.max is None else max(self.max, seconds)
+        self.recent.append(seconds)
+
+class Stats(object):
+    """
+    Aggregate telemetry events into totals and latency percentiles. Pass
+    `~astrodata.telemetry.Stats.record` as an event callback, or use
+    `~astrodata.telemetry.Stats.timed` to time an operation.
+
+    Parameters
+    ----------
+    max_samples : int (optional)
+        The number of recent durations of each operation kept for the
+        percentiles (default is 1024). Counts, totals, and maxima cover all
+        of them.
+    """
+    quantiles = (50, 90, 99)
+
+    def __init__(self, max_samples=1024):
+        self._lock = threading.Lock()
+        self._counts = defaultdict(int)
+        self._bytes = 0
+        self._timings = defaultdict(lambda: _Timing(int(max_samples)))
+
+    def record(self, event):
+        """ Add an `~astrodata.telemetry.Event` to the statistics. """
+        with self._lock:
+            if event.name == 'start':
+                self._counts['downloads_started'] += 1
+
+            elif event.name == 'ttfb':
+                self._timings['ttfb'].append(event.data['seconds'])
+
+            elif event.name == 'retry':
+                self._counts['retries'] += 1
+
+            elif event.name == 'complete':
+                self._counts['downloads_completed'] += 1
+                self._bytes += event.data['bytes']
+                self._timings['download'].append(event.data['seconds'])
+
+            elif event.name == 'failure':
+                self._counts['downloads_failed'] += 1
+
+            elif event.name == 'operation':
+                self._timings[event.data['operation']].append(event.data['seconds'])
+
+    @contextlib.contextmanager
+    def timed(self, operation, callback=None):
+        """
+        Time the body of a ``with`` statement as an ``'operation'`` event,
+        which is recorded here and sent to any listeners and ``callback``.
+        """
+        start = time.time()
+        try:
+            yield
+        finally:
+            seconds = time.time() - start
+            emit(self._callback(callback), 'operation', operation=operation,
+                 seconds=seconds)
+
+    def _callback(self, callback):
+        if callback is None:
+            return self.record
+
+        def _both(event):
+            self.record(event)
+            callback(event)
+        return _both
+
+    def summary(self):
+        """
+        Return the statistics as a dictionary with the download counts, the
+        total ``bytes`` downloaded, and per-operation ``timings`` (``'ttfb'``,
+        ``'download'``, and any timed cache operations) giving the ``count``,
+        ``total``, ``mean``, ``max``, and percentiles (``p50``, ``p90``,
+        ``p99``, over the most recent durations) in seconds.
+        """
+        with self._lock:
+            summary = dict(downloads_started=0, downloads_completed=0,
+                           downloads_failed=0, retries=0)
+            summary.update(self._counts)
+            summary['bytes'] = self._bytes
+
+            timings = dict()
+            for name, series in self._timings.items():
+                values = sorted(series.recent)
+                timing = dict(count=series.count, total=series.total,
+                              mean=series.total / series.count, max=series.max)
+                for q in self.quantiles:
+                    timing['p{0}'.format(q)] = _percentile(values, q)
+                timings[name] = timing
+            summary['timings'] = timings
+
+        return summary
+
+    def write_prometheus(self, path, prefix='astrodata'):
+        """
+        Write the statistics in the Prometheus text exposition format, e.g.
+        for the node exporter's textfile collector. The file is replaced
+        atomically so that a scrape never sees a partial file.
+        """
+        summary = self.summary()
+        lines = []
+
+        def _metric(name, kind, help, samples):
+            lines.append('# HELP {0}_{1} {2}'.format(prefix, name, help))
+            lines.append('# TYPE {0}_{1} {2}'.format(prefix, name, kind))
+            for suffix, labels, value in samples:
+                label_str = ','.join('{0}="{1}"'.format(k, v) for k, v in labels)
+                if label_str:
+                    label_str = '{' + label_str + '}'
+                lines.append('{0}_{1}{2}{3} {4!r}'.format(prefix, name, suffix,
+                                                           label_str, value))
+
+        _metric('downloads_total', 'counter', 'Downloads by outcome.',
+                [('', [('status', status)], summary['downloads_' + status])
+                 for status in ('started', 'completed', 'failed')])
+        _metric('download_retries_total', 'counter', 'Download retries.',
+                [('', [], summary['retries'])])
+        _metric('download_bytes_total', 'counter', 'Bytes downloaded.',
+                [('', [], summary['bytes'])])
+
+        samples = []
+        for name, timing in sorted(summary['timings'].items()):
+            for q in self.quantiles:
+                samples.append(('', [('operation', name), ('quantile', q / 100.)],
+                                timing['p{0}'.format(q)]))
+            samples.append(('_sum', [('operation', name)], timing['total']))
+            samples.append(('_count', [('operation', name)], timing['count']))
+        _metric('operation_seconds', 'summary',
+                'Latency of downloads and cache operations.', samples)
+
+        dirname = os.path.dirname(os.path.abspath(path))
+        fd, tmp_path = tempfile.mkstemp(dir=dirname, prefix='.prom')
+        try:
+            with os.fdopen(fd, 'w') as f:
+                f.write('\n'.join(lines) + '\n')
+            os.chmod(tmp_path, 0o644)
+            os.replace(tmp_path, path)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
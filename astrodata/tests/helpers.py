@@ -0,0 +1,204 @@
+""" Helpers for testing downloads against a local HTTP server """
+
+from __future__ import (absolute_import, division, print_function,
+                        unicode_literals)
+
+# Standard library
+import email.utils
+import os
+import threading
+import time
+
+# Third-party
+from astropy.extern.six.moves import BaseHTTPServer, socketserver
+
+__all__ = ['LocalHTTPServer']
+
+class _FileHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """
+    Serve files with ``ETag`` and ``Last-Modified`` validators, answering
+    conditional requests with 304 (Not Modified) and, if the server allows
+    it, byte ranges (with 416 for a range past the end of the file). The server can also be told to drop the
+    connection part-way through a file, to fail requests outright, or to
+    stall before responding.
+    Connections are kept alive between requests.
+    """
+    protocol_version = 'HTTP/1.1'
+
+    # drop idle keep-alive connections eventually
+    timeout = 5
+
+    def setup(self):
+        BaseHTTPServer.BaseHTTPRequestHandler.setup(self)
+        self.server.connections += 1
+
+    def _path(self):
+        path = self.path.split('?', 1)[0].split('#', 1)[0]
+        return os.path.join(self.server.root, *path.strip('/').split('/'))
+
+    def _etag(self, stat):
+        return '"{0:x}-{1:x}"'.format(int(stat.st_mtime * 1e6), stat.st_size)
+
+    def do_HEAD(self):
+        self._respond(send_body=False)
+
+    def do_GET(self):
+        self._respond(send_body=True)
+
+    def _respond(self, send_body):
+        self.server.requests.append((self.command, self.path, dict(self.headers)))
+        name = self.path.lstrip('/')
+
+        seconds, times = self.server.delays.get(name, (0, 0))
+        if times > 0:
+            self.server.delays[name] = (seconds, times - 1)
+            time.sleep(seconds)
+
+        if self.server.errors.get(name):
+            self.server.errors[name] -= 1
+            self.send_error(503)
+            return
+
+        path = self._path()
+        if not os.path.isfile(path):
+            self.send_error(404)
+            return
+
+        with open(path, 'rb') as f:
+            data = f.read()
+        stat = os.stat(path)
+        etag = self._etag(stat)
+
+        if self._not_modified(stat, etag):
+            self.send_response(304)
+            self.send_header('ETag', etag)
+            self.send_header('Last-Modified', self.date_time_string(stat.st_mtime))
+            self.end_headers()
+            return
+
+        start, end = 0, len(data)
+        status = 200
+        range_header = self.headers.get('Range')
+        if_range = self.headers.get('If-Range')
+        if (self.server.ranges and range_header and range_header.startswith('bytes=') and
+                (if_range is None or if_range == etag)):
+            first, _, last = range_header[len('bytes='):].partition('-')
+            start = int(first)
+            end = int(last) + 1 if last else len(data)
+            status = 206
+            if start >= len(data):
+                self.send_response(416)
+                self.send_header('Content-Range', 'bytes */{}'.format(len(data)))
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return
+
+        self.send_response(status)
+        self.send_header('Content-Length', str(end - start))
+        self.send_header('ETag', etag)
+        self.send_header('Last-Modified', self.date_time_string(stat.st_mtime))
+        if self.server.ranges:
+            self.send_header('Accept-Ranges', 'bytes')
+        if status == 206:
+            self.send_header('Content-Range', 'bytes {0}-{1}/{2}'.format(start, end-1, len(data)))
+        self.end_headers()
+
+        if not send_body:
+            return
+
+        # optionally drop the connection part-way through
+        if self.server.truncate.get(name):
+            self.server.truncate[name] -= 1
+            end = start + (end - start) // 2
+            self.close_connection = True
+
+        self.wfile.write(data[start:end])
+
+    def _not_modified(self, stat, etag):
+        if_none_match = self.headers.get('If-None-Match')
+        if if_none_match is not None:
+            # If-Modified-Since is ignored when If-None-Match is present
+            tags = [tag.strip() for tag in if_none_match.split(',')]
+            return etag in tags or '*' in tags
+
+        if_modified_since = self.headers.get('If-Modified-Since')
+        if if_modified_since is not None:
+            since = email.utils.parsedate_tz(if_modified_since)
+            return since is not None and int(stat.st_mtime) <= email.utils.mktime_tz(since)
+
+        return False
+
+    def log_message(self, format, *args):
+        pass
+
+class _ThreadingHTTPServer(socketserver.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+class LocalHTTPServer(object):
+    """
+    Serve the files in a directory over HTTP from a background thread.
+
+    Use as a context manager::
+
+        with LocalHTTPServer(path) as server:
+            download_file(server.url('file.dat'), cache_path)
+
+    Parameters
+    ----------
+    root : str
+        The directory to serve.
+    ranges : bool (optional)
+        Whether to honor HTTP Range requests (default is ``True``).
+    """
+    handler_class = _FileHandler
+
+    def __init__(self, root, ranges=True):
+        self.root = root
+        self.ranges = ranges
+
+    def truncate(self, name, times=1):
+        """ Send only half of the file ``name`` for the next ``times`` requests. """
+        self._server.truncate[name] = times
+
+    def fail(self, name, times=1):
+        """ Respond with a 503 error for the next ``times`` requests of ``name``. """
+        self._server.errors[name] = times
+
+    def delay(self, name, seconds, times=1):
+        """ Wait ``seconds`` before responding to the next ``times`` requests of ``name``. """
+        self._server.delays[name] = (seconds, times)
+
+    def url(self, name):
+        return 'http://127.0.0.1:{0}/{1}'.format(self.port, name)
+
+    @property
+    def connections(self):
+        """ The number of connections accepted so far. """
+        return self._server.connections
+
+    @property
+    def requests(self):
+        """ ``(method, path, headers)`` for all requests handled so far. """
+        return self._server.requests
+
+    def __enter__(self):
+        self._server = _ThreadingHTTPServer(('127.0.0.1', 0), self.handler_class)
+        self._server.root = self.root
+        self._server.ranges = self.ranges
+        self._server.requests = []
+        self._server.truncate = dict()
+        self._server.errors = dict()
+        self._server.delays = dict()
+        self._server.connections = 0
+        self.port = self._server.server_address[1]
+
+        self._thread = threading.Thread(target=self._server.serve_forever,
+                                        kwargs=dict(poll_interval=0.05))
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def __exit__(self, *args):
+        self._server.shutdown()
+        self._server.server_close()
+        self._thread.join()
@@ -0,0 +1,160 @@
+from __future__ import (absolute_import, division, print_function,
+                        unicode_literals)
+
+# Standard library
+import asyncio
+import os
+try:
+    from ConfigParser import ConfigParser
+except ImportError:
+    from configparser import ConfigParser
+
+# Third-party
+import astropy.units as u
+from astropy.extern.six.moves import urllib
+from astropy.tests.helper import pytest
+
+# Package
+from ..async_download import async_download_file
+from ..cache import Cache
+
+class AsyncHTTPStandIn(object):
+    """
+    A minimal HTTP server on asyncio streams that serves bytes from a dict,
+    with optional chunked encoding, redirects, stalls, and connections dropped
+    part-way through a file.
+    """
+    def __init__(self, files, chunked=False):
+        self.files = files
+        self.chunked = chunked
+        self.redirects = dict()
+        self.stall = set()
+        self.truncate = set()
+
+    def url(self, name):
+        return 'http://127.0.0.1:{0}/{1}'.format(self.port, name)
+
+    async def _handle(self, reader, writer):
+        request_line = (await reader.readline()).decode('latin-1')
+        while (await reader.readline()).strip():
+            pass
+        name = request_line.split(' ')[1].lstrip('/')
+
+        if name in self.stall:
+            await asyncio.sleep(10)
+
+        if name in self.redirects:
+            writer.write('HTTP/1.1 302 Found\r\nLocation: /{}\r\nContent-Length: 0\r\n\r\n'
+                         .format(self.redirects[name]).encode('latin-1'))
+
+        elif name not in self.files:
+            writer.write(b'HTTP/1.1 404 Not Found\r\nContent-Length: 0\r\n\r\n')
+
+        elif self.chunked:
+            writer.write(b'HTTP/1.1 200 OK\r\nTransfer-Encoding: chunked\r\n\r\n')
+            data = self.files[name]
+            if name in self.truncate:
+                data = data[:len(data) // 2]
+            for i in range(0, len(data), 1000):
+                chunk = data[i:i+1000]
+                writer.write('{:x}\r\n'.format(len(chunk)).encode('latin-1') + chunk + b'\r\n')
+            if name not in self.truncate:
+                writer.write(b'0\r\n\r\n')
+
+        else:
+            data = self.files[name]
+            header = ('HTTP/1.1 200 OK\r\nContent-Length: {}\r\n\r\n'
+                      .format(len(data)).encode('latin-1'))
+            if name in self.truncate:
+                data = data[:len(data) // 2]
+            writer.write(header + data)
+
+        await writer.drain()
+        writer.close()
+
+    async def __aenter__(self):
+        self._server = await asyncio.start_server(self._handle, '127.0.0.1', 0)
+        self.port = self._server.sockets[0].getsockname()[1]
+        return self
+
+    async def __aexit__(self, *args):
+        self._server.close()
+        await self._server.wait_closed()
+
+def _files(n, size=10000):
+    return dict(('data{}.dat'.format(i), os.urandom(size)) for i in range(n))
+
+@pytest.mark.parametrize('chunked', [False, True])
+def test_async_download_file(tmpdir, chunked):
+    files = _files(1)
+    download_path = str(tmpdir.join('download'))
+    progress = []
+
+    async def main():
+        async with AsyncHTTPStandIn(files, chunked=chunked) as server:
+            server.redirects['moved.dat'] = 'data0.dat'
+
+            local_path = await async_download_file(server.url('data0.dat'), download_path,
+                                                   block_size=4096,
+                                                   progress_callback=lambda *a: progress.append(a))
+            with open(local_path, 'rb') as f:
+                assert f.read() == files['data0.dat']
+            assert progress[-1][1] == 10000
+
+            local_path = await async_download_file(server.url('moved.dat'), download_path)
+            with open(local_path, 'rb') as f:
+                assert f.read() == files['data0.dat']
+
+            with pytest.raises(urllib.error.HTTPError):
+                await async_download_file(server.url('nonexistentfile'), download_path)
+
+            # a dropped connection is reported like a failed one
+            server.truncate.add('data0.dat')
+            with pytest.raises(urllib.error.URLError):
+                await async_download_file(server.url('data0.dat'), download_path,
+                                          filename='truncated.dat')
+
+            server.stall.add('slow.dat')
+            with pytest.raises(urllib.error.URLError):
+                await async_download_file(server.url('slow.dat'), download_path,
+                                          timeout=0.1*u.second)
+
+    asyncio.run(main())
+
+    # no temporary files are left behind
+    assert sorted(os.listdir(download_path)) == ['data0.dat', 'moved.dat']
+
+def test_cache_async(tmpdir):
+    config_path = str(tmpdir.join('.testconfig'))
+    repo_path = str(tmpdir.join('astrodata'))
+    conf = ConfigParser()
+    conf.add_section('astrodata')
+    conf.set('astrodata', 'repository_path', repo_path)
+    with open(config_path, 'w') as configfile:
+        conf.write(configfile)
+
+    files = _files(16)
+
+    async def main():
+        async with AsyncHTTPStandIn(files) as server:
+            with Cache(config_path) as cache:
+                local_path = await cache.aadd_data('sdss', server.url('data0.dat'),
+                                                   local_name='bob')
+                assert cache.get_entry('sdss', 'bob')['source'] == server.url('data0.dat')
+
+                items = [('gaia/dr1', server.url(name)) for name in sorted(files)]
+                items.append(('gaia/dr1', server.url('nonexistentfile')))
+                results = await cache.afetch_many(items, max_concurrent=4)
+                return server, local_path, results
+
+    server, local_path, results = asyncio.run(main())
+
+    with open(local_path, 'rb') as f:
+        assert f.read() == files['data0.dat']
+    assert all(r.error is None for r in results[:-1])
+    assert isinstance(results[-1].error, urllib.error.HTTPError)
+
+    with Cache(config_path) as cache:
+        assert len(cache.schema['gaia']['dr1']) == 16
+        for name in files:
+            assert cache.get_entry('gaia/dr1', name)['source'] == server.url(name)
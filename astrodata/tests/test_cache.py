@@ -2,8 +2,14 @@ from __future__ import (absolute_import, division, print_function,
                         unicode_literals)
 
 # Standard library
+import errno
+import gzip
+import hashlib
+import json
 import os
 import shutil
+import threading
+import time
 try:
     from ConfigParser import ConfigParser
 except ImportError:
@@ -16,6 +22,8 @@ import numpy as np
 
 # Package
 from ..cache import Cache
+from ..catalog import JSONCatalog
+from .helpers import LocalHTTPServer
 
 def _check_schema(cache, sub_path, local_name):
     sub_schema = cache.schema
@@ -152,3 +160,748 @@ class TestCache(object):
         assert os.path.exists(data_file)
 
         add_data_helper(self.config_path, self.repo_path, data_file)
+
+    def test_add_data_many(self):
+        data_files = []
+        for i in range(4):
+            data_file = os.path.join(self.tmpdir, 'test-data{}.dat'.format(i))
+            np.savetxt(data_file, np.random.random(size=(16,5)))
+            data_files.append(data_file)
+
+        missing_file = os.path.join(self.tmpdir, 'nonexistentfile')
+        items = [('sdss/apogee/dr13', data_files[0]),
+                 ('sdss/apogee/dr13', data_files[1], 'bob'),
+                 ('sdss/apogee/dr13', missing_file, 'alice'),
+                 ('gaia/dr1', data_files[2]),
+                 ('gaia/dr1', data_files[3], 'tgas.dat')]
+
+        with Cache(self.config_path) as cache:
+            results = cache.add_data_many(items)
+
+        assert [r.source for r in results] == [item[1] for item in items]
+        assert results[2].local_path is None
+        assert isinstance(results[2].error, ValueError)
+        for i in [0, 1, 3, 4]:
+            assert results[i].error is None
+            assert os.path.exists(results[i].local_path)
+
+        with Cache(self.config_path) as cache:
+            _check_schema(cache, 'sdss/apogee/dr13', 'test-data0.dat')
+            _check_schema(cache, 'sdss/apogee/dr13', 'bob')
+            _check_schema(cache, 'gaia/dr1', 'test-data2.dat')
+            _check_schema(cache, 'gaia/dr1', 'tgas.dat')
+            assert len(cache.schema['sdss']['apogee']['dr13']) == 2
+            assert cache.get_entry('gaia/dr1', 'tgas.dat')['source'] == data_files[3]
+
+    def test_deduplicate(self):
+        data_file = os.path.join(self.tmpdir, 'test-data.dat')
+        np.savetxt(data_file, np.random.random(size=(128,5)))
+
+        with Cache(self.config_path) as cache:
+            path1 = cache.add_data('sdss/apogee/dr13', data_file, local_name='bob',
+                                   deduplicate=True)
+            path2 = cache.add_data('gaia/dr1', data_file, local_name='alice',
+                                   deduplicate=True)
+
+            entry = cache.get_entry('sdss/apogee/dr13', 'bob')
+            assert cache.get_entry('gaia/dr1', 'alice')['sha256'] == entry['sha256']
+
+            object_path = cache.objects.object_path(entry['sha256'])
+            assert os.stat(path1).st_ino == os.stat(object_path).st_ino
+            assert os.stat(path2).st_ino == os.stat(object_path).st_ino
+
+            # replacing a linked file without deduplication leaves the object alone
+            other_file = os.path.join(self.tmpdir, 'other-data.dat')
+            np.savetxt(other_file, np.random.random(size=(16,5)))
+            cache.add_data('gaia/dr1', other_file, local_name='alice')
+            with open(object_path) as f1, open(data_file) as f2:
+                assert f1.read() == f2.read()
+
+            # moving a file in only renames it into the store
+            cache.add_data('gaia/dr2', other_file, deduplicate=True, delete_source=True)
+            assert not os.path.exists(other_file)
+            assert 'sha256' in cache.get_entry('gaia/dr2', 'other-data.dat')
+
+    def test_hardlink(self):
+        data_file = os.path.join(self.tmpdir, 'test-data.dat')
+        np.savetxt(data_file, np.random.random(size=(128,5)))
+
+        with Cache(self.config_path) as cache:
+            path = cache.add_data('sdss/apogee/dr13', data_file, hardlink=True,
+                                  hash_algorithm='md5')
+            assert os.stat(path).st_ino == os.stat(data_file).st_ino
+            assert 'md5' in cache.get_entry('sdss/apogee/dr13', 'test-data.dat')
+
+            # a plain copy is a separate file
+            path = cache.add_data('gaia/dr1', data_file)
+            assert os.stat(path).st_ino != os.stat(data_file).st_ino
+
+            inode = os.stat(data_file).st_ino
+            path = cache.add_data('gaia/dr2', data_file, delete_source=True)
+            assert not os.path.exists(data_file)
+            assert os.stat(path).st_ino == inode
+
+    def test_refresh(self):
+        serve_path = os.path.join(self.tmpdir, 'serve')
+        os.makedirs(serve_path)
+        serve_file = os.path.join(serve_path, 'data.dat')
+        np.savetxt(serve_file, np.random.random(size=(128,5)))
+
+        with LocalHTTPServer(serve_path) as server:
+            with Cache(self.config_path) as cache:
+                cache.add_data('sdss/apogee/dr13', server.url('data.dat'))
+                entry = cache.get_entry('sdss/apogee/dr13', 'data.dat')
+                assert entry['content_length'] == os.path.getsize(serve_file)
+                assert 'etag' in entry and 'last_modified' in entry
+
+                # adding the file again uses it as it is, and keeps its validators
+                n_requests = len(server.requests)
+                cache.add_data('sdss/apogee/dr13', server.url('data.dat'))
+                assert len(server.requests) == n_requests
+                new_entry = cache.get_entry('sdss/apogee/dr13', 'data.dat')
+                for key in ('etag', 'last_modified', 'content_length', 'download_datetime'):
+                    assert new_entry[key] == entry[key]
+
+                # only a conditional request is made for an unchanged file
+                n_requests = len(server.requests)
+                cache.add_data('sdss/apogee/dr13', server.url('data.dat'), refresh=True)
+                assert len(server.requests) == n_requests + 1
+                assert server.requests[-1][2]['If-None-Match'] == entry['etag']
+                new_entry = cache.get_entry('sdss/apogee/dr13', 'data.dat')
+                assert new_entry['download_datetime'] == entry['download_datetime']
+
+                np.savetxt(serve_file, np.random.random(size=(16,5)))
+                local_path = cache.add_data('sdss/apogee/dr13', server.url('data.dat'),
+                                            refresh=True)
+                with open(local_path) as f1, open(serve_file) as f2:
+                    assert f1.read() == f2.read()
+                new_entry = cache.get_entry('sdss/apogee/dr13', 'data.dat')
+                assert new_entry['etag'] != entry['etag']
+
+    def test_refresh_checksum(self, monkeypatch):
+        serve_path = os.path.join(self.tmpdir, 'serve')
+        os.makedirs(serve_path)
+        np.savetxt(os.path.join(serve_path, 'data.dat'), np.random.random(size=(128,5)))
+
+        with LocalHTTPServer(serve_path) as server, Cache(self.config_path) as cache:
+            cache.add_data('sdss/apogee/dr13', server.url('data.dat'), hash_algorithm='md5')
+            checksum = cache.get_entry('sdss/apogee/dr13', 'data.dat')['md5']
+
+            # an unchanged file is not read again to hash it
+            from .. import download
+            def _hash_file(*args, **kwargs):
+                raise AssertionError("the file was hashed again")
+            monkeypatch.setattr(download, 'hash_file', _hash_file)
+            cache.add_data('sdss/apogee/dr13', server.url('data.dat'), hash_algorithm='md5')
+            assert cache.get_entry('sdss/apogee/dr13', 'data.dat')['md5'] == checksum
+            cache.add_data('sdss/apogee/dr13', server.url('data.dat'), hash_algorithm='md5',
+                           refresh=True)
+            assert server.requests[-1][2]['If-None-Match'] is not None
+            assert cache.get_entry('sdss/apogee/dr13', 'data.dat')['md5'] == checksum
+
+    def test_mirrors(self):
+        serve_path = os.path.join(self.tmpdir, 'serve')
+        os.makedirs(serve_path)
+        np.savetxt(os.path.join(serve_path, 'data.dat'), np.random.random(size=(128,5)))
+
+        with LocalHTTPServer(serve_path) as bad, LocalHTTPServer(serve_path) as good:
+            bad.fail('data.dat', times=10)
+            with Cache(self.config_path) as cache:
+                cache.add_data('sdss/apogee/dr13', bad.url('data.dat'),
+                               mirrors=[good.url('data.dat')])
+                entry = cache.get_entry('sdss/apogee/dr13', 'data.dat')
+                assert entry['source'] == bad.url('data.dat')
+                assert entry['mirrors'] == [good.url('data.dat')]
+                assert cache.check_state(full=True)
+
+            # what was learned about the hosts is kept
+            assert os.path.exists(os.path.join(self.repo_path, '.hosts.json'))
+            with Cache(self.config_path) as cache:
+                assert cache.hosts.rank([bad.url('x'), good.url('x')])[0] == good.url('x')
+
+    def test_upstream(self):
+        serve_path = os.path.join(self.tmpdir, 'serve')
+        os.makedirs(serve_path)
+        for name in ('a.dat', 'b.dat', 'c.dat'):
+            np.savetxt(os.path.join(serve_path, name), np.random.random(size=(16,5)))
+
+        # a shared repository, filled from the origin
+        upstream_path = os.path.join(self.tmpdir, 'upstream')
+        upstream_config = os.path.join(self.tmpdir, '.upstreamconfig')
+        conf = ConfigParser()
+        conf.add_section('astrodata')
+        conf.set('astrodata', 'repository_path', upstream_path)
+        with open(upstream_config, 'w') as configfile:
+            conf.write(configfile)
+
+        with LocalHTTPServer(serve_path) as origin:
+            with Cache(upstream_config) as upstream:
+                upstream.add_data('sdss/apogee/dr13', origin.url('a.dat'),
+                                  hash_algorithm='md5')
+                upstream.add_data('sdss/apogee/dr13', origin.url('b.dat'))
+            n_requests = len(origin.requests)
+
+            with LocalHTTPServer(upstream_path) as upstream_server:
+                self._set_config(upstream=upstream_path)
+                with Cache(self.config_path) as cache:
+                    local_path = cache.lookup('sdss/apogee/dr13', 'a.dat')
+                    assert local_path.startswith(cache.root)
+                    entry = cache.get_entry('sdss/apogee/dr13', 'a.dat')
+                    assert entry['source'] == origin.url('a.dat')
+                    assert 'md5' in entry
+                    assert cache.lookup('sdss/apogee/dr13', 'a.dat') == local_path
+
+                    # add_data reads through to upstream too
+                    cache.add_data('gaia/dr1', origin.url('b.dat'))
+                    assert cache.get_entry('gaia/dr1', 'b.dat')['source'] == origin.url('b.dat')
+                    assert len(origin.requests) == n_requests
+
+                    # a file that is not upstream comes from its source
+                    cache.lookup('sdss/apogee/dr13', 'c.dat', source=origin.url('c.dat'))
+                    assert len(origin.requests) == n_requests + 1
+                    with pytest.raises(IOError):
+                        cache.lookup('sdss/apogee/dr13', 'd.dat')
+                    assert cache.check_state(full=True)
+
+                # an upstream served over HTTP, with a damaged copy
+                shutil.rmtree(self.repo_path)
+                with open(os.path.join(upstream_path, 'sdss/apogee/dr13/a.dat'), 'a') as f:
+                    f.write('0')
+                self._set_config(upstream=upstream_server.url(''))
+                with Cache(self.config_path) as cache:
+                    cache.lookup('sdss/apogee/dr13', 'b.dat')
+                    assert len(origin.requests) == n_requests + 1
+
+                    with pytest.warns(UserWarning):
+                        local_path = cache.lookup('sdss/apogee/dr13', 'a.dat')
+                    assert len(origin.requests) == n_requests + 2
+                    with open(local_path) as f1, open(os.path.join(serve_path, 'a.dat')) as f2:
+                        assert f1.read() == f2.read()
+
+    def test_upstream_unreadable(self):
+        serve_path = os.path.join(self.tmpdir, 'serve')
+        os.makedirs(serve_path)
+        np.savetxt(os.path.join(serve_path, 'a.dat'), np.random.random(size=(16,5)))
+
+        # an upstream whose schema is not a database at all
+        upstream_path = os.path.join(self.tmpdir, 'upstream')
+        os.makedirs(upstream_path)
+        with open(os.path.join(upstream_path, 'schema.db'), 'wb') as f:
+            f.write(b'not a database' * 100)
+
+        with LocalHTTPServer(serve_path) as origin:
+            self._set_config(upstream=upstream_path)
+            with Cache(self.config_path) as cache:
+                with pytest.warns(UserWarning):
+                    local_path = cache.lookup('sdss/apogee/dr13', 'a.dat',
+                                              source=origin.url('a.dat'))
+                assert os.path.exists(local_path)
+                assert len(origin.requests) == 1
+
+    def test_stats(self):
+        serve_path = os.path.join(self.tmpdir, 'serve')
+        os.makedirs(serve_path)
+        np.savetxt(os.path.join(serve_path, 'data.dat'), np.random.random(size=(128,5)))
+
+        with LocalHTTPServer(serve_path) as server:
+            with Cache(self.config_path) as cache:
+                cache.add_data('sdss/apogee/dr13', server.url('data.dat'))
+                stats = cache.stats()
+
+        assert stats['downloads_completed'] == 1
+        assert stats['bytes'] == os.path.getsize(os.path.join(serve_path, 'data.dat'))
+        assert stats['timings']['__init__']['count'] == 1
+        assert stats['timings']['add_data']['count'] == 1
+        assert stats['timings']['ttfb']['count'] == 1
+
+    def test_decompress(self):
+        serve_path = os.path.join(self.tmpdir, 'serve')
+        os.makedirs(serve_path)
+        data = np.random.random(size=(128,5)).tobytes()
+        with gzip.open(os.path.join(serve_path, 'data.dat.gz'), 'wb') as f:
+            f.write(data)
+
+        with LocalHTTPServer(serve_path) as server:
+            with Cache(self.config_path) as cache:
+                local_path = cache.add_data('sdss/apogee/dr13', server.url('data.dat.gz'),
+                                            decompress=True, hash_algorithm='sha256')
+                with open(local_path, 'rb') as f:
+                    assert f.read() == data
+
+                entry = cache.get_entry('sdss/apogee/dr13', 'data.dat')
+                assert entry['source'] == server.url('data.dat.gz')
+                assert entry['compression'] == 'gzip'
+                assert entry['size'] == len(data)
+                assert entry['source_size'] == os.path.getsize(os.path.join(serve_path,
+                                                                            'data.dat.gz'))
+                assert entry['sha256'] == hashlib.sha256(data).hexdigest()
+                assert entry['source_checksum'].startswith('sha256:')
+                assert cache.check_state(full=True)
+
+    def test_mmap(self):
+        data_file = os.path.join(self.tmpdir, 'test-data.dat')
+        data = np.random.random(size=(128,5))
+        data.tofile(data_file)
+
+        with Cache(self.config_path) as cache:
+            cache.add_data('sdss/apogee/dr13', data_file)
+
+            m = cache.open_mmap('sdss/apogee/dr13', 'test-data.dat')
+            assert m[:] == data.tobytes()
+            # other callers are not affected when one releases its view
+            m.release()
+            assert cache.open_mmap('sdss/apogee/dr13', 'test-data.dat') == data.tobytes()
+
+            arr = cache.load_array('sdss/apogee/dr13', 'test-data.dat', dtype=data.dtype,
+                                   shape=data.shape)
+            np.testing.assert_array_equal(arr, data)
+
+            with pytest.raises(IOError):
+                cache.open_mmap('sdss/apogee/dr13', 'nonexistent.dat')
+
+    def _set_config(self, **options):
+        conf = ConfigParser()
+        conf.read(self.config_path)
+        for key, value in options.items():
+            conf.set('astrodata', key.replace('__', '/'), str(value))
+        with open(self.config_path, 'w') as configfile:
+            conf.write(configfile)
+
+    def _make_files(self, n, size=1000):
+        data_files = []
+        for i in range(n):
+            data_file = os.path.join(self.tmpdir, 'data{0}.dat'.format(i))
+            with open(data_file, 'wb') as f:
+                f.write(os.urandom(size))
+            data_files.append(data_file)
+        return data_files
+
+    def test_max_size(self):
+        self._set_config(max_size='2.5K')
+        data_files = self._make_files(4)
+
+        with Cache(self.config_path) as cache:
+            assert cache.max_size == 2560
+            for data_file in data_files[:3]:
+                cache.add_data('sdss/apogee/dr13', data_file)
+                time.sleep(0.01)
+            assert cache.usage() == 2000
+
+            # data0 is now the most recently used, and data2 is pinned
+            cache.touch('sdss/apogee/dr13', 'data0.dat')
+            cache.pin('sdss/apogee/dr13', 'data2.dat')
+
+            cache.add_data('gaia/dr1', data_files[3])
+            assert cache.usage() == 2000
+            assert cache.get_entry('sdss/apogee/dr13', 'data1.dat') is None
+            assert not os.path.exists(os.path.join(cache.root, 'sdss/apogee/dr13/data1.dat'))
+            assert cache.get_entry('sdss/apogee/dr13', 'data0.dat') is None
+            assert cache.get_entry('sdss/apogee/dr13', 'data2.dat')['pinned']
+            assert cache.get_entry('gaia/dr1', 'data3.dat') is not None
+
+            cache.unpin('sdss/apogee/dr13', 'data2.dat')
+            assert cache.evict(1) == [('sdss/apogee/dr13', 'data2.dat')]
+            assert not os.path.exists(os.path.join(cache.root, 'sdss'))
+            assert cache.usage() == 1000
+
+            with pytest.raises(IOError):
+                cache.pin('sdss/apogee/dr13', 'data2.dat')
+
+        with Cache(self.config_path) as cache:
+            assert cache.usage() == 1000
+            assert cache.check_state()
+
+    def test_pin_add_again(self):
+        data_files = self._make_files(1)
+        serve_path = os.path.dirname(data_files[0])
+
+        with LocalHTTPServer(serve_path) as server, Cache(self.config_path) as cache:
+            url = server.url('data0.dat')
+            cache.add_data('sdss/apogee/dr13', url, mirrors=[url + '?mirror'])
+            cache.add_data('gaia/dr1', data_files[0])
+            cache.pin('sdss/apogee/dr13', 'data0.dat')
+            cache.pin('gaia/dr1', 'data0.dat')
+
+            # as it is, downloaded again, or copied again, a file stays pinned
+            for kwargs in (dict(), dict(overwrite=True)):
+                cache.add_data('sdss/apogee/dr13', url, **kwargs)
+                entry = cache.get_entry('sdss/apogee/dr13', 'data0.dat')
+                assert entry['pinned']
+                assert entry['mirrors'] == [url + '?mirror']
+            cache.add_data('gaia/dr1', data_files[0])
+            assert cache.get_entry('gaia/dr1', 'data0.dat')['pinned']
+
+            assert cache.evict(10**6) == []
+
+    def test_quota(self):
+        self._set_config(**{'quota.sdss__apogee': 1500})
+        data_files = self._make_files(3)
+
+        with Cache(self.config_path) as cache:
+            cache.add_data('sdss/apogee/dr13', data_files[0])
+            cache.add_data('gaia/dr1', data_files[1])
+            cache.add_data('sdss/apogee/dr14', data_files[2])
+
+            # only files under the sub path count towards its quota
+            assert cache.usage('sdss/apogee') == 1000
+            assert cache.usage() == 2000
+            assert cache.get_entry('sdss/apogee/dr13', 'data0.dat') is None
+            assert cache.get_entry('gaia/dr1', 'data1.dat') is not None
+
+    def test_make_space(self, monkeypatch):
+        self._set_config(max_size='1G')
+        data_files = self._make_files(2)
+
+        with Cache(self.config_path) as cache:
+            for data_file in data_files:
+                cache.add_data('sdss/apogee/dr13', data_file)
+                time.sleep(0.01)
+
+            # pretend the disk is nearly full
+            usage = shutil.disk_usage(cache.root)
+            monkeypatch.setattr(shutil, 'disk_usage',
+                                lambda path: usage._replace(free=500))
+            cache._make_space(1000)
+            assert cache.get_entry('sdss/apogee/dr13', 'data0.dat') is None
+            assert cache.get_entry('sdss/apogee/dr13', 'data1.dat') is not None
+
+    def test_make_space_threads(self, monkeypatch):
+        self._set_config(max_size='1G')
+        data_files = self._make_files(8)
+
+        with Cache(self.config_path) as cache:
+            for data_file in data_files:
+                cache.add_data('sdss/apogee/dr13', data_file)
+
+            # every download thread finds the disk full at once
+            usage = shutil.disk_usage(cache.root)
+            monkeypatch.setattr(shutil, 'disk_usage',
+                                lambda path: usage._replace(free=0))
+            errors = []
+            def _work():
+                try:
+                    cache._make_space(3000)
+                except Exception as e:
+                    errors.append(e)
+            threads = [threading.Thread(target=_work) for i in range(8)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+
+            assert errors == []
+            assert cache.usage() == 0
+            assert cache.check_state()
+
+    def test_evict_deduplicated(self, monkeypatch):
+        data_file, = self._make_files(1)
+
+        with Cache(self.config_path) as cache:
+            path1 = cache.add_data('sdss/apogee/dr13', data_file, local_name='bob',
+                                   deduplicate=True)
+
+            # the second link to the object is a symlink, e.g. across devices
+            def _no_link(source, destination):
+                raise OSError(errno.EXDEV, 'Invalid cross-device link')
+            monkeypatch.setattr(os, 'link', _no_link)
+            path2 = cache.add_data('gaia/dr1', data_file, local_name='alice',
+                                   deduplicate=True)
+            monkeypatch.undo()
+            assert os.path.islink(path2)
+
+            object_path = cache.objects.object_path(
+                cache.get_entry('gaia/dr1', 'alice')['sha256'])
+            assert cache.evict(1, sub_path='sdss') == [('sdss/apogee/dr13', 'bob')]
+            assert not os.path.exists(path1)
+            assert os.path.exists(object_path)
+            with open(path2, 'rb') as f1, open(data_file, 'rb') as f2:
+                assert f1.read() == f2.read()
+
+            assert cache.evict(1) == [('gaia/dr1', 'alice')]
+            assert not os.path.lexists(path2)
+            assert not os.path.exists(object_path)
+
+    def test_evict_deduplicated_freed(self):
+        data_files = self._make_files(2)
+
+        with Cache(self.config_path) as cache:
+            cache.add_data('sdss/apogee/dr13', data_files[0], local_name='bob',
+                           deduplicate=True)
+            cache.add_data('sdss/apogee/dr14', data_files[0], local_name='alice',
+                           deduplicate=True)
+            cache.add_data('gaia/dr1', data_files[1])
+
+            # the shared object only takes up space once
+            sizes = [os.path.getsize(data_file) for data_file in data_files]
+            assert cache.usage() == sum(sizes)
+            assert cache.usage('sdss') == sizes[0]
+
+            # removing one link frees nothing, so eviction carries on
+            assert cache.evict(1, sub_path='sdss') == [('sdss/apogee/dr13', 'bob'),
+                                                       ('sdss/apogee/dr14', 'alice')]
+            assert cache.usage() == sizes[1]
+
+    def test_concurrent_sessions(self):
+        data_files = self._make_files(2)
+
+        first = Cache(self.config_path)
+        second = Cache(self.config_path)
+        first.add_data('sdss/apogee/dr13', data_files[0])
+        second.add_data('gaia/dr1', data_files[1])
+        first.close()
+        second.close()
+
+        with Cache(self.config_path) as cache:
+            assert cache.get_entry('sdss/apogee/dr13', 'data0.dat') is not None
+            assert cache.get_entry('gaia/dr1', 'data1.dat') is not None
+
+    def test_checksum(self):
+        data_file = os.path.join(self.tmpdir, 'test-data.dat')
+        np.savetxt(data_file, np.random.random(size=(128,5)))
+        with open(data_file, 'rb') as f:
+            data = f.read()
+
+        with Cache(self.config_path) as cache:
+            cache.add_data('sdss', data_file, local_name='bob', hash_algorithm='md5')
+            entry = cache.get_entry('sdss', 'bob')
+            assert entry['md5'] == hashlib.md5(data).hexdigest()
+            assert entry['size'] == len(data)
+
+            cache.add_data('sdss', data_file, local_name='alice', deduplicate=True,
+                           expected_checksum=hashlib.sha256(data).hexdigest())
+            assert cache.get_entry('sdss', 'alice')['sha256'] == hashlib.sha256(data).hexdigest()
+
+            for deduplicate in [False, True]:
+                with pytest.raises(IOError):
+                    cache.add_data('sdss', data_file, local_name='carol',
+                                   deduplicate=deduplicate, expected_checksum='md5:0123')
+                assert cache.get_entry('sdss', 'carol') is None
+                assert not os.path.exists(os.path.join(self.repo_path, 'sdss', 'carol'))
+
+    def test_check_state(self):
+        data_file = os.path.join(self.tmpdir, 'test-data.dat')
+        np.savetxt(data_file, np.random.random(size=(128,5)))
+
+        with Cache(self.config_path) as cache:
+            bob = cache.add_data('sdss', data_file, local_name='bob', hash_algorithm='md5')
+            alice = cache.add_data('sdss', data_file, local_name='alice')
+            carol = cache.add_data('gaia', data_file, local_name='carol', hash_algorithm='md5')
+            dave = cache.add_data('gaia', data_file, local_name='dave', hash_algorithm='md5')
+            assert cache.check_state()
+
+        # touched but not changed
+        os.utime(bob, (0, 1000))
+
+        # changed, keeping the size and modification time
+        stat = os.stat(carol)
+        with open(carol, 'r+b') as f:
+            f.write(b'X')
+        os.utime(carol, (stat.st_atime, stat.st_mtime))
+
+        # changed without a checksum to compare
+        with open(alice, 'ab') as f:
+            f.write(b'X')
+
+        os.remove(dave)
+        with open(os.path.join(self.repo_path, 'gaia', 'eve'), 'w') as f:
+            f.write('orphan')
+
+        # downloads in progress or kept for resuming are not orphans
+        for name in ('frank.part', 'frank.part.json', 'tmpk2_x9a7q'):
+            with open(os.path.join(self.repo_path, 'gaia', name), 'w') as f:
+                f.write('partial')
+
+        with Cache(self.config_path) as cache:
+            with pytest.warns(UserWarning):
+                state = cache.check_state()
+            assert not state
+            assert state.missing == [('gaia', 'dave')]
+            assert state.modified == [('sdss', 'alice')]
+            assert state.orphaned == [os.path.join('gaia', 'eve')]
+
+            # the touched file had its stat data refreshed
+            assert cache.get_entry('sdss', 'bob')['mtime'] == 1000
+
+            with pytest.warns(UserWarning):
+                state = cache.check_state(full=True, orphans=False)
+            assert state.modified == [('gaia', 'carol'), ('sdss', 'alice')]
+            assert state.orphaned == []
+
+    def test_build_from_schema(self):
+        serve_path = os.path.join(self.tmpdir, 'serve')
+        os.makedirs(serve_path)
+        names = []
+        for i in range(6):
+            names.append('test-data{}.dat'.format(i))
+            np.savetxt(os.path.join(serve_path, names[-1]),
+                       np.random.random(size=(16*(6-i),5)))
+
+        # the config of a second, empty cache
+        new_config_path = os.path.join(self.tmpdir, '.newconfig')
+        new_repo_path = os.path.join(self.tmpdir, 'newastrodata')
+        conf = ConfigParser()
+        conf.read([self.config_path])
+        conf.set('astrodata', 'repository_path', new_repo_path)
+        with open(new_config_path, 'w') as configfile:
+            conf.write(configfile)
+
+        with LocalHTTPServer(serve_path) as server:
+            with Cache(self.config_path) as cache:
+                cache.add_data_many([('sdss/apogee/dr13', server.url(name)) for name in names[:4]],
+                                    hash_algorithm='md5')
+                cache.add_data_many([('gaia/dr1', server.url(name)) for name in names[4:]])
+                cache.add_data('local', os.path.join(serve_path, names[0]), local_name='bob')
+
+            # copy the schema to build the new cache from
+            with Cache(self.config_path) as cache:
+                entries = list(cache._catalog.entries())
+            schema_file = os.path.join(self.tmpdir, 'schema-copy.json')
+            schema_copy = JSONCatalog(schema_file)
+            schema_copy.set_many(entries)
+            schema_copy.close()
+
+            # an interrupted build
+            server.fail(names[1])
+            results = Cache.build_from_schema(schema_file, new_config_path,
+                                              max_workers=2, batch_size=2)
+            assert len(results) == 7
+            assert [r.error is None for r in results].count(False) == 1
+
+            # smallest files first
+            sizes = [os.path.getsize(r.source) if os.path.exists(r.source) else
+                     os.path.getsize(os.path.join(serve_path, os.path.basename(r.source)))
+                     for r in results]
+            assert sizes == sorted(sizes)
+
+            # picks up where it stopped
+            n_requests = len(server.requests)
+            results = Cache.build_from_schema(schema_file, new_config_path)
+            assert len(results) == 1
+            assert results[0].error is None
+            assert results[0].source == server.url(names[1])
+            assert len(server.requests) == n_requests + 1
+
+        with Cache(new_config_path) as cache:
+            for sub_path, name, entry in entries:
+                new_entry = cache.get_entry(sub_path, name)
+                assert new_entry['source'] == entry['source']
+                assert new_entry.get('md5') == entry.get('md5')
+                with open(os.path.join(new_repo_path, sub_path, name), 'rb') as f1, \
+                        open(os.path.join(self.repo_path, sub_path, name), 'rb') as f2:
+                    assert f1.read() == f2.read()
+            assert cache.check_state()
+
+    def test_add_data_many_parallel(self):
+        serve_path = os.path.join(self.tmpdir, 'serve')
+        os.makedirs(serve_path)
+        names = []
+        for i in range(8):
+            names.append('test-data{}.dat'.format(i))
+            np.savetxt(os.path.join(serve_path, names[-1]), np.random.random(size=(16,5)))
+
+        with LocalHTTPServer(serve_path) as server:
+            items = [('sdss/apogee/dr13', server.url(name)) for name in names]
+            items.append(('sdss/apogee/dr13', server.url('nonexistentfile')))
+            with Cache(self.config_path) as cache:
+                results = cache.add_data_many(items, max_workers=4)
+
+        assert all(r.error is None for r in results[:-1])
+        assert isinstance(results[-1].error, urllib.error.HTTPError)
+
+        with Cache(self.config_path) as cache:
+            assert len(cache.schema['sdss']['apogee']['dr13']) == len(names)
+            for name in names:
+                _check_schema(cache, 'sdss/apogee/dr13', name)
+                assert cache.get_entry('sdss/apogee/dr13', name)['source'] == server.url(name)
+
+    def test_add_data_many_parallel_deduplicate(self):
+        serve_path = os.path.join(self.tmpdir, 'serve')
+        os.makedirs(serve_path)
+        names = []
+        for i in range(8):
+            names.append('test-data{}.dat'.format(i))
+            np.savetxt(os.path.join(serve_path, names[-1]), np.random.random(size=(16,5)))
+
+        with LocalHTTPServer(serve_path) as server:
+            items = [('sdss/apogee/dr13', server.url(name)) for name in names]
+            items.append(('sdss/apogee/dr13', server.url('nonexistentfile')))
+            with Cache(self.config_path) as cache:
+                results = cache.add_data_many(items, max_workers=4, deduplicate=True)
+
+        assert all(r.error is None for r in results[:-1])
+        assert isinstance(results[-1].error, urllib.error.HTTPError)
+
+        with Cache(self.config_path) as cache:
+            assert len(cache.schema['sdss']['apogee']['dr13']) == len(names)
+            for name in names:
+                _check_schema(cache, 'sdss/apogee/dr13', name)
+                entry = cache.get_entry('sdss/apogee/dr13', name)
+                assert entry['source'] == server.url(name)
+                assert entry['sha256'] in cache.objects
+
+class TestSQLiteCache(TestCache):
+
+    @pytest.fixture(autouse=True)
+    def setup(self, tmpdir):
+        self.tmpdir = str(tmpdir)
+        self.config_path = str(tmpdir.join('.testconfig'))
+        self.repo_path = str(tmpdir.join('astrodata'))
+
+        conf = ConfigParser()
+        conf.add_section('astrodata')
+        conf.set('astrodata', 'repository_path', self.repo_path)
+        conf.set('astrodata', 'schema_backend', 'sqlite')
+
+        with open(self.config_path, 'w') as configfile:
+            conf.write(configfile)
+
+    def test_migrate_json(self):
+        data_file = os.path.join(self.tmpdir, 'test-data.dat')
+        np.savetxt(data_file, np.random.random(size=(128,5)))
+
+        # populate a JSON schema first
+        json_config_path = os.path.join(self.tmpdir, '.jsonconfig')
+        conf = ConfigParser()
+        conf.add_section('astrodata')
+        conf.set('astrodata', 'repository_path', self.repo_path)
+        with open(json_config_path, 'w') as configfile:
+            conf.write(configfile)
+
+        with Cache(json_config_path) as cache:
+            cache.add_data('sdss/apogee/dr13', data_file, local_name='bob')
+            cache.add_data('sdss/apogee/dr14', data_file, local_name='alice')
+
+        with Cache(self.config_path) as cache:
+            assert os.path.exists(os.path.join(self.repo_path, 'schema.db'))
+            _check_schema(cache, 'sdss/apogee/dr13', 'bob')
+            _check_schema(cache, 'sdss/apogee/dr14', 'alice')
+            assert cache.get_entry('sdss/apogee/dr14', 'alice')['source'] == data_file
+            assert sorted(cache.find_source(data_file)) == [('sdss/apogee/dr13', 'bob'),
+                                                            ('sdss/apogee/dr14', 'alice')]
+
+class TestJournaledCache(TestCache):
+
+    @pytest.fixture(autouse=True)
+    def setup(self, tmpdir):
+        self.tmpdir = str(tmpdir)
+        self.config_path = str(tmpdir.join('.testconfig'))
+        self.repo_path = str(tmpdir.join('astrodata'))
+
+        conf = ConfigParser()
+        conf.add_section('astrodata')
+        conf.set('astrodata', 'repository_path', self.repo_path)
+        conf.set('astrodata', 'schema_backend', 'journal')
+
+        with open(self.config_path, 'w') as configfile:
+            conf.write(configfile)
+
+    def test_compact(self):
+        data_file = os.path.join(self.tmpdir, 'test-data.dat')
+        np.savetxt(data_file, np.random.random(size=(128,5)))
+
+        with Cache(self.config_path) as cache:
+            cache.add_data('sdss/apogee/dr13', data_file, local_name='bob')
+            cache.compact()
+
+        with open(os.path.join(self.repo_path, 'schema.json')) as f:
+            assert 'bob' in json.load(f)['sdss']['apogee']['dr13']
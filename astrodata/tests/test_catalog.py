@@ -0,0 +1,233 @@
+from __future__ import (absolute_import, division, print_function,
+                        unicode_literals)
+
+# Standard library
+import json
+import os
+import sqlite3
+import threading
+import time
+
+# Third-party
+from astropy.tests.helper import pytest
+
+# Package
+from ..catalog import (JSONCatalog, JournaledCatalog, SQLiteCatalog,
+                       migrate_json_to_sqlite, read_entries)
+
+def _entry(source):
+    return dict(source=source, download_datetime='2016-12-31T14:57:59.227953')
+
+@pytest.mark.parametrize('Catalog,filename', [(JSONCatalog, 'schema.json'),
+                                              (JournaledCatalog, 'schema.json'),
+                                              (SQLiteCatalog, 'schema.db')])
+def test_catalog(tmpdir, Catalog, filename):
+    path = str(tmpdir.join(filename))
+
+    catalog = Catalog(path)
+    catalog.set('sdss/apogee/dr13', 'allStar.fits', _entry('http://a/allStar.fits'))
+    catalog.set('sdss/apogee/dr13/', 'allVisit.fits', _entry('http://a/allVisit.fits'))
+    catalog.set('sdss/apogee-2/dr14', 'allStar.fits', _entry('http://a/allStar.fits'))
+    catalog.close()
+
+    catalog = Catalog(path)
+    assert catalog.get('sdss/apogee/dr13', 'allStar.fits')['source'] == 'http://a/allStar.fits'
+    assert catalog.get('sdss/apogee/dr13', 'nope.fits') is None
+    assert catalog.get('sdss/apogee', 'dr13') is None
+    assert catalog.get('gaia', 'allStar.fits') is None
+
+    assert sorted(catalog.find_source('http://a/allStar.fits')) == \
+        [('sdss/apogee-2/dr14', 'allStar.fits'), ('sdss/apogee/dr13', 'allStar.fits')]
+    assert len(list(catalog.entries())) == 3
+
+    # the nested view of the schema
+    schema = catalog.schema
+    assert list(schema) == ['sdss']
+    assert sorted(schema['sdss']) == ['apogee', 'apogee-2']
+    assert len(schema['sdss']['apogee']['dr13']) == 2
+    assert schema['sdss']['apogee']['dr13']['allVisit.fits']['source'] == 'http://a/allVisit.fits'
+    assert 'dr14' not in schema['sdss']['apogee']
+
+    catalog.delete_many([('sdss/apogee-2/dr14', 'allStar.fits'),
+                         ('sdss/apogee/dr13', 'nope.fits')])
+    catalog.close()
+
+    catalog = Catalog(path)
+    assert catalog.get('sdss/apogee-2/dr14', 'allStar.fits') is None
+    assert list(catalog.schema['sdss']) == ['apogee']
+    assert len(read_entries(path)) == 2
+    catalog.close()
+
+@pytest.mark.parametrize('Catalog,filename', [(JSONCatalog, 'schema.json'),
+                                              (JournaledCatalog, 'schema.json'),
+                                              (SQLiteCatalog, 'schema.db')])
+def test_catalog_concurrent(tmpdir, Catalog, filename):
+    path = str(tmpdir.join(filename))
+    Catalog(path).close()
+
+    # two sessions open at once only lose nothing if their changes are merged
+    first = Catalog(path)
+    second = Catalog(path)
+    first.set('sdss/apogee/dr13', 'a.fits', _entry('http://a/a.fits'))
+    first.set('sdss/apogee/dr13', 'b.fits', _entry('http://a/b.fits'))
+    second.set('gaia/dr1', 'c.fits', _entry('http://a/c.fits'))
+    first.close()
+    second.delete_many([('sdss/apogee/dr13', 'a.fits')])
+    second.close()
+
+    catalog = Catalog(path)
+    assert sorted((sub_path, name) for sub_path, name, _ in catalog.entries()) == \
+        [('gaia/dr1', 'c.fits'), ('sdss/apogee/dr13', 'b.fits')]
+    catalog.compact()
+    catalog.close()
+    assert len(read_entries(path)) == 2
+    assert not os.path.exists(path + '.lock')
+
+def test_json_catalog_dirty(tmpdir):
+    path = str(tmpdir.join('schema.json'))
+    catalog = JSONCatalog(path)
+    catalog.set('sdss', 'a.fits', _entry('http://a/a.fits'))
+    assert catalog.dirty
+    catalog.commit()
+    assert not catalog.dirty
+
+    # an unchanged catalog does not rewrite the file
+    mtime = os.stat(path).st_mtime_ns
+    inode = os.stat(path).st_ino
+    catalog.close()
+    JSONCatalog(path).close()
+    assert os.stat(path).st_mtime_ns == mtime
+    assert os.stat(path).st_ino == inode
+
+def test_migrate_json_to_sqlite(tmpdir):
+    json_path = str(tmpdir.join('schema.json'))
+    schema = {'sdss': {'apogee': {'dr13': {'allStar.fits': _entry('http://a/allStar.fits')}}},
+              'gaia': {'dr1': {'tgas.fits': _entry('/data/tgas.fits'),
+                               'source': {'b.fits': _entry('http://b/b.fits')}}}}
+    with open(json_path, 'w') as f:
+        json.dump(schema, f)
+
+    sqlite_path = str(tmpdir.join('schema.db'))
+    assert migrate_json_to_sqlite(json_path, sqlite_path) == 3
+
+    catalog = SQLiteCatalog(sqlite_path)
+    assert catalog.get('gaia/dr1', 'tgas.fits')['source'] == '/data/tgas.fits'
+    assert catalog.get('gaia/dr1/source', 'b.fits')['source'] == 'http://b/b.fits'
+    assert catalog.find_source('http://a/allStar.fits') == [('sdss/apogee/dr13', 'allStar.fits')]
+    catalog.close()
+
+    # entries are added to an existing catalog
+    other_path = str(tmpdir.join('other.json'))
+    with open(other_path, 'w') as f:
+        json.dump({'gaia': {'dr2': {'gaia.fits': _entry('http://c/gaia.fits')}}}, f)
+    assert migrate_json_to_sqlite(other_path, sqlite_path) == 1
+    assert len(read_entries(sqlite_path)) == 4
+
+def test_migrate_json_to_sqlite_interrupted(tmpdir, monkeypatch):
+    json_path = str(tmpdir.join('schema.json'))
+    with open(json_path, 'w') as f:
+        json.dump({'sdss': {'a.fits': _entry('http://a/a.fits')}}, f)
+
+    def _crash(self, records):
+        raise KeyboardInterrupt()
+    monkeypatch.setattr(SQLiteCatalog, 'set_many', _crash)
+
+    # nothing is left behind that looks like a finished migration
+    sqlite_path = str(tmpdir.join('schema.db'))
+    with pytest.raises(KeyboardInterrupt):
+        migrate_json_to_sqlite(json_path, sqlite_path)
+    assert sorted(os.listdir(str(tmpdir))) == ['schema.json']
+
+def test_read_entries_read_only(tmpdir):
+    path = str(tmpdir.join('schema.db'))
+    catalog = SQLiteCatalog(path)
+    catalog.set('sdss', 'a.fits', _entry('http://a/a.fits'))
+    catalog.close()
+
+    conn = sqlite3.connect(path)
+    conn.execute('PRAGMA journal_mode=DELETE')
+    conn.close()
+    with open(path, 'rb') as f:
+        data = f.read()
+
+    assert read_entries(path) == [('sdss', 'a.fits', _entry('http://a/a.fits'))]
+
+    # the source database is left exactly as it was
+    with open(path, 'rb') as f:
+        assert f.read() == data
+    conn = sqlite3.connect(path)
+    assert conn.execute('PRAGMA journal_mode').fetchone()[0] == 'delete'
+    conn.close()
+    assert sorted(os.listdir(str(tmpdir))) == ['schema.db']
+
+def test_journaled_catalog(tmpdir):
+    path = str(tmpdir.join('schema.json'))
+    log_path = path + '.log'
+
+    catalog = JournaledCatalog(path, compact_threshold=0)
+    catalog.set('sdss/apogee/dr13', 'allStar.fits', _entry('http://a/allStar.fits'))
+    catalog.set_many([('gaia/dr1', 'tgas.fits', _entry('/data/tgas.fits')),
+                      ('gaia/dr1', 'tgas2.fits', _entry('/data/tgas2.fits'))])
+    catalog.close()
+
+    # nothing was written to the snapshot, only the log
+    with open(path) as f:
+        assert json.load(f) == dict()
+    with open(log_path) as f:
+        assert len(f.readlines()) == 3
+
+    # simulate a crash part-way through writing a record
+    with open(log_path, 'a') as f:
+        f.write('{"entry": {"source": "http://a/allV')
+
+    catalog = JournaledCatalog(path, compact_threshold=0)
+    assert catalog.get('sdss/apogee/dr13', 'allStar.fits')['source'] == 'http://a/allStar.fits'
+    assert len(catalog.schema['gaia']['dr1']) == 2
+    catalog.set('sdss/apogee/dr13', 'allVisit.fits', _entry('http://a/allVisit.fits'))
+
+    catalog.compact()
+    assert os.path.getsize(log_path) == 0
+    with open(path) as f:
+        assert len(json.load(f)['sdss']['apogee']['dr13']) == 2
+    catalog.close()
+
+    catalog = JournaledCatalog(path)
+    assert len(list(catalog.entries())) == 4
+    catalog.close()
+
+def test_journaled_catalog_open_during_compact(tmpdir, monkeypatch):
+    from .. import catalog as catalog_module
+    path = str(tmpdir.join('schema.json'))
+
+    writer = JournaledCatalog(path, compact_threshold=0)
+    writer.set('sdss', 'allStar.fits', _entry('http://a/allStar.fits'))
+    writer.commit()
+
+    # another process compacts the log just after the snapshot was read
+    read_json = catalog_module._read_json
+    compactions = []
+    def _read_json(read_path):
+        schema = read_json(read_path)
+        if not compactions:
+            compactions.append(threading.Thread(target=writer.compact))
+            compactions[0].start()
+            time.sleep(0.2)
+        return schema
+    monkeypatch.setattr(catalog_module, '_read_json', _read_json)
+
+    reader = JournaledCatalog(path, compact_threshold=0)
+    compactions[0].join()
+    assert reader.get('sdss', 'allStar.fits') is not None
+    reader.close()
+    writer.close()
+
+def test_journaled_catalog_auto_compact(tmpdir):
+    path = str(tmpdir.join('schema.json'))
+
+    catalog = JournaledCatalog(path, compact_threshold=2)
+    for i in range(3):
+        catalog.set('sdss', 'file{}.fits'.format(i), _entry('http://a/{}'.format(i)))
+    catalog.close()
+
+    assert os.path.getsize(path + '.log') == 0
+    assert len(JSONCatalog(path).schema['sdss']) == 3
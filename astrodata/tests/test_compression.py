@@ -0,0 +1,47 @@
+from __future__ import (absolute_import, division, print_function,
+                        unicode_literals)
+
+# Standard library
+import bz2
+import gzip
+import lzma
+import os
+
+# Third-party
+from astropy.tests.helper import pytest
+
+# Package
+from ..compression import (StreamDecompressor, detect_compression,
+                           strip_compression_suffix)
+
+_compressors = dict(gzip=gzip.compress, bz2=bz2.compress, lzma=lzma.compress)
+
+@pytest.mark.parametrize('compression', sorted(_compressors))
+def test_stream_decompressor(compression):
+    compress = _compressors[compression]
+    data1 = os.urandom(10000) + b'\0' * 100000
+    data2 = b'second member'
+    stream = compress(data1) + compress(data2)
+    assert detect_compression(stream) == compression
+
+    # fed in blocks that split members and headers
+    decompressor = StreamDecompressor(compression)
+    out = [decompressor.decompress(stream[i:i+7]) for i in range(0, len(stream), 7)]
+    out.append(decompressor.flush())
+    assert b''.join(out) == data1 + data2
+
+    decompressor = StreamDecompressor(compression)
+    decompressor.decompress(memoryview(stream)[:len(stream) // 2])
+    with pytest.raises(IOError):
+        decompressor.flush()
+
+def test_detect_compression():
+    assert detect_compression(b'SIMPLE  =                    T') is None
+    assert detect_compression(b'') is None
+    assert detect_compression(b'\x5d\x00\x00\x80\x00') is None
+    assert strip_compression_suffix('spec-0001.fits.gz') == ('spec-0001.fits', 'gzip')
+    assert strip_compression_suffix('spec-0001.fits.XZ') == ('spec-0001.fits', 'lzma')
+    assert strip_compression_suffix('spec-0001.fits') == ('spec-0001.fits', None)
+
+    with pytest.raises(ValueError):
+        StreamDecompressor('zip')
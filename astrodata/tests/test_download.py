@@ -7,15 +7,21 @@ from __future__ import (absolute_import, division, print_function,
                         unicode_literals)
 
 # Standard library
+import gzip
+import hashlib
+import io
+import json
 import os
 
 # Third-party
-from astropy.extern.six.moves import urllib
+import astropy.units as u
+from astropy.extern.six.moves import http_client, urllib
 from astropy.tests.helper import remote_data, pytest
 
 # Package
 from ..cache import Cache
-from ..download import download_file
+from ..download import _iter_blocks, download_file, download_files, fetch_file
+from .helpers import LocalHTTPServer
 
 TESTURL = 'http://www.astropy.org'
 with Cache() as cache:
@@ -86,3 +92,359 @@ def test_invalid_location_download_noconnect():
     # This should invoke socket's monkeypatched failure
     with pytest.raises(IOError):
         download_file('http://astropy.org/nonexistentfile', cache_path=download_dir)
+
+def _make_data_files(path, n, size=2**18):
+    names = []
+    for i in range(n):
+        name = 'data{}.dat'.format(i)
+        with open(os.path.join(path, name), 'wb') as f:
+            f.write(os.urandom(size))
+        names.append(name)
+    return names
+
+def test_download_files(tmpdir):
+    serve_path = str(tmpdir.mkdir('serve'))
+    download_path = str(tmpdir.join('download'))
+    names = _make_data_files(serve_path, 8)
+
+    progress = dict()
+    def callback(remote_url, bytes_read, size):
+        progress[remote_url] = (bytes_read, size)
+
+    with LocalHTTPServer(serve_path) as server:
+        requests = [(server.url(name), download_path) for name in names]
+        requests.append((server.url('nonexistentfile'), download_path, 'alice'))
+        results = download_files(requests, max_workers=4, progress_callback=callback)
+
+    assert len(results) == len(names) + 1
+    for name, (local_path, error) in zip(names, results):
+        assert error is None
+        assert local_path == os.path.join(download_path, name)
+        with open(local_path, 'rb') as f1, open(os.path.join(serve_path, name), 'rb') as f2:
+            assert f1.read() == f2.read()
+        assert progress[server.url(name)] == (2**18, 2**18)
+
+    local_path, error = results[-1]
+    assert local_path is None
+    assert isinstance(error, urllib.error.HTTPError)
+    assert not os.path.exists(os.path.join(download_path, 'alice'))
+
+def _read(path):
+    with open(path, 'rb') as f:
+        return f.read()
+
+@pytest.mark.parametrize('ranges', [True, False])
+def test_download_resume(tmpdir, ranges):
+    serve_path = str(tmpdir.mkdir('serve'))
+    download_path = str(tmpdir.join('download'))
+    name, = _make_data_files(serve_path, 1)
+    part_path = os.path.join(download_path, name + '.part')
+
+    with LocalHTTPServer(serve_path, ranges=ranges) as server:
+        server.truncate(name)
+        with pytest.raises(http_client.IncompleteRead):
+            download_file(server.url(name), download_path, resume=True)
+
+        # the partial file and its sidecar are kept
+        assert os.path.getsize(part_path) == 2**17
+        with open(part_path + '.json') as f:
+            meta = json.load(f)
+        assert meta['bytes'] == 2**17
+        assert meta['url'] == server.url(name)
+
+        local_path = download_file(server.url(name), download_path, resume=True)
+
+    assert _read(local_path) == _read(os.path.join(serve_path, name))
+    assert not os.path.exists(part_path)
+    assert not os.path.exists(part_path + '.json')
+
+    method, path, headers = server.requests[-1]
+    assert headers.get('Range') == 'bytes={}-'.format(2**17)
+
+def test_download_resume_changed(tmpdir):
+    serve_path = str(tmpdir.mkdir('serve'))
+    download_path = str(tmpdir.join('download'))
+    name, = _make_data_files(serve_path, 1)
+
+    with LocalHTTPServer(serve_path) as server:
+        server.truncate(name)
+        with pytest.raises(http_client.IncompleteRead):
+            download_file(server.url(name), download_path, resume=True)
+
+        # change the file on the server, so the ETag no longer matches
+        with open(os.path.join(serve_path, name), 'wb') as f:
+            f.write(os.urandom(2**18 + 10))
+        os.utime(os.path.join(serve_path, name), (0, 0))
+
+        local_path = download_file(server.url(name), download_path, resume=True)
+
+    assert _read(local_path) == _read(os.path.join(serve_path, name))
+
+def test_download_resume_past_end(tmpdir):
+    serve_path = str(tmpdir.mkdir('serve'))
+    download_path = str(tmpdir.mkdir('download'))
+    name, = _make_data_files(serve_path, 1)
+    part_path = os.path.join(download_path, name + '.part')
+
+    with LocalHTTPServer(serve_path) as server:
+        # a partial download longer than the file is now, with no validator
+        # to tell that it changed
+        with open(part_path, 'wb') as f:
+            f.write(os.urandom(2**19))
+        with open(part_path + '.json', 'w') as f:
+            json.dump(dict(url=server.url(name), bytes=2**19), f)
+
+        local_path = download_file(server.url(name), download_path, resume=True)
+        assert [request[2].get('Range') for request in server.requests] == \
+            ['bytes={}-'.format(2**19), None]
+
+    assert _read(local_path) == _read(os.path.join(serve_path, name))
+    assert not os.path.exists(part_path)
+    assert not os.path.exists(part_path + '.json')
+
+def test_download_retries(tmpdir):
+    serve_path = str(tmpdir.mkdir('serve'))
+    download_path = str(tmpdir.join('download'))
+    name, = _make_data_files(serve_path, 1)
+    backoff = 0.01*u.second
+
+    with LocalHTTPServer(serve_path) as server:
+        # a dropped connection is resumed within the same call
+        server.truncate(name)
+        local_path = download_file(server.url(name), download_path, resume=True,
+                                   retries=1, retry_backoff=backoff)
+        assert _read(local_path) == _read(os.path.join(serve_path, name))
+        assert len(server.requests) == 2
+        os.remove(local_path)
+
+        # server errors are retried...
+        server.fail(name, times=2)
+        local_path = download_file(server.url(name), download_path,
+                                   retries=2, retry_backoff=backoff)
+        assert _read(local_path) == _read(os.path.join(serve_path, name))
+        os.remove(local_path)
+
+        # ...until the retries run out
+        server.fail(name, times=2)
+        with pytest.raises(urllib.error.HTTPError):
+            download_file(server.url(name), download_path, retries=1, retry_backoff=backoff)
+
+        # but client errors are not
+        n_requests = len(server.requests)
+        with pytest.raises(urllib.error.HTTPError):
+            download_file(server.url('nonexistentfile'), download_path,
+                          retries=3, retry_backoff=backoff)
+        assert len(server.requests) == n_requests + 1
+
+@pytest.mark.parametrize('ranges', [True, False])
+def test_download_segmented(tmpdir, ranges):
+    serve_path = str(tmpdir.mkdir('serve'))
+    download_path = str(tmpdir.join('download'))
+    name, = _make_data_files(serve_path, 1, size=2**18 + 3)
+
+    progress = []
+    with LocalHTTPServer(serve_path, ranges=ranges) as server:
+        local_path = download_file(server.url(name), download_path, segments=4,
+                                   min_segment_size=2**14,
+                                   progress_callback=lambda *a: progress.append(a))
+
+    assert _read(local_path) == _read(os.path.join(serve_path, name))
+    assert os.listdir(download_path) == [name]
+    assert progress[-1][1] == 2**18 + 3
+
+    ranges_requested = sorted(headers.get('Range') for method, path, headers
+                              in server.requests[1:])
+    if ranges:
+        # a probe for range support, then one request per segment
+        assert len(server.requests) == 5
+        assert ranges_requested == ['bytes=0-65535', 'bytes=131073-196609',
+                                    'bytes=196610-262146', 'bytes=65536-131072']
+    else:
+        assert len(server.requests) == 2
+        assert ranges_requested == [None]
+
+def test_download_segmented_small(tmpdir):
+    serve_path = str(tmpdir.mkdir('serve'))
+    download_path = str(tmpdir.join('download'))
+    name, = _make_data_files(serve_path, 1, size=2**15)
+
+    with LocalHTTPServer(serve_path) as server:
+        # only big enough for two segments of at least min_segment_size
+        local_path = download_file(server.url(name), download_path, segments=4,
+                                   min_segment_size=2**14)
+        assert _read(local_path) == _read(os.path.join(serve_path, name))
+        assert len(server.requests) == 3
+        os.remove(local_path)
+
+        # too small to split at all
+        local_path = download_file(server.url(name), download_path, segments=4,
+                                   min_segment_size=2**16)
+        assert _read(local_path) == _read(os.path.join(serve_path, name))
+        assert len(server.requests) == 5
+
+@pytest.mark.parametrize('kwargs', [dict(), dict(resume=True),
+                                    dict(segments=4, min_segment_size=2**14)])
+def test_fetch_file_checksum(tmpdir, kwargs):
+    serve_path = str(tmpdir.mkdir('serve'))
+    download_path = str(tmpdir.join('download'))
+    name, = _make_data_files(serve_path, 1)
+    data = _read(os.path.join(serve_path, name))
+    md5 = hashlib.md5(data).hexdigest()
+    sha256 = hashlib.sha256(data).hexdigest()
+
+    with LocalHTTPServer(serve_path) as server:
+        if kwargs.get('resume'):
+            # the digest covers the part downloaded before the failure
+            server.truncate(name)
+            with pytest.raises(http_client.IncompleteRead):
+                fetch_file(server.url(name), download_path, **kwargs)
+
+        result = fetch_file(server.url(name), download_path, hash_algorithm='md5', **kwargs)
+        assert result.local_path == os.path.join(download_path, name)
+        assert result.size == len(data)
+        assert result.hash_algorithm == 'md5'
+        assert result.checksum == md5
+
+        # a mismatch fails before anything is moved into place
+        with pytest.raises(IOError):
+            fetch_file(server.url(name), download_path, filename='bob',
+                       expected_checksum='0'*64, **kwargs)
+        assert sorted(os.listdir(download_path)) == [name]
+
+        result = fetch_file(server.url(name), download_path, filename='bob',
+                            expected_checksum='sha256:' + sha256, **kwargs)
+        assert result.checksum == sha256
+
+        # an existing file that does not match is downloaded again
+        with open(result.local_path, 'wb') as f:
+            f.write(b'corrupted')
+        n_requests = len(server.requests)
+        result = fetch_file(server.url(name), download_path, filename='bob',
+                            expected_checksum=sha256, **kwargs)
+        assert _read(result.local_path) == data
+        assert len(server.requests) > n_requests
+
+    with pytest.raises(ValueError):
+        fetch_file(server.url(name), download_path, hash_algorithm='md5',
+                   expected_checksum='sha256:' + sha256)
+
+def test_fetch_file_refresh(tmpdir):
+    serve_path = str(tmpdir.mkdir('serve'))
+    download_path = str(tmpdir.join('download'))
+    name, = _make_data_files(serve_path, 1)
+    serve_file = os.path.join(serve_path, name)
+    os.utime(serve_file, (1000000000, 1000000000))
+
+    with LocalHTTPServer(serve_path) as server:
+        result = fetch_file(server.url(name), download_path)
+        assert result.etag is not None
+        assert result.last_modified is not None
+        assert result.content_length == os.path.getsize(serve_file)
+        assert not result.not_modified
+        inode = os.stat(result.local_path).st_ino
+
+        # an unchanged file is not transferred again
+        result = fetch_file(server.url(name), download_path, refresh=True,
+                            etag=result.etag, last_modified=result.last_modified,
+                            hash_algorithm='md5')
+        assert result.not_modified
+        assert result.checksum == hashlib.md5(_read(serve_file)).hexdigest()
+        assert os.stat(result.local_path).st_ino == inode
+        headers = server.requests[-1][2]
+        assert headers['If-None-Match'] == result.etag
+        assert 'If-Modified-Since' in headers
+
+        # without validators, the local modification time is used
+        result = fetch_file(server.url(name), download_path, refresh=True)
+        assert result.not_modified
+        assert 'If-None-Match' not in server.requests[-1][2]
+
+        # a changed file is downloaded again
+        with open(serve_file, 'wb') as f:
+            f.write(b'new data')
+        old_etag = result.etag
+        result = fetch_file(server.url(name), download_path, refresh=True,
+                            etag=old_etag)
+        assert not result.not_modified
+        assert result.etag != old_etag
+        assert _read(result.local_path) == b'new data'
+
+def test_iter_blocks():
+    data = os.urandom(2**20 + 3)
+
+    blocks = [bytes(block) for block in _iter_blocks(io.BytesIO(data), 2**10)]
+    assert b''.join(blocks) == data
+    # reads from memory are fast, so the blocks grow
+    assert len(blocks[0]) == 2**10
+    assert max(len(block) for block in blocks) > 2**10
+    assert len(blocks) < 2**10
+
+    blocks = [bytes(block) for block in _iter_blocks(io.BytesIO(data), 2**10, limit=5000)]
+    assert b''.join(blocks) == data[:5000]
+
+def test_download_progress(tmpdir):
+    serve_path = str(tmpdir.mkdir('serve'))
+    download_path = str(tmpdir.join('download'))
+    name, = _make_data_files(serve_path, 1, size=2**20)
+
+    progress = []
+    with LocalHTTPServer(serve_path) as server:
+        download_file(server.url(name), download_path, block_size=2**10,
+                      progress_callback=lambda *a: progress.append(a))
+
+    # updates are throttled, but the last one is always sent
+    assert len(progress) < 2**10
+    assert progress[-1] == (server.url(name), 2**20, 2**20)
+
+def test_fetch_file_decompress(tmpdir):
+    serve_path = str(tmpdir.mkdir('serve'))
+    download_path = str(tmpdir.join('download'))
+    data = os.urandom(2**16) * 4
+    compressed = gzip.compress(data)
+    with open(os.path.join(serve_path, 'data.dat.gz'), 'wb') as f:
+        f.write(compressed)
+    with open(os.path.join(serve_path, 'plain.dat'), 'wb') as f:
+        f.write(data)
+
+    with LocalHTTPServer(serve_path) as server:
+        result = fetch_file(server.url('data.dat.gz'), download_path, decompress=True,
+                            block_size=2**10, expected_checksum=hashlib.md5(compressed).hexdigest(),
+                            hash_algorithm='md5')
+        assert result.local_path == os.path.join(download_path, 'data.dat')
+        assert _read(result.local_path) == data
+        assert result.compression == 'gzip'
+        assert result.size == len(data)
+        assert result.source_size == len(compressed)
+        assert result.checksum == hashlib.md5(data).hexdigest()
+        assert result.source_checksum == hashlib.md5(compressed).hexdigest()
+
+        # uncompressed data are stored as they are
+        result = fetch_file(server.url('plain.dat'), download_path, decompress=True)
+        assert _read(result.local_path) == data
+        assert result.compression is None
+
+        # the format is detected however short the first reads are
+        result = fetch_file(server.url('data.dat.gz'), download_path, decompress=True,
+                            block_size=1, overwrite=True)
+        assert _read(result.local_path) == data
+        assert result.compression == 'gzip'
+
+        # data that only look like a raw lzma stream, under a compression
+        # suffix, are neither decompressed nor renamed
+        lookalike = b'\x5d\x00\x00' + data
+        with open(os.path.join(serve_path, 'lookalike.dat.gz'), 'wb') as f:
+            f.write(lookalike)
+        result = fetch_file(server.url('lookalike.dat.gz'), download_path, decompress=True)
+        assert result.local_path == os.path.join(download_path, 'lookalike.dat.gz')
+        assert _read(result.local_path) == lookalike
+        assert result.compression is None
+        n_requests = len(server.requests)
+        assert fetch_file(server.url('lookalike.dat.gz'), download_path,
+                          decompress=True).local_path == result.local_path
+        assert len(server.requests) == n_requests
+
+        # the format can also be given explicitly
+        with pytest.raises(IOError):
+            fetch_file(server.url('plain.dat'), download_path, filename='bad',
+                       decompress='bz2')
+        assert not os.path.exists(os.path.join(download_path, 'bad'))
@@ -0,0 +1,193 @@
+from __future__ import (absolute_import, division, print_function,
+                        unicode_literals)
+
+# Standard library
+import concurrent.futures
+import os
+import socket
+import sqlite3
+import subprocess
+import sys
+import time
+try:
+    from ConfigParser import ConfigParser
+except ImportError:
+    from configparser import ConfigParser
+
+# Third-party
+from astropy.tests.helper import pytest
+
+# Package
+from ..cache import Cache
+from ..download_queue import DownloadQueue, QueueWorker
+from .helpers import LocalHTTPServer
+
+def test_download_queue(tmpdir):
+    path = str(tmpdir.join('queue.db'))
+    queue = DownloadQueue(path, max_attempts=2, retry_delay=0.2)
+
+    unknown = queue.put('a', 'http://x/unknown.dat')
+    big = queue.put('a', 'http://x/big.dat', size=10**6)
+    small = queue.put('a', 'http://x/small.dat', size=10)
+    urgent = queue.put('a', 'http://x/urgent.dat', priority=1)
+    assert queue.put('a', 'http://x/small.dat', size=10) == small
+    with pytest.raises(ValueError):
+        queue.put('a', 'http://x/bad.dat', options=dict(callback=object()))
+
+    # the queue survives being closed and opened again
+    queue.close()
+    queue = DownloadQueue(path, max_attempts=2, retry_delay=0.2)
+
+    order = []
+    while True:
+        job = queue.claim()
+        if job is None:
+            break
+        order.append(job['id'])
+    assert order == [urgent, small, big, unknown]
+    assert queue.counts() == dict(running=4)
+
+    queue.complete(urgent, '/tmp/urgent.dat', dict(source='http://x/urgent.dat'))
+    assert queue.get(urgent)['entry']['source'] == 'http://x/urgent.dat'
+
+    # failed jobs are retried up to max_attempts, after a delay
+    queue.fail(small, IOError('nope'))
+    job = queue.get(small)
+    assert job['state'] == 'queued'
+    assert job['not_before'] - job['finished'] == pytest.approx(0.2)
+    assert queue.claim() is None
+    time.sleep(0.25)
+    assert queue.claim()['id'] == small
+    queue.fail(small, IOError('nope'))
+    assert queue.get(small)['state'] == 'failed'
+    assert queue.get(small)['error'] == 'nope'
+
+    # jobs of workers that died go back in the queue
+    process = subprocess.Popen([sys.executable, '-c', 'pass'])
+    process.wait()
+    dead = '{0}:{1}'.format(socket.gethostname(), process.pid)
+    queue.put('a', 'http://x/crashed.dat')
+    crashed = queue.claim(worker=dead)['id']
+    assert queue.recover() == 1
+    assert queue.get(crashed)['state'] == 'queued'
+    # the jobs of this (live) process are left alone
+    assert queue.get(big)['state'] == 'running'
+
+    queue.purge()
+    assert queue.get(urgent) is None
+    queue.close()
+
+def test_download_queue_backoff(tmpdir):
+    queue = DownloadQueue(str(tmpdir.join('queue.db')), max_attempts=4, retry_delay=10.)
+    job_id = queue.put('a', 'http://x/flaky.dat')
+    for delay in (10., 20., 40.):
+        queue._execute('UPDATE jobs SET not_before = NULL WHERE id = ?', (job_id,))
+        assert queue.claim()['id'] == job_id
+        queue.fail(job_id, IOError('nope'))
+        job = queue.get(job_id)
+        assert job['not_before'] - job['finished'] == pytest.approx(delay)
+    queue.close()
+
+def test_download_queue_unknown_size(tmpdir):
+    path = str(tmpdir.join('queue.db'))
+
+    # a queue from before sizes that could not be probed were flagged
+    conn = sqlite3.connect(path)
+    conn.execute('CREATE TABLE jobs (id INTEGER PRIMARY KEY AUTOINCREMENT, '
+                 'sub_path TEXT NOT NULL, source TEXT NOT NULL, local_name TEXT, '
+                 'options TEXT NOT NULL, priority INTEGER NOT NULL DEFAULT 0, '
+                 'size INTEGER, state TEXT NOT NULL, '
+                 'attempts INTEGER NOT NULL DEFAULT 0, error TEXT, local_path TEXT, '
+                 'entry TEXT, worker TEXT, enqueued REAL, started REAL, finished REAL)')
+    conn.execute("INSERT INTO jobs (sub_path, source, options, size, state) "
+                 "VALUES ('a', 'http://x/old.dat', '{}', ?, 'queued')", (2**62,))
+    conn.commit()
+    conn.close()
+
+    queue = DownloadQueue(path)
+    old, = [row[0] for row in queue._execute('SELECT id FROM jobs')]
+    assert queue.get(old)['size'] is None
+    assert queue.get(old)['probed']
+
+    unknown = queue.put('a', 'http://x/unknown.dat')
+    sized = queue.put('a', 'http://x/sized.dat')
+    assert queue.unsized() == [(unknown, 'http://x/unknown.dat'),
+                               (sized, 'http://x/sized.dat')]
+    queue.set_size(unknown, None)
+    queue.set_size(sized, 2**40)
+    assert queue.unsized() == []
+    assert [queue.claim()['id'] for i in range(3)] == [sized, old, unknown]
+    queue.close()
+
+def test_enqueue(tmpdir):
+    serve_path = str(tmpdir.mkdir('serve'))
+    for name, size in (('big.dat', 2**16), ('small.dat', 2**10)):
+        with open(os.path.join(serve_path, name), 'wb') as f:
+            f.write(os.urandom(size))
+
+    config_path = str(tmpdir.join('.testconfig'))
+    conf = ConfigParser()
+    conf.add_section('astrodata')
+    conf.set('astrodata', 'repository_path', str(tmpdir.join('astrodata')))
+    with open(config_path, 'w') as configfile:
+        conf.write(configfile)
+
+    with LocalHTTPServer(serve_path) as server, Cache(config_path) as cache:
+        big = cache.add_data('sdss/apogee/dr13', server.url('big.dat'), enqueue=True,
+                             hash_algorithm='md5')
+        small = cache.add_data('sdss/apogee/dr13', server.url('small.dat'), enqueue=True)
+        missing = cache.add_data('sdss/apogee/dr13', server.url('missing.dat'),
+                                 enqueue=True)
+        assert big.state == 'queued' and not big.done()
+        assert cache.get_entry('sdss/apogee/dr13', 'big.dat') is None
+
+        # a worker with its own cache, as in a separate process
+        with Cache(config_path) as worker_cache:
+            worker_cache.config['queue_attempts'] = '1'
+            worker = QueueWorker(worker_cache, max_workers=1, poll_interval=0.05)
+            # sizes are probed in the background as jobs run, so probe them
+            # all first to know the order
+            with concurrent.futures.ThreadPoolExecutor() as prober:
+                worker._probe_sizes(prober, dict())
+            assert worker.run(until_empty=True) == 3
+
+        # smaller files first, once their sizes are known
+        paths = [request[1] for request in server.requests if request[0] == 'GET'][3:]
+        assert paths.index('/small.dat') < paths.index('/big.dat')
+
+        local_path = big.wait(timeout=5)
+        assert os.path.getsize(local_path) == 2**16
+        assert 'md5' in cache.get_entry('sdss/apogee/dr13', 'big.dat')
+        assert small.wait(timeout=5) == os.path.join(cache.root, 'sdss/apogee/dr13',
+                                                     'small.dat')
+        with pytest.raises(IOError):
+            missing.wait(timeout=5)
+
+    with Cache(config_path) as cache:
+        assert cache.check_state(full=True)
+
+def test_probe_in_background(tmpdir):
+    serve_path = str(tmpdir.mkdir('serve'))
+    for name in ('slow.dat', 'fast.dat'):
+        with open(os.path.join(serve_path, name), 'wb') as f:
+            f.write(os.urandom(2**10))
+
+    config_path = str(tmpdir.join('.testconfig'))
+    conf = ConfigParser()
+    conf.add_section('astrodata')
+    conf.set('astrodata', 'repository_path', str(tmpdir.join('astrodata')))
+    with open(config_path, 'w') as configfile:
+        conf.write(configfile)
+
+    with LocalHTTPServer(serve_path) as server, Cache(config_path) as cache:
+        # the first request for slow.dat is its size probe
+        server.delay('slow.dat', 1.)
+        cache.add_data('sdss', server.url('slow.dat'), enqueue=True)
+        fast = cache.add_data('sdss', server.url('fast.dat'), enqueue=True)
+
+        start = time.time()
+        worker = QueueWorker(cache, max_workers=2, poll_interval=0.05, max_probes=1)
+        assert worker.run(until_empty=True) == 2
+
+        # a slow probe does not hold up the jobs
+        assert cache.queue.get(fast.id)['finished'] - start < 0.5
@@ -0,0 +1,65 @@
+from __future__ import (absolute_import, division, print_function,
+                        unicode_literals)
+
+# Standard library
+import os
+
+# Third-party
+import pytest
+
+# Package
+from ..fastcopy import copy_file, ingest_file
+
+def _write(path, data):
+    with open(path, 'wb') as f:
+        f.write(data)
+
+def _read(path):
+    with open(path, 'rb') as f:
+        return f.read()
+
+@pytest.mark.parametrize('size', [0, 1000, 2**20 + 7])
+def test_copy_file(tmpdir, size):
+    data = os.urandom(size)
+    source = str(tmpdir.join('source.dat'))
+    dest = str(tmpdir.join('dest.dat'))
+    _write(source, data)
+    os.utime(source, (1000000000, 1000000000))
+
+    method = copy_file(source, dest)
+    assert method in ('reflink', 'copy_file_range', 'sendfile', 'copy')
+    assert _read(dest) == data
+    assert os.stat(dest).st_mtime == 1000000000
+    assert os.stat(dest).st_ino != os.stat(source).st_ino
+
+def test_ingest_file(tmpdir):
+    data = os.urandom(10000)
+    source = str(tmpdir.join('source.dat'))
+    local = str(tmpdir.join('local.dat'))
+
+    # an existing file is replaced, not written through
+    _write(source, data)
+    _write(local, b'old')
+    other = str(tmpdir.join('other.dat'))
+    os.link(local, other)
+    assert ingest_file(source, local) not in ('rename', 'link')
+    assert _read(local) == data
+    assert _read(other) == b'old'
+    assert os.path.exists(source)
+
+    assert ingest_file(source, local, hardlink=True) == 'link'
+    assert os.stat(local).st_ino == os.stat(source).st_ino
+
+    inode = os.stat(source).st_ino
+    assert ingest_file(source, local, move=True) == 'rename'
+    assert not os.path.exists(source)
+    assert os.stat(local).st_ino == inode
+
+    # no temporary files are left behind
+    assert sorted(os.listdir(str(tmpdir))) == ['local.dat', 'other.dat']
+
+def test_ingest_file_missing(tmpdir):
+    local = str(tmpdir.join('local.dat'))
+    with pytest.raises((IOError, OSError)):
+        ingest_file(str(tmpdir.join('nope.dat')), local, move=True)
+    assert os.listdir(str(tmpdir)) == []
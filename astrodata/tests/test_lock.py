@@ -0,0 +1,141 @@
+from __future__ import (absolute_import, division, print_function,
+                        unicode_literals)
+
+# Standard library
+import json
+import os
+import socket
+import subprocess
+import sys
+import threading
+import time
+
+# Third-party
+from astropy.tests.helper import pytest
+
+# Package
+from ..download import _lock_path, fetch_file
+from ..lock import FileLock, LockTimeout, SingleFlight
+from .helpers import LocalHTTPServer
+
+def test_file_lock(tmpdir):
+    path = str(tmpdir.join('test.lock'))
+
+    with FileLock(path) as lock:
+        assert lock.locked and not lock.waited
+        assert os.path.exists(path)
+
+        with pytest.raises(LockTimeout):
+            FileLock(path, timeout=0.1).acquire()
+
+        other = FileLock(path)
+        thread = threading.Thread(target=other.acquire)
+        thread.start()
+        time.sleep(0.1)
+        assert not other.locked
+
+    thread.join(5)
+    assert other.locked and other.waited
+    other.release()
+    assert not os.path.exists(path)
+
+def test_file_lock_stale(tmpdir):
+    path = str(tmpdir.join('test.lock'))
+
+    # held by a process that has exited
+    process = subprocess.Popen([sys.executable, '-c', 'pass'])
+    process.wait()
+    with open(path, 'w') as f:
+        json.dump(dict(host=socket.gethostname(), pid=process.pid, token='dead'), f)
+    with FileLock(path, timeout=5) as lock:
+        assert lock.waited
+
+    # held by another host that stopped refreshing it
+    with open(path, 'w') as f:
+        json.dump(dict(host='elsewhere', pid=1, token='old'), f)
+    old = time.time() - 120
+    os.utime(path, (old, old))
+    with FileLock(path, timeout=5, stale_after=60) as lock:
+        assert lock.waited
+
+    # a lock that is held is refreshed so that it does not go stale
+    with FileLock(path, stale_after=0.4):
+        time.sleep(0.5)
+        with pytest.raises(LockTimeout):
+            FileLock(path, timeout=0.2, stale_after=0.4).acquire()
+
+def test_single_flight():
+    flights = SingleFlight()
+    started = threading.Event()
+    release = threading.Event()
+    calls = []
+
+    def _work():
+        calls.append(1)
+        started.set()
+        release.wait(5)
+        return 42
+
+    results = []
+    def _call():
+        results.append(flights.do('key', _work))
+
+    leader = threading.Thread(target=_call)
+    leader.start()
+    started.wait(5)
+    followers = [threading.Thread(target=_call) for i in range(4)]
+    for thread in followers:
+        thread.start()
+    time.sleep(0.1)
+    release.set()
+    for thread in [leader] + followers:
+        thread.join(5)
+
+    assert len(calls) == 1
+    assert sorted(results) == [(42, False)] + [(42, True)] * 4
+
+    def _fail():
+        raise IOError('nope')
+    with pytest.raises(IOError):
+        flights.do('key', _fail)
+    assert flights.do('key', lambda: 1) == (1, False)
+
+def test_fetch_file_single_flight(tmpdir):
+    serve_path = str(tmpdir.mkdir('serve'))
+    download_path = str(tmpdir.join('download'))
+    data = os.urandom(2**14)
+    with open(os.path.join(serve_path, 'data.dat'), 'wb') as f:
+        f.write(data)
+
+    with LocalHTTPServer(serve_path) as server:
+        # concurrent requests for one file share a single download
+        server.delay('data.dat', 0.3)
+        results = []
+        def _fetch():
+            results.append(fetch_file(server.url('data.dat'), download_path,
+                                      show_progress=False, overwrite=True))
+        threads = [threading.Thread(target=_fetch) for i in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join(10)
+        assert len(results) == 8
+        assert len(server.requests) == 1
+        assert not os.path.exists(_lock_path(results[0].local_path))
+
+        # another process holds the lock and fetches the file meanwhile
+        local_path = os.path.join(download_path, 'other.dat')
+        lock = FileLock(_lock_path(local_path))
+        lock.acquire()
+        def _other_process():
+            time.sleep(0.2)
+            with open(local_path, 'wb') as f:
+                f.write(data)
+            lock.release()
+        thread = threading.Thread(target=_other_process)
+        thread.start()
+        result = fetch_file(server.url('data.dat'), download_path, filename='other.dat',
+                            show_progress=False, overwrite=True)
+        thread.join(5)
+        assert result.size == len(data)
+        assert len(server.requests) == 1
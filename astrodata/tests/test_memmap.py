@@ -0,0 +1,85 @@
+from __future__ import (absolute_import, division, print_function,
+                        unicode_literals)
+
+# Standard library
+import os
+
+# Third-party
+from astropy.io import fits
+import numpy as np
+
+# Package
+from ..memmap import MappedFiles
+
+def test_mapped_files(tmpdir):
+    maps = MappedFiles(maxsize=2)
+
+    raw_path = str(tmpdir.join('data.dat'))
+    data = np.arange(24, dtype='<f8')
+    data.tofile(raw_path)
+
+    m = maps.open_mmap(raw_path)
+    assert isinstance(m, memoryview)
+    assert m.readonly
+    assert m[:8] == data[:1].tobytes()
+    assert maps.open_mmap(raw_path) is not m
+    assert len(maps) == 1
+
+    arr = maps.load_array(raw_path, dtype='<f8', shape=(4, 6))
+    assert arr.shape == (4, 6)
+    assert not arr.flags.writeable
+    np.testing.assert_array_equal(arr.ravel(), data)
+    assert maps.load_array(raw_path, dtype='<f8', offset=8).shape == (23,)
+    np.testing.assert_array_equal(maps.load_array(raw_path, dtype='<f8', shape=(4, 6),
+                                                  order='F').ravel(order='F'), data)
+    assert len(maps) == 1
+
+    npy_path = str(tmpdir.join('data.npy'))
+    np.save(npy_path, data.reshape(2, 12))
+    arr = maps.load_array(npy_path)
+    assert arr.shape == (2, 12)
+    np.testing.assert_array_equal(arr.ravel(), data)
+    np.save(npy_path, np.asfortranarray(data.reshape(2, 12)))
+    np.testing.assert_array_equal(maps.load_array(npy_path), data.reshape(2, 12))
+
+    fits_path = str(tmpdir.join('data.fits'))
+    fits.PrimaryHDU(data.reshape(4, 6)).writeto(fits_path)
+    hdulist = maps.load_array(fits_path)
+    assert isinstance(hdulist, fits.HDUList)
+    np.testing.assert_array_equal(hdulist[0].data.ravel(), data)
+
+    # only the most recently used maps are kept
+    maps.open_mmap(str(tmpdir.join('data.fits')))
+    assert len(maps) == 2
+    # evicted maps stay usable
+    assert m[:8] == data[:1].tobytes()
+
+    # a changed file is mapped again
+    os.remove(raw_path)
+    data[::-1].tofile(raw_path)
+    assert maps.open_mmap(raw_path)[:8] == data[-1:].tobytes()
+
+    maps.clear()
+    assert len(maps) == 0
+
+def test_mapped_files_callers(tmpdir):
+    maps = MappedFiles()
+    raw_path = str(tmpdir.join('data.dat'))
+    with open(raw_path, 'wb') as f:
+        f.write(b'0123456789')
+
+    # each caller has its own view, which it can release
+    first = maps.open_mmap(raw_path)
+    second = maps.open_mmap(raw_path)
+    first.release()
+    assert bytes(second[:4]) == b'0123'
+    assert bytes(maps.open_mmap(raw_path)[:4]) == b'0123'
+
+    data = np.arange(24, dtype='<f8')
+    fits_path = str(tmpdir.join('data.fits'))
+    fits.PrimaryHDU(data).writeto(fits_path)
+    hdulist = maps.load_array(fits_path)
+    with maps.load_array(fits_path) as other:
+        np.testing.assert_array_equal(other[0].data, data)
+    np.testing.assert_array_equal(hdulist[0].data, data)
+    hdulist.close()
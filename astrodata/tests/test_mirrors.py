@@ -0,0 +1,139 @@
+from __future__ import (absolute_import, division, print_function,
+                        unicode_literals)
+
+# Standard library
+import os
+import threading
+import time
+
+# Third-party
+from astropy.extern.six.moves import urllib
+from astropy.tests.helper import pytest
+
+# Package
+from ..mirrors import HostScores, fetch_mirrored
+from ..telemetry import Event
+from .helpers import LocalHTTPServer
+
+def _event(name, url, **data):
+    return Event(name, url, time.time(), data)
+
+def test_host_scores(tmpdir):
+    path = str(tmpdir.join('hosts.json'))
+    scores = HostScores(path)
+
+    fast, slow, new = 'http://fast/a.dat', 'http://slow/a.dat', 'http://new/a.dat'
+    for i in range(5):
+        scores.record(_event('ttfb', fast, seconds=0.1))
+        scores.record(_event('ttfb', slow, seconds=1.))
+    scores.record(_event('complete', fast, bytes=1000, seconds=1., throughput=100.))
+    scores.record(_event('complete', slow, bytes=1000, seconds=1., throughput=1e6))
+
+    assert scores.rank([slow, fast]) == [fast, slow]
+    # a large file is faster from the host with more throughput
+    assert scores.rank([slow, fast], size=10**6) == [slow, fast]
+    # unknown hosts rank as if average
+    assert scores.rank([slow, new, fast]) == [fast, new, slow]
+    assert scores.ttfb_percentile(fast, 90) == pytest.approx(0.1)
+    assert scores.ttfb_percentile(new, 90) is None
+
+    # failures push a host down until it succeeds again
+    for i in range(4):
+        scores.record(_event('failure', fast, error=IOError(), seconds=0.))
+    assert scores.rank([fast, slow]) == [slow, fast]
+
+    scores.save()
+    assert HostScores(path).rank([fast, slow]) == [slow, fast]
+
+def test_fetch_mirrored_fallback(tmpdir):
+    serve_path = str(tmpdir.mkdir('serve'))
+    download_path = str(tmpdir.join('download'))
+    data = os.urandom(2**14)
+    with open(os.path.join(serve_path, 'data.dat'), 'wb') as f:
+        f.write(data)
+
+    scores = HostScores()
+    with LocalHTTPServer(serve_path) as bad, LocalHTTPServer(serve_path) as good:
+        bad.fail('data.dat', times=10)
+        result = fetch_mirrored([bad.url('data.dat'), good.url('data.dat')],
+                                download_path, scores=scores, show_progress=False)
+        with open(result.local_path, 'rb') as f:
+            assert f.read() == data
+
+        # the failed mirror is now tried last
+        assert scores.rank([bad.url('data.dat'), good.url('data.dat')])[0] == good.url('data.dat')
+
+        with pytest.raises(urllib.error.HTTPError):
+            fetch_mirrored([bad.url('data.dat'), good.url('missing.dat')],
+                           download_path, filename='other.dat', show_progress=False)
+
+def test_fetch_mirrored_hedge(tmpdir):
+    serve_path = str(tmpdir.mkdir('serve'))
+    download_path = str(tmpdir.join('download'))
+    data = os.urandom(2**14)
+    with open(os.path.join(serve_path, 'data.dat'), 'wb') as f:
+        f.write(data)
+
+    with LocalHTTPServer(serve_path) as slow, LocalHTTPServer(serve_path) as fast:
+        slow.delay('data.dat', 2.)
+        events = []
+        start = time.time()
+        result = fetch_mirrored([slow.url('data.dat'), fast.url('data.dat')],
+                                download_path, hedge_delay=0.1, show_progress=False,
+                                hash_algorithm='sha256', event_callback=events.append)
+        assert time.time() - start < 1.5
+
+        assert result.local_path == os.path.join(download_path, 'data.dat')
+        with open(result.local_path, 'rb') as f:
+            assert f.read() == data
+        assert len(fast.requests) == 1
+
+        # a mirror that answers in time is not hedged
+        result = fetch_mirrored([fast.url('data.dat'), slow.url('data.dat')],
+                                download_path, filename='again.dat', hedge_delay=1.,
+                                show_progress=False)
+        assert os.path.exists(result.local_path)
+        assert len(slow.requests) == 1
+
+        # let the cancelled download stop, so its events don't reach later tests
+        while (not any(event.name == 'failure' for event in events) and
+               time.time() - start < 5):
+            time.sleep(0.05)
+
+def test_fetch_mirrored_hedge_single_flight(tmpdir):
+    serve_path = str(tmpdir.mkdir('serve'))
+    download_path = str(tmpdir.join('download'))
+    data = os.urandom(2**14)
+    with open(os.path.join(serve_path, 'data.dat'), 'wb') as f:
+        f.write(data)
+
+    with LocalHTTPServer(serve_path) as slow, LocalHTTPServer(serve_path) as fast:
+        slow.delay('data.dat', 0.5, times=2)
+        fast.delay('data.dat', 0.2, times=2)
+        events = []
+        results = []
+
+        def _fetch():
+            results.append(fetch_mirrored([slow.url('data.dat'), fast.url('data.dat')],
+                                          download_path, hedge_delay=0.1,
+                                          show_progress=False,
+                                          event_callback=events.append))
+
+        # threads hedging the same file share one pair of downloads
+        threads = [threading.Thread(target=_fetch) for i in range(2)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        assert len(results) == 2
+        assert results[0].local_path == results[1].local_path
+        with open(results[0].local_path, 'rb') as f:
+            assert f.read() == data
+        assert len(slow.requests) == 1
+        assert len(fast.requests) == 1
+
+        start = time.time()
+        while (not any(event.name == 'failure' for event in events) and
+               time.time() - start < 5):
+            time.sleep(0.05)
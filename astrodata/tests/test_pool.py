@@ -0,0 +1,84 @@
+from __future__ import (absolute_import, division, print_function,
+                        unicode_literals)
+
+# Standard library
+import os
+import socket
+import time
+
+# Third-party
+from astropy.extern.six.moves import urllib
+from astropy.tests.helper import pytest
+
+# Package
+from ..download import download_file, download_files, fetch_file
+from ..pool import ConnectionPool
+from .helpers import LocalHTTPServer
+
+def _make_data_files(path, n, size=2**14):
+    names = []
+    for i in range(n):
+        name = 'data{}.dat'.format(i)
+        with open(os.path.join(path, name), 'wb') as f:
+            f.write(os.urandom(size))
+        names.append(name)
+    return names
+
+def test_pool_reuse(tmpdir):
+    serve_path = str(tmpdir.mkdir('serve'))
+    download_path = str(tmpdir.join('download'))
+    names = _make_data_files(serve_path, 5)
+    pool = ConnectionPool()
+
+    with LocalHTTPServer(serve_path) as server:
+        for name in names:
+            download_file(server.url(name), download_path, pool=pool,
+                          show_progress=False)
+        assert server.connections == 1
+
+        # the test server closes the connection after an error...
+        with pytest.raises(urllib.error.HTTPError):
+            download_file(server.url('nonexistentfile'), download_path, pool=pool)
+        assert fetch_file(server.url(names[0]), download_path, pool=pool,
+                          refresh=True).not_modified
+        assert server.connections == 2
+
+        # ...but not after a response without a body
+        assert fetch_file(server.url(names[0]), download_path, pool=pool,
+                          refresh=True).not_modified
+        assert server.connections == 2
+
+        # a connection dropped while idle is replaced
+        conn, _ = pool._idle[('http', '127.0.0.1', server.port)][0]
+        conn.sock.shutdown(socket.SHUT_RDWR)
+        download_file(server.url(names[0]), download_path, pool=pool, overwrite=True,
+                      show_progress=False)
+        assert server.connections == 3
+
+        # threads each borrow their own connection
+        results = download_files([(server.url(name), download_path, name + '.copy')
+                                  for name in names], max_workers=3, pool=pool)
+        assert all(error is None for _, error in results)
+        assert server.connections <= 5
+
+    pool.clear()
+    assert pool._idle == dict()
+
+def test_pool_limits(tmpdir):
+    serve_path = str(tmpdir.mkdir('serve'))
+    download_path = str(tmpdir.join('download'))
+    names = _make_data_files(serve_path, 2)
+
+    with LocalHTTPServer(serve_path) as server:
+        pool = ConnectionPool(idle_timeout=0.01)
+        for name in names:
+            download_file(server.url(name), download_path, pool=pool,
+                          show_progress=False)
+            time.sleep(0.05)
+        assert server.connections == 2
+
+        pool = ConnectionPool(maxsize=0)
+        for name in names:
+            download_file(server.url(name), download_path, pool=pool, overwrite=True,
+                          show_progress=False)
+        assert server.connections == 4
@@ -0,0 +1,180 @@
+from __future__ import (absolute_import, division, print_function,
+                        unicode_literals)
+
+# Standard library
+from collections import defaultdict
+import os
+import threading
+import time
+try:
+    from ConfigParser import ConfigParser
+except ImportError:
+    from configparser import ConfigParser
+
+# Third-party
+from astropy.extern.six.moves import urllib
+
+# Package
+from ..cache import Cache
+from ..download import download_files
+from ..scheduler import Scheduler, TokenBucket
+from ..telemetry import Event
+from .helpers import LocalHTTPServer
+
+def _event(name, url, **data):
+    return Event(name, url, time.time(), data)
+
+def test_token_bucket():
+    bucket = TokenBucket(1000., burst=100)
+    start = time.time()
+    bucket.consume(100)
+    assert time.time() - start < 0.05
+
+    bucket.consume(300)
+    assert time.time() - start >= 0.25
+
+def test_adaptive_limits():
+    scheduler = Scheduler(max_per_host=4, initial_per_host=1)
+    url = 'http://archive.example.org/data.dat'
+    complete = _event('complete', url, bytes=2**20, throughput=100.)
+
+    # one more connection per download at first, up to the maximum
+    for limit in (2, 3, 4, 4):
+        scheduler.record(complete)
+        assert scheduler.limits() == {'archive.example.org': limit}
+
+    # halved by server errors, but not by missing files
+    error = urllib.error.HTTPError(url, 503, 'Unavailable', {}, None)
+    scheduler.record(_event('retry', url, attempt=1, error=error))
+    assert scheduler.limits()['archive.example.org'] == 2
+    error = urllib.error.HTTPError(url, 404, 'Not Found', {}, None)
+    scheduler.record(_event('failure', url, error=error, seconds=0.1))
+    assert scheduler.limits()['archive.example.org'] == 2
+
+    # then one more connection per window of downloads
+    limits = []
+    for i in range(3):
+        scheduler.record(complete)
+        limits.append(scheduler.limits()['archive.example.org'])
+    assert limits == [2, 2, 3]
+
+    # one fewer when adding connections made the host slower overall
+    scheduler._state('archive.example.org').active = 3
+    scheduler.record(_event('complete', url, bytes=100, throughput=10.))
+    assert scheduler.limits()['archive.example.org'] == 3
+    scheduler.record(_event('complete', url, bytes=2**20, throughput=10.))
+    assert scheduler.limits()['archive.example.org'] == 2
+
+    # local files are not tracked
+    scheduler.record(_event('complete', '/tmp/data.dat', bytes=100, throughput=100.))
+    assert list(scheduler.limits()) == ['archive.example.org']
+
+def test_map():
+    scheduler = Scheduler(max_per_host=4, initial_per_host=4,
+                          host_limits={'slow.example.org': 1})
+    lock = threading.Lock()
+    active = defaultdict(int)
+    most = defaultdict(int)
+    finished = []
+
+    def _work(url, i):
+        host = urllib.parse.urlsplit(url).netloc
+        with lock:
+            active[host] += 1
+            most[host] = max(most[host], active[host])
+        time.sleep(0.05)
+        with lock:
+            active[host] -= 1
+            finished.append((host, i))
+        if i == 3:
+            raise IOError('nope')
+        return i
+
+    jobs = ([('http://slow.example.org/{}'.format(i), i) for i in range(4)] +
+            [('http://fast.example.org/{}'.format(i), i) for i in range(4, 12)])
+    results = scheduler.map(_work, jobs, max_workers=5)
+
+    assert [result for result, error in results] == [0, 1, 2, None] + list(range(4, 12))
+    assert isinstance(results[3][1], IOError)
+    assert most['slow.example.org'] == 1
+    assert most['fast.example.org'] == 4
+
+    # the slow host does not hold up the fast one, and keeps its order
+    assert finished[-1] == ('slow.example.org', 3)
+    assert [i for host, i in finished if host == 'slow.example.org'] == [0, 1, 2, 3]
+
+def test_map_unlimited():
+    scheduler = Scheduler(host_limits={'slow.example.org': 1})
+    lock = threading.Lock()
+    active = defaultdict(int)
+    most = defaultdict(int)
+
+    def _work(url):
+        host = urllib.parse.urlsplit(url).netloc
+        with lock:
+            active[host] += 1
+            most[host] = max(most[host], active[host])
+        time.sleep(0.05)
+        with lock:
+            active[host] -= 1
+
+    # without a window, a host gets as many workers as were asked for
+    jobs = ([('http://fast.example.org/{}'.format(i),) for i in range(12)] +
+            [('http://slow.example.org/{}'.format(i),) for i in range(2)])
+    scheduler.map(_work, jobs, max_workers=6)
+    assert most['fast.example.org'] == 6
+    assert most['slow.example.org'] == 1
+
+    error = urllib.error.HTTPError('http://fast.example.org/0', 503, 'Unavailable', {}, None)
+    scheduler.record(_event('retry', 'http://fast.example.org/0', attempt=1, error=error))
+    assert scheduler.limits() == {'fast.example.org': None, 'slow.example.org': 1}
+
+def test_download_files_scheduler(tmpdir):
+    serve_path = str(tmpdir.mkdir('serve'))
+    download_path = str(tmpdir.join('download'))
+    for i in range(3):
+        with open(os.path.join(serve_path, '{}.dat'.format(i)), 'wb') as f:
+            f.write(os.urandom(2**15))
+
+    with LocalHTTPServer(serve_path) as server:
+        requests = [(server.url('{}.dat'.format(i)), download_path) for i in range(3)]
+        host = urllib.parse.urlsplit(server.url('')).netloc
+
+        scheduler = Scheduler(max_per_host=8)
+        results = download_files(requests, scheduler=scheduler, overwrite=True)
+        assert all(error is None for _, error in results)
+        assert scheduler.limits()[host] == 5
+
+        scheduler = Scheduler(max_bandwidth=2**16)
+        start = time.time()
+        results = download_files(requests, scheduler=scheduler, overwrite=True)
+        assert all(error is None for _, error in results)
+        # 96K at 64K per second, after a 64K burst
+        assert time.time() - start >= 0.4
+
+def test_cache_scheduler(tmpdir):
+    serve_path = str(tmpdir.mkdir('serve'))
+    for i in range(4):
+        with open(os.path.join(serve_path, '{}.dat'.format(i)), 'wb') as f:
+            f.write(os.urandom(2**12))
+
+    with LocalHTTPServer(serve_path) as server:
+        host = urllib.parse.urlsplit(server.url('')).netloc
+
+        config_path = str(tmpdir.join('.testconfig'))
+        conf = ConfigParser()
+        conf.add_section('astrodata')
+        conf.set('astrodata', 'repository_path', str(tmpdir.join('astrodata')))
+        hostname = urllib.parse.urlsplit(server.url('')).hostname
+        conf.set('astrodata', 'max_connections_per_host.' + hostname, '1')
+        conf.set('astrodata', 'max_bandwidth', '1M')
+        with open(config_path, 'w') as configfile:
+            conf.write(configfile)
+
+        with Cache(config_path) as cache:
+            assert cache.scheduler.bucket.rate == 2**20
+            results = cache.add_data_many([('sdss', server.url('{}.dat'.format(i)))
+                                           for i in range(4)], max_workers=4)
+            assert all(result.error is None for result in results)
+            assert cache.scheduler.limits() == {host: 1}
+            assert cache.check_state(full=True)
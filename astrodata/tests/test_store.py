@@ -0,0 +1,52 @@
+from __future__ import (absolute_import, division, print_function,
+                        unicode_literals)
+
+# Standard library
+import hashlib
+import os
+
+# Package
+from ..store import ObjectStore, hash_file
+
+def _write(path, data):
+    with open(path, 'wb') as f:
+        f.write(data)
+
+def _read(path):
+    with open(path, 'rb') as f:
+        return f.read()
+
+def test_hash_file(tmpdir):
+    path = str(tmpdir.join('data.dat'))
+    data = os.urandom(2**16 + 5)
+    _write(path, data)
+
+    assert hash_file(path) == hashlib.sha256(data).hexdigest()
+    assert hash_file(path, 'md5', block_size=1000) == hashlib.md5(data).hexdigest()
+
+def test_object_store(tmpdir):
+    store = ObjectStore(str(tmpdir))
+    data = os.urandom(1000)
+
+    path1 = str(tmpdir.join('data1.dat'))
+    path2 = str(tmpdir.join('data2.dat'))
+    _write(path1, data)
+    _write(path2, data)
+
+    digest = store.add(path1)
+    assert digest == hashlib.sha256(data).hexdigest()
+    assert digest in store
+    assert os.path.exists(path1)
+    assert _read(store.object_path(digest)) == data
+
+    # the same contents are not stored twice, and a moved file is removed
+    assert store.add(path2, move=True) == digest
+    assert not os.path.exists(path2)
+    assert len(os.listdir(os.path.dirname(store.object_path(digest)))) == 1
+
+    store.link(digest, path1)
+    store.link(digest, path2)
+    assert _read(path2) == data
+    assert os.stat(path1).st_ino == os.stat(store.object_path(digest)).st_ino
+    assert os.stat(store.object_path(digest)).st_nlink == 3
+    assert sorted(os.listdir(str(tmpdir))) == ['.objects', 'data1.dat', 'data2.dat']
@@ -0,0 +1,107 @@
+from __future__ import (absolute_import, division, print_function,
+                        unicode_literals)
+
+# Standard library
+import os
+
+# Third-party
+import astropy.units as u
+from astropy.extern.six.moves import urllib
+from astropy.tests.helper import pytest
+
+# Package
+from ..download import download_file
+from ..telemetry import Event, Stats, add_listener, emit, remove_listener
+from .helpers import LocalHTTPServer
+
+def test_stats():
+    stats = Stats()
+    for i in range(100):
+        emit(stats.record, 'operation', operation='add_data', seconds=float(i))
+    emit(stats.record, 'start', 'http://example.com/a')
+    emit(stats.record, 'retry', 'http://example.com/a', attempt=1, error=None)
+    emit(stats.record, 'complete', 'http://example.com/a', bytes=1000, seconds=2.,
+         throughput=500.)
+    emit(stats.record, 'failure', 'http://example.com/b', error=None, seconds=1.)
+
+    with stats.timed('close'):
+        pass
+
+    summary = stats.summary()
+    assert summary['downloads_started'] == 1
+    assert summary['downloads_completed'] == 1
+    assert summary['downloads_failed'] == 1
+    assert summary['retries'] == 1
+    assert summary['bytes'] == 1000
+
+    timing = summary['timings']['add_data']
+    assert timing['count'] == 100
+    assert timing['total'] == sum(range(100))
+    assert timing['max'] == 99.
+    assert timing['p50'] == 50.
+    assert timing['p99'] == 98.
+    assert summary['timings']['download']['count'] == 1
+    assert summary['timings']['close']['count'] == 1
+
+def test_stats_bounded():
+    stats = Stats(max_samples=10)
+    for i in range(100):
+        emit(stats.record, 'operation', operation='add_data', seconds=float(i))
+
+    # totals cover every duration, percentiles only the most recent ones
+    timing = stats.summary()['timings']['add_data']
+    assert timing['count'] == 100
+    assert timing['total'] == sum(range(100))
+    assert timing['max'] == 99.
+    assert timing['p50'] == 94.
+    assert len(stats._timings['add_data'].recent) == 10
+
+def test_write_prometheus(tmpdir):
+    stats = Stats()
+    emit(stats.record, 'complete', 'http://example.com/a', bytes=1000, seconds=2.,
+         throughput=500.)
+
+    path = str(tmpdir.join('astrodata.prom'))
+    stats.write_prometheus(path)
+    with open(path) as f:
+        lines = f.read().splitlines()
+
+    assert '# TYPE astrodata_downloads_total counter' in lines
+    assert 'astrodata_downloads_total{status="completed"} 1' in lines
+    assert 'astrodata_download_bytes_total 1000' in lines
+    assert 'astrodata_operation_seconds{operation="download",quantile="0.5"} 2.0' in lines
+    assert 'astrodata_operation_seconds_count{operation="download"} 1' in lines
+    assert os.listdir(str(tmpdir)) == ['astrodata.prom']
+
+def test_download_events(tmpdir):
+    serve_path = str(tmpdir.mkdir('serve'))
+    download_path = str(tmpdir.join('download'))
+    with open(os.path.join(serve_path, 'data.dat'), 'wb') as f:
+        f.write(os.urandom(1000))
+
+    events = []
+    listened = []
+    add_listener(listened.append)
+    try:
+        with LocalHTTPServer(serve_path) as server:
+            server.fail('data.dat')
+            download_file(server.url('data.dat'), download_path, retries=1,
+                          retry_backoff=0.01*u.second, event_callback=events.append)
+
+            with pytest.raises(urllib.error.HTTPError):
+                download_file(server.url('nonexistentfile'), download_path,
+                              event_callback=events.append)
+    finally:
+        remove_listener(listened.append)
+
+    assert [event.name for event in events] == ['start', 'retry', 'ttfb', 'complete',
+                                                'start', 'failure']
+    assert listened == events
+    assert all(isinstance(event, Event) for event in events)
+
+    complete = events[3]
+    assert complete.url == server.url('data.dat')
+    assert complete.data['bytes'] == 1000
+    assert complete.data['throughput'] > 0
+    assert events[1].data['attempt'] == 1
+    assert isinstance(events[-1].data['error'], urllib.error.HTTPError)
@@ -0,0 +1,87 @@
+from __future__ import (absolute_import, division, print_function,
+                        unicode_literals)
+
+# Standard library
+import json
+import os
+
+# Package
+from ..catalog import SQLiteCatalog
+from ..upstream import HTTPUpstream, LocalUpstream, open_upstream
+from .helpers import LocalHTTPServer
+
+def _write_schema(path):
+    schema = {'sdss': {'apogee': {'data.dat': {'source': 'http://origin/data.dat',
+                                               'mirrors': ['http://mirror/data.dat']}}}}
+    with open(os.path.join(path, 'schema.json'), 'w') as f:
+        json.dump(schema, f)
+
+def test_local_upstream(tmpdir):
+    root = str(tmpdir)
+    _write_schema(root)
+
+    upstream = open_upstream(root)
+    assert isinstance(upstream, LocalUpstream)
+    assert upstream.get('sdss/apogee', 'data.dat')['source'] == 'http://origin/data.dat'
+    assert upstream.location('sdss/apogee', 'data.dat') == os.path.join(root, 'sdss',
+                                                                        'apogee', 'data.dat')
+
+    # by place, then by source or mirror
+    assert upstream.find('sdss/apogee/', 'data.dat')[:2] == ('sdss/apogee', 'data.dat')
+    assert upstream.find('gaia', 'x.dat', source='http://mirror/data.dat')[:2] == \
+        ('sdss/apogee', 'data.dat')
+    assert upstream.find('sdss/apogee', 'data.dat', source='http://other/data.dat') is None
+    assert upstream.find('gaia', 'x.dat') is None
+
+    assert LocalUpstream(str(tmpdir.join('missing'))).get('sdss', 'data.dat') is None
+
+def test_local_upstream_sqlite(tmpdir):
+    root = str(tmpdir)
+    path = os.path.join(root, 'schema.db')
+    catalog = SQLiteCatalog(path)
+    catalog.set_many([('sdss/apogee', 'data.dat',
+                       {'source': 'http://origin/data.dat',
+                        'mirrors': ['http://mirror/data.dat']}),
+                      ('gaia', 'tgas.dat', {'source': 'http://origin/tgas.dat'})])
+    catalog.close()
+    with open(path, 'rb') as f:
+        before = f.read()
+    listing = sorted(os.listdir(root))
+
+    upstream = LocalUpstream(root)
+    assert upstream.get('sdss/apogee/', 'data.dat')['source'] == 'http://origin/data.dat'
+    assert upstream.get('sdss/apogee', 'other.dat') is None
+    assert upstream.find('x', 'y.dat', source='http://origin/tgas.dat')[:2] == \
+        ('gaia', 'tgas.dat')
+    assert upstream.find('x', 'y.dat', source='http://mirror/data.dat')[:2] == \
+        ('sdss/apogee', 'data.dat')
+    assert upstream.find('x', 'y.dat', source='http://mirror/other.dat') is None
+
+    # each file is looked up on its own, and nothing is written
+    assert upstream._index is None
+    with open(path, 'rb') as f:
+        assert f.read() == before
+    assert sorted(os.listdir(root)) == listing
+
+    # changes made while the repository is in use are seen
+    catalog = SQLiteCatalog(path)
+    catalog.set('gaia', 'dr2.dat', {'source': 'http://origin/dr2.dat'})
+    catalog.commit()
+    try:
+        assert upstream.get('gaia', 'dr2.dat')['source'] == 'http://origin/dr2.dat'
+    finally:
+        catalog.close()
+
+def test_http_upstream(tmpdir):
+    root = str(tmpdir)
+    _write_schema(root)
+
+    with LocalHTTPServer(root) as server:
+        upstream = open_upstream(server.url(''))
+        assert isinstance(upstream, HTTPUpstream)
+        assert upstream.get('sdss/apogee', 'data.dat') is not None
+        assert upstream.location('sdss/apogee', 'a b.dat') == server.url('sdss/apogee/a%20b.dat')
+        assert upstream.location('.', 'a.dat') == server.url('a.dat')
+
+    with LocalHTTPServer(str(tmpdir.mkdir('empty'))) as server:
+        assert HTTPUpstream(server.url('')).get('sdss/apogee', 'data.dat') is None
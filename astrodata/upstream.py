@@ -0,0 +1,202 @@
+""" Read-only upstream repositories that a cache reads through to """
+
+from __future__ import division, print_function
+
+# Standard library
+import json
+import os
+import threading
+
+# Third party
+from astropy.extern.six.moves import urllib
+
+# Package
+from .catalog import _connect_read_only, _iter_nested, _normalize_sub_path, read_entries
+
+__all__ = ['LocalUpstream', 'HTTPUpstream', 'open_upstream']
+
+class _Upstream(object):
+    """
+    An AstroData repository whose schema is read once, on first use, and
+    whose files are only ever copied out of it.
+    """
+
+    def __init__(self):
+        self._index = None
+        self._sources = None
+        self._lock = threading.Lock()
+
+    def _read_entries(self):
+        raise NotImplementedError()
+
+    def location(self, sub_path, name):
+        """ The path or URL of a file in the repository. """
+        raise NotImplementedError()
+
+    def _load(self):
+        with self._lock:
+            if self._index is None:
+                index = dict()
+                sources = dict()
+                for sub_path, name, entry in self._read_entries():
+                    key = (_normalize_sub_path(sub_path), name)
+                    index[key] = entry
+                    for source in [entry.get('source')] + list(entry.get('mirrors', [])):
+                        if source is not None:
+                            sources.setdefault(source, key)
+                self._index, self._sources = index, sources
+        return self._index
+
+    def _get(self, key):
+        return self._load().get(key)
+
+    def _find_source(self, source):
+        """ ``(sub_path, name, entry)`` of a file with this source or mirror, or `None`. """
+        index = self._load()
+        key = self._sources.get(source)
+        if key is None:
+            return None
+        return key + (index[key],)
+
+    def get(self, sub_path, name):
+        """ Return the entry for file ``name`` under ``sub_path``, or `None`. """
+        return self._get((_normalize_sub_path(sub_path), name))
+
+    def find(self, sub_path, name, source=None):
+        """
+        Find a file by its place in the repository or, failing that, by its
+        source URL (or one of its mirrors).
+
+        Returns
+        -------
+        found : tuple or None
+            ``(sub_path, name, entry)`` of the file, or `None`.
+        """
+        key = (_normalize_sub_path(sub_path), name)
+        entry = self._get(key)
+        if entry is not None and (source is None or entry.get('source') == source or
+                                  source in entry.get('mirrors', [])):
+            return key + (entry,)
+
+        if source is not None:
+            return self._find_source(source)
+
+        return None
+
+class LocalUpstream(_Upstream):
+    """
+    A repository on a local or network filesystem (e.g., NFS), with either a
+    JSON or an SQLite schema. An SQLite schema is opened read-only and
+    queried for each file, instead of being read whole.
+
+    Parameters
+    ----------
+    root : str
+        The root of the repository.
+    """
+
+    def __init__(self, root):
+        super(LocalUpstream, self).__init__()
+        self.root = os.path.abspath(os.path.expanduser(root))
+
+    def _read_entries(self):
+        for filename in ('schema.db', 'schema.json'):
+            path = os.path.join(self.root, filename)
+            if os.path.exists(path):
+                return read_entries(path)
+        return []
+
+    def _query(self, sql, parameters):
+        path = os.path.join(self.root, 'schema.db')
+        if not os.path.exists(path):
+            return None
+
+        # a connection per query, since the schema may be replaced at any time
+        # (e.g., by a migration)
+        conn = _connect_read_only(path)
+        try:
+            return conn.execute(sql, parameters).fetchall()
+        finally:
+            conn.close()
+
+    def _get(self, key):
+        rows = self._query('SELECT metadata FROM entries WHERE sub_path = ? AND name = ?',
+                           key)
+        if rows is None:
+            return super(LocalUpstream, self)._get(key)
+        return json.loads(rows[0][0]) if rows else None
+
+    def _find_source(self, source):
+        rows = self._query('SELECT sub_path, name, metadata FROM entries '
+                           'WHERE source = ? ORDER BY sub_path, name LIMIT 1', (source,))
+        if rows is None:
+            return super(LocalUpstream, self)._find_source(source)
+
+        if not rows:
+            # mirrors are not indexed, so only the entries mentioning the URL
+            # are read back to check
+            rows = self._query('SELECT sub_path, name, metadata FROM entries '
+                               'WHERE instr(metadata, ?) > 0 ORDER BY sub_path, name',
+                               (json.dumps(source),))
+        for sub_path, name, metadata in rows:
+            entry = json.loads(metadata)
+            if entry.get('source') == source or source in entry.get('mirrors', []):
+                return sub_path, name, entry
+        return None
+
+    def location(self, sub_path, name):
+        return os.path.join(self.root, sub_path, name)
+
+    def __repr__(self):
+        return '<LocalUpstream {0}>'.format(self.root)
+
+class HTTPUpstream(_Upstream):
+    """
+    A repository served over HTTP, with its ``schema.json`` at the base URL
+    and the files under it at their sub paths.
+
+    Parameters
+    ----------
+    base_url : str
+        The URL of the root of the repository.
+    pool : `~astrodata.pool.ConnectionPool` (optional)
+        The pool to read the schema with (default is the shared
+        `~astrodata.pool.default_pool`).
+    timeout : float (optional)
+        The timeout in seconds for reading the schema (default is 10).
+    """
+
+    def __init__(self, base_url, pool=None, timeout=10.):
+        super(HTTPUpstream, self).__init__()
+        self.base_url = base_url.rstrip('/') + '/'
+        self.pool = pool
+        self.timeout = timeout
+
+    def _read_entries(self):
+        from .pool import default_pool
+        pool = self.pool if self.pool is not None else default_pool
+        try:
+            with pool.urlopen(self.base_url + 'schema.json', timeout=self.timeout) as response:
+                schema = json.loads(response.read().decode('utf-8'))
+        except urllib.error.HTTPError as e:
+            if e.code == 404:
+                return []
+            raise
+        return list(_iter_nested(schema))
+
+    def location(self, sub_path, name):
+        pieces = [piece for piece in _normalize_sub_path(sub_path).split('/')
+                  if piece != '.']
+        return self.base_url + urllib.parse.quote('/'.join(pieces + [name]))
+
+    def __repr__(self):
+        return '<HTTPUpstream {0}>'.format(self.base_url)
+
+def open_upstream(location, pool=None):
+    """
+    Return an `~astrodata.upstream.HTTPUpstream` for an ``http://`` or
+    ``https://`` URL, and otherwise a `~astrodata.upstream.LocalUpstream`.
+    """
+    if urllib.parse.urlsplit(location).scheme in ('http', 'https'):
+        return HTTPUpstream(location, pool=pool)
+    return LocalUpstream(location)
@@ -130,6 +130,7 @@ setup(name=PACKAGENAME,
       description=DESCRIPTION,
       scripts=scripts,
       install_requires=metadata.get('install_requires', 'astropy').strip().split(),
+      python_requires=metadata.get('python_requires', '>=3.7'),
       author=AUTHOR,
       author_email=AUTHOR_EMAIL,
       license=LICENSE,